@@ -1,21 +1,99 @@
 from fastapi import FastAPI, HTTPException, Depends, status, Query
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, FileResponse, PlainTextResponse
 from pydantic import BaseModel
 import socketio
+import fast_json
+from fast_json import FastJSONResponse
 from typing import List, Optional
-from auth import create_admin_user, authenticate_user, hash_password, verify_password,find_user_by_username,find_user_online_status,verify_credentials
-from db import chat_collection, user_collection,client
-from models import Chat, Message, User,ChatCreate,UserUpdateModel
+from auth import authenticate_socket, check_secret_key, create_admin_user, credential_cache, rate_limited_user, hash_password_async, verify_password_async, create_access_token, invalidate_credentials, ACCESS_TOKEN_EXPIRE_MINUTES,find_user_by_username,find_users_by_usernames,find_user_online_status,verify_credentials
+from db import chat_collection, user_collection, message_collection, export_job_collection, inbox_collection, message_archive_collection, mongo
+from message_store import append_messages, decode_message_cursor, encode_message_cursor
+from indexes import bootstrap as bootstrap_indexes, ensure_indexes, participant_key, SORTABLE_CHAT_FIELDS
+from export import EXPORT_FORMATS, export_chunks, export_filename
+from export_jobs import export_jobs
+from search_index import search_index, SEARCH_MAX_OFFSET
+from inbox import add_chat as add_inbox_rows, get_inbox_page, mark_read as mark_inbox_read, record_messages as record_inbox_messages, unread_key
+from stats import stats_service
+from retention import compaction
+from tail_cache import tail_cache
+from models import Chat, ChatMessage, Message, User,ChatCreate,UserUpdateModel,ExportJobCreate,RetentionPolicy, naive_utc
+from presence import PresenceRegistry
+from socket_bus import create_client_manager
+from hashing import password_hasher, HashingBusyError
+from ingest import DeliveryAckBatcher, MessagePipeline, ReadReceiptBatcher, MESSAGE_DURABILITY
+from metrics import Gauge, MetricsMiddleware, METRICS_ENABLED, log_message, render as render_metrics, socket_fanout
+from replay import replay_log, replay_missed, replay_stats, sequences
+from rate_limit import LimitedServer, message_limiter, rest_limiter
+from user_cache import get_profiles, invalidate_profile, store_profile, profile_cache
 from bson.objectid import ObjectId
+from contextlib import asynccontextmanager
+import asyncio
+import os
+import time
+import base64
+import json
 from datetime import datetime
-from dateutil import parser  
 from pymongo import ASCENDING, DESCENDING
-from pymongo.errors import PyMongoError
-from io import StringIO
+from pymongo.errors import DuplicateKeyError, PyMongoError
 
-app = FastAPI()
+# Seconds a draining worker waits for its sockets to close
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", "10"))
+# Seconds /ready waits for the database to answer
+READY_PING_TIMEOUT = float(os.getenv("READY_PING_TIMEOUT", "2"))
+
+# starting -> ready -> draining, reported by /ready
+lifecycle = {"state": "starting", "startup_seconds": None}
+
+# Backend initialization and shutdown
+@asynccontextmanager
+async def lifespan(app):
+    print("FastAPI app is starting...")
+    started = time.perf_counter()
+    check_secret_key()
+    # The Mongo client connects on first use, wait until the database answers before serving
+    await mongo.wait_ready()
+    # Creates missing indexes, and fails the start on unindexed queries when QUERY_PLAN_CHECK is set
+    await bootstrap_indexes()
+    await create_admin_user()
+    # Listen to the other workers from startup rather than from the first socket,
+    # cache invalidations reach workers that have no socket connected
+    if not sio.manager_initialized:
+        sio.manager_initialized = True
+        client_manager.initialize()
+    await stats_service.start()
+    message_pipeline.start()
+    read_receipts.start()
+    delivery_acks.start()
+    # Also resumes export jobs interrupted by the last shutdown
+    export_jobs.start()
+    # Archives and expires old history in the background
+    compaction.start()
+    lifecycle["state"] = "ready"
+    lifecycle["startup_seconds"] = round(time.perf_counter() - started, 3)
+    print(f"FastAPI app is ready after {lifecycle['startup_seconds']}s")
+
+    yield
+
+    print("FastAPI app is shutting down...")
+    await drain()
+    # Write the messages still waiting in the pipeline before the process exits
+    await message_pipeline.stop()
+    await read_receipts.stop()
+    await delivery_acks.stop()
+    await export_jobs.stop()
+    await compaction.stop()
+    await stats_service.stop()
+    # Let the other workers forget the sessions of this one
+    await client_manager.drop_host()
+    password_hasher.shutdown()
+    search_index.close()
+    # Last, everything above may still write
+    mongo.close()
+
+# Responses are rendered with the fast JSON encoder (orjson when installed)
+app = FastAPI(default_response_class=FastJSONResponse, lifespan=lifespan)
 
 # Use FastAPI's built-in HTTPBasic dependency for basic authentication
 security = HTTPBasic()
@@ -32,134 +110,320 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Latency and status of every HTTP request, served at /metrics
+app.add_middleware(MetricsMiddleware)
+
 #user default value
 aboutme_value="I am a Dummy!!"
 
-# Socket.IO Server
-sio = socketio.AsyncServer(
+# Number of online users returned per snapshot page
+ONLINE_USERS_PAGE_SIZE = 100
+
+# Users shown as online (sessions of users whose status is Online)
+online_users = PresenceRegistry()
+
+# Every socket that joined its user's rooms, whatever the user's status
+socket_users = PresenceRegistry()
+
+# In-process by default, a pub/sub backend when SOCKETIO_MESSAGE_QUEUE is set so several workers can share sockets and presence
+client_manager = create_client_manager()
+presence_registries = {"online_users": online_users, "socket_users": socket_users}
+client_manager.attach_registries(presence_registries)
+
+
+def forget_user(username=None):
+    """Drop the cached credentials and profile of a user, or of everyone."""
+    invalidate_credentials(username)
+    invalidate_profile(username)
+
+
+# Other workers forget the user too, or they would accept an old password until AUTH_CACHE_TTL expires
+client_manager.attach_caches({"users": forget_user})
+
+# Socket.IO Server, counting and timing the events it handles, rate limiting them per socket
+# and bounding the packets queued for slow clients
+sio = LimitedServer(
     async_mode='asgi',
+    client_manager=client_manager,
+    json=fast_json,  # Encodes every event payload
     cors_allowed_origins=["http://localhost:3000"]  # Allow frontend origin for WebSocket
 )
 
-
-# Store connected users in a set or a dictionary
-online_users = set()
-online_user_list = []
+# Values the app already tracks, read when /metrics is scraped
+Gauge("socketio_connected_sockets", "Sockets connected to this worker", function=lambda: len(sio.eio.sockets))
+Gauge("online_users", "Users shown as online", function=lambda: online_users.count())
+Gauge("password_hash_pending", "Password checks running or waiting", function=lambda: password_hasher.pending)
+Gauge("message_pipeline_queued", "Messages waiting to be written", function=lambda: message_pipeline.depth())
+Gauge("delivery_acks_queued", "Delivery acknowledgements waiting to be written", function=lambda: delivery_acks.depth())
+Gauge("read_receipts_queued", "Read receipts waiting to be written", function=lambda: read_receipts.depth())
+Gauge("tail_cache_bytes", "Estimated memory held by cached chat tails", function=lambda: tail_cache.size)
+
+def local_room_size(room):
+    # Sockets of this worker in a room, other workers count their own
+    return len(sio.manager.rooms.get('/', {}).get(room, ()))
+
+# Register a session in a presence registry and share it with the other workers
+async def add_session(registry_name, username, sid):
+    first_session = presence_registries[registry_name].add(username, sid, host=client_manager.host_id)
+    await client_manager.share_presence(registry_name, "add", username, sid)
+    return first_session
+
+async def remove_session(registry_name, sid):
+    username, last_session = presence_registries[registry_name].remove(sid)
+    if username is not None:
+        await client_manager.share_presence(registry_name, "remove", username, sid)
+    return username, last_session
+
+# Room names used for targeted fan-out
+def user_room(username):
+    return f"user:{username}"
+
+def chat_room(chat_id):
+    return f"chat:{chat_id}"
 
 #custom functions
-def format_message(sender, time_str, content):
-    # Ensure the time is formatted as dd/mm/yy hh:mm:ss
-    formatted_time = time_str.strftime("%d/%m/%y %H:%M:%S")
-    return f"{sender} ({formatted_time}): {content}"
-
-# Backend initialization hook
-@app.on_event("startup")
-async def on_startup():
-    print("FastAPI app is starting...")
-    await create_admin_user()
-    
-@app.on_event("shutdown")
-async def shutdown_event():
-    print("FastAPI app is shutting down...")
+def encode_chat_cursor(sort_field, order, chat):
+    # Opaque continuation token: the sort key of the last chat of a page
+    value = chat.get(sort_field)
+    payload = {"f": sort_field, "o": order, "v": value.isoformat() if value else None, "id": chat["_id"]}
+    return base64.urlsafe_b64encode(json.dumps(payload).encode("utf-8")).decode("ascii")
+
+def decode_chat_cursor(cursor, sort_field, order):
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        value = datetime.fromisoformat(payload["v"]) if payload["v"] else None
+        chat_id = payload["id"]
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if payload.get("f") != sort_field or payload.get("o") != order:
+        raise HTTPException(status_code=400, detail="Cursor was issued for a different sort")
+    return value, chat_id
+
+# Join a socket to its user's room and to the room of every chat the user takes part in
+async def join_user_rooms(sid, username):
+    await add_session("socket_users", username, sid)
+    await sio.enter_room(sid, user_room(username))
+    chat_ids = set()
+    async for chat in chat_collection.find({"participants": username}, {"_id": 1}):
+        await sio.enter_room(sid, chat_room(chat["_id"]))
+        chat_ids.add(chat["_id"])
+    return chat_ids
+
+# Messages a reconnecting client missed, resume maps chat ids to the last seq it saw.
+# Called after the socket joined its rooms, so newer messages arrive live and the client drops repeats by seq.
+async def replay_for(chat_ids, resume):
+    if not isinstance(resume, dict):
+        return {}
+    resumed = [(chat_id, seq) for chat_id, seq in resume.items() if chat_id in chat_ids and isinstance(seq, int)]
+    replays = await asyncio.gather(*[replay_missed(chat_id, seq) for chat_id, seq in resumed])
+    return {chat_id: replay for (chat_id, _), replay in zip(resumed, replays)}
+
+# Stop taking new sockets and close the open ones, their clients reconnect to another worker
+# and catch up through the seq replay
+async def drain():
+    if lifecycle["state"] == "draining":
+        return
+    lifecycle["state"] = "draining"
+    if sio.eio.sockets:
+        try:
+            await asyncio.wait_for(sio.eio.disconnect(), DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            print(f"{len(sio.eio.sockets)} sockets were still open after {DRAIN_TIMEOUT}s of draining")
+
+@sio.event
+async def connect(sid, environ, auth=None):
+    # A draining worker refuses new sockets
+    if lifecycle["state"] != "ready":
+        raise socketio.exceptions.ConnectionRefusedError("Server is shutting down")
+    # The user is authenticated once here, handlers only trust the username kept in the session
+    try:
+        username = await authenticate_socket(auth)
+    except HashingBusyError as e:
+        raise socketio.exceptions.ConnectionRefusedError({"detail": "Too many password checks in progress", "retry_after": e.retry_after})
+    if username is None:
+        raise socketio.exceptions.ConnectionRefusedError("Invalid credentials")
+    await sio.save_session(sid, {"username": username})
+
+# Username the socket authenticated as at connect
+async def session_user(sid):
+    session = await sio.get_session(sid)
+    return session.get("username")
 
 # Handle socket disconnection
 @sio.event
 async def disconnect(sid):
-    username = [user for user, session_id in online_users if session_id == sid]
-    #print(online_users)
-    if username:
-        #print(f'{username[0]} and session id {sid}')
-        online_users.remove((username[0], sid))
-        online_user_list = [item[0] for item in online_users]
-        #print(f'Online user list {online_user_list} when disconnection of {username[0]}')
-        await sio.emit('user_offline', {'username': username[0],'online_users':online_user_list})
-    #print(f"User disconnected: {sid}")
+    # Socket.IO removes the socket from its rooms by itself
+    await remove_session("socket_users", sid)
+    username, last_session = await remove_session("online_users", sid)
+    if last_session:
+        # Only announce the change, clients keep their own copy of the online list
+        await sio.emit('user_offline', {'username': username})
 
 @sio.event
 async def user_connected(sid, data):
-    username = data.get('username')
-    
-    # Check if the user already exists in the online_users set
-    for user, session_id in online_users:
-        if user == username:
-            # Disconnect the old session
-            await sio.disconnect(session_id)
-            online_users.remove((user, session_id))
-            break
+    username = await session_user(sid)
+    data = data if isinstance(data, dict) else {}
+
+    # Subscribe this socket to the user's chats before anything is sent to it
+    chat_ids = await join_user_rooms(sid, username)
     
     # find online status of user
     user_online = await find_user_online_status(username)
     if(user_online == True):
-        # Add the new session for the user
-        online_users.add((username, sid))
-        online_user_list = [item[0] for item in online_users]
-        #print(f'Online user list {online_user_list} when connection of {username[0]}')
-        await sio.emit('user_online', {'username': username,'online_users':online_user_list})
+        # Add the new session for the user, a user can be connected from several sockets
+        if await add_session("online_users", username, sid):
+            await sio.emit('user_online', {'username': username})
+
+    # Acknowledge with the first page of online users, further pages come from /online_users,
+    # and the messages missed since the seqs in data["resume"]
+    return {"online_users": online_users.snapshot(0, ONLINE_USERS_PAGE_SIZE), "total": online_users.count(),
+            "replay": await replay_for(chat_ids, data.get('resume'))}
+
+# Secondary sockets of a user (for example the chat detail view) only need the rooms, not presence
+@sio.event
+async def join_rooms(sid, data):
+    username = await session_user(sid)
+    data = data if isinstance(data, dict) else {}
+    chat_ids = await join_user_rooms(sid, username)
+    return {"replay": await replay_for(chat_ids, data.get('resume'))}
         
 @sio.event
 async def read_message(sid, data):
-    chatid = data.get('chatid')
-    try:
-        await chat_collection.update_one({"_id":chatid},{"$set": {"unreadMessageCounter": 0}})
-    except:
-        print("Unread message counter update failed")
-    
+    chatid = data.get('chatid') if isinstance(data, dict) else None
+    reader = await session_user(sid)
+    # Only chats the socket joined, which are the reader's own
+    if not chatid or chat_room(chatid) not in sio.rooms(sid):
+        return
+    # Read up to data['seq'], the newest message the client shows; messages after it stay unread
+    seq = data.get('seq')
+    if not isinstance(seq, int) or isinstance(seq, bool):
+        # Older clients send no seq: everything stored so far
+        chat = await chat_collection.find_one({"_id": chatid}, {"last_seq": 1})
+        seq = (chat or {}).get("last_seq", 0)
+    # Written with the other reads of the interval, as a watermark that only grows
+    read_receipts.submit(chatid, reader, seq)
+
+# A client confirms the messages it received, data["acks"] maps chat ids to the highest seq
+@sio.event
+async def ack_messages(sid, data):
+    user = await session_user(sid)
+    acks = data.get('acks') if isinstance(data, dict) else None
+    if not isinstance(acks, dict):
+        return
+    rooms = sio.rooms(sid)
+    for chat_id, seq in acks.items():
+        # Only chats the socket joined, which are the user's own
+        if isinstance(seq, int) and chat_room(chat_id) in rooms:
+            delivery_acks.submit(chat_id, user, seq)
+
 
 @sio.event
 async def message(sid, data):
-    print(data)
-    # Get the current UTC time, set microseconds to 0, and format as ISO
-    current_utc_time = datetime.utcnow().replace(microsecond=0)
-    # Convert to ISO 8601 format with 'Z' (for UTC)
-    iso_utc_time = current_utc_time.isoformat() + 'Z'
+    # The sender is the authenticated user, whatever the client put in data['sender']
+    sender = await session_user(sid)
+    # Every message costs a write and a fan-out, a user gets MESSAGE_RATE of them across all sockets
+    retry_after = message_limiter.retry_after(sender)
+    if retry_after:
+        return {"status": "rate_limited", "retry_after": round(retry_after, 3)}
 
     chat_id = data['chat_id']
-    chat_receipients = data['chatparticipants']
-    #print(chat_participants)
-    chat_receipients.remove(data['sender'])
-    #print(receiver)
-    message_data = {
-        'content': data['content'],
-        'sender': data['sender'],
-        'receiver': chat_receipients,
-        'time': iso_utc_time  # Convert to ISO string
+    # Only into chats the socket joined, which are the sender's own
+    if chat_room(chat_id) not in sio.rooms(sid):
+        return {"status": "error", "detail": "Chat not found"}
+    # Next position in the chat, clients use it to spot and fetch what they missed
+    seq = await sequences.next(chat_id)
+    if seq is None:
+        return {"status": "error", "detail": "Chat not found"}
+    # Receivers are the stored participants, whatever the client put in data['chatparticipants']
+    chat_receipients = [participant for participant in sequences.participants(chat_id) if participant != sender]
+    # Timestamped now in UTC; its ISO form doubles as the history cursor
+    chat_message = ChatMessage.create(chat_id, sender, chat_receipients, data['content'], seq)
+
+    # Queue the message for a batched write, it is fanned out without waiting for the database.
+    # Nothing awaits between taking the seq and queueing, so messages are stored and logged in seq order.
+    persisted = message_pipeline.submit(chat_id, chat_message)
+    replay_log.append(chat_message)
+
+    # Emit the message only to the sockets of the chat participants
+    await sio.emit("new_message", chat_message.to_payload(), room=chat_room(chat_id))
+    socket_fanout.observe(local_room_size(chat_room(chat_id)))
+    log_message("message", chat_id=chat_id, sender=chat_message.sender,
+                receivers=len(chat_receipients), length=len(chat_message.content))
+
+    # Acknowledge to the sender, after the write when durability is "persist"
+    if MESSAGE_DURABILITY == "persist":
+        try:
+            await persisted
+        except Exception:
+            return {"status": "error", "time": chat_message.time_text, "seq": seq}
+    return {"status": "ok", "time": chat_message.time_text, "seq": seq}
+
+# Write one batch of ChatMessages of a chat, called by the message pipeline
+async def persist_messages(chat_id, messages):
+    # Every receiver has the messages of the batch sent to it unread, until its read watermark passes their seqs
+    unread_by_receiver = {}
+    for message in messages:
+        for receiver in message.receiver:
+            unread_by_receiver.setdefault(receiver, []).append(message.seq)
+
+    # Metadata changes in one atomic update, no read of the chat is needed
+    last_updated = datetime.utcnow()
+    preview = messages[-1].content[:50]  # Save the first 50 characters as preview
+    update_data = {
+        "$set": {
+            "last_updated": last_updated,
+            "last_updated_by": messages[-1].sender,
+            "latestMessage": preview,
+        },
     }
-    #print(message_data)
-    update_query = {"_id": chat_id}
-    # Find the current chat document to check the last_updated_by field
-    chat = await chat_collection.find_one(update_query)
-
-    if chat:
-        # Determine how to update the unreadMessageCounter
-        if chat['last_updated_by'] == data['sender']:
-            # If the sender is the same as last_updated_by, increment the unreadMessageCounter by 1
-            unread_message_update = {"$inc": {"unreadMessageCounter": 1}}
-        else:
-            # If the sender is different, reset the unreadMessageCounter to 1
-            unread_message_update = {"$set": {"unreadMessageCounter": 1}}
-
-        # Combine the other updates with the unreadMessageCounter logic
-        update_data = {
-            "$set": {
-                "last_updated": datetime.utcnow(),
-                "last_updated_by": data['sender'],
-                "latestMessage": data['content'][:50],  # Save the first 50 characters as preview
-            },
-            "$push": {
-                "messages": message_data  # Add the new message to the messages array
-            }
-        }
-
-        # Perform the update to the MongoDB document, including unreadMessageCounter changes
-        await chat_collection.update_one(
-            update_query,
-            {**update_data, **unread_message_update}  # Merge the two update operations
-        )
 
-    message_data['chat_id'] = chat_id
+    result = await chat_collection.update_one({"_id": chat_id}, update_data)
+    if result.matched_count == 0:
+        # Unknown chat, nothing to store
+        return
+
+    # Store the messages in the bucketed message collection with a single bulk push,
+    # the chat's in-memory tail (if it has one) gets them once they are stored
+    with tail_cache.storing(chat_id, messages):
+        await append_messages(chat_id, [message.to_document() for message in messages])
+    stats_service.messages_added(len(messages))
+    # Highest stored seq, raised once the messages are in their bucket; read_message falls back to it
+    await chat_collection.update_one({"_id": chat_id}, {"$max": {"last_seq": max(message.seq for message in messages)}})
 
-    # Emit the message to all connected clients without using rooms
-    await sio.emit("new_message", message_data)
+    # Make them searchable, a failure here must not fail the stored batch
+    try:
+        await search_index.add(chat_id, messages)
+    except Exception as e:
+        print(f"Indexing {len(messages)} messages of chat {chat_id} failed: {e}")
+
+    # Move the chat to the top of its participants' inboxes, `python inbox.py --rebuild` repairs a failure
+    try:
+        await record_inbox_messages(chat_id, last_updated, messages[-1].sender, preview, unread_by_receiver)
+    except Exception as e:
+        print(f"Updating the inboxes of chat {chat_id} failed: {e}")
+
+message_pipeline = MessagePipeline(persist_messages)
+
+# Raise the read watermarks collected by read_message, in the chat and in the readers' inbox rows.
+# $max commutes with the unread seqs persist_messages pushes, whichever of the two is written first
+async def store_read_receipts(reads_by_chat):
+    await asyncio.gather(*[
+        chat_collection.update_one({"_id": chat_id}, {"$max": {f"readSeq.{unread_key(reader)}": seq for reader, seq in reads.items()}})
+        for chat_id, reads in reads_by_chat.items()
+    ], mark_inbox_read(reads_by_chat))
+
+read_receipts = ReadReceiptBatcher(store_read_receipts)
+
+# Store the highest seq each user acknowledged and tell the chat, senders show their messages as delivered
+async def store_delivery_acks(acks_by_chat):
+    await asyncio.gather(*[
+        chat_collection.update_one({"_id": chat_id}, {"$max": {f"deliveredSeq.{unread_key(user)}": seq for user, seq in acks.items()}})
+        for chat_id, acks in acks_by_chat.items()
+    ])
+    for chat_id, acks in acks_by_chat.items():
+        await sio.emit("messages_delivered", {"chat_id": chat_id, "delivered": acks}, room=chat_room(chat_id))
+
+delivery_acks = DeliveryAckBatcher(store_delivery_acks)
 
 app.mount("/socket.io/", socketio.ASGIApp(sio))
 
@@ -172,7 +436,7 @@ async def register_user(user: User):
     if existing_user:
         raise HTTPException(status_code=400, detail="Username already registered")
     
-    hashed_password = hash_password(user.password)    
+    hashed_password = await hash_password_async(user.password)    
     
     user_data = {
         "email": user.email,
@@ -186,7 +450,14 @@ async def register_user(user: User):
         "creation_date": datetime.utcnow()
     }
     
-    result = await user_collection.insert_one(user_data)
+    try:
+        result = await user_collection.insert_one(user_data)
+    except DuplicateKeyError:
+        # Registered by a concurrent request since the check above, the unique username index refuses the second
+        raise HTTPException(status_code=400, detail="Username already registered")
+    stats_service.user_added()
+    invalidate_credentials(user.username)
+    store_profile(user_data)
     
     return {
         "user_id": str(result.inserted_id),
@@ -206,7 +477,7 @@ async def login_user(username: str, password: str):
             detail="Invalid username or password",
         )
 
-    if not verify_password(password, user['password']):
+    if not await verify_password_async(password, user['password']):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid username or password",
@@ -214,6 +485,10 @@ async def login_user(username: str, password: str):
 
     return {"message": "User logged successfully",
              "status": "success",
+             # Send the token as "Authorization: Bearer <token>" to skip password checks on later requests
+             "access_token": create_access_token(username),
+             "token_type": "bearer",
+             "expires_in": ACCESS_TOKEN_EXPIRE_MINUTES * 60,
                "user": 
                {"name": username,
                  "avatarUrl": user['avatarUrl'],
@@ -227,20 +502,70 @@ async def server_status(credentials: HTTPBasicCredentials = Depends(security)):
     # Validate the credentials
     verify_credentials(credentials)
     
-    # If the credentials are valid, return the server status
-    db_server_status = await client.admin.command("serverStatus")
-    connections = db_server_status['connections']
-    user_count = await user_collection.count_documents({})
-    user_online_count = len(online_user_list)
-    
+    # Answered from memory: maintained counters and a cached MongoDB serverStatus
+    db_status, db_status_age = stats_service.db_status()
+    counts = stats_service.counts()
+
     data_response = {
-        "user_count": user_count,
-        "user_online_count": user_online_count,
-        "db_connections": connections
+        "user_count": counts["users"],
+        "user_online_count": online_users.count(),
+        "db_connections": db_status["connections"] if db_status else None,
+        "db_status_age_seconds": db_status_age,
+        "counts": counts,
+        "sockets": len(sio.eio.sockets),
+        "password_hashing": password_hasher.stats(),
+        "message_pipeline": message_pipeline.stats(),
+        "user_cache": profile_cache.stats(),
+        "credential_cache": credential_cache.stats(),
+        "tail_cache": tail_cache.stats(),
+        "read_receipts": read_receipts.stats(),
+        "delivery_acks": delivery_acks.stats(),
+        "replay": replay_stats(),
+        "rate_limits": {
+            "socket_event": sio.event_limiter.stats(),
+            "message": message_limiter.stats(),
+            "rest": rest_limiter.stats(),
+        },
+        "outbound": sio.backpressure_stats(),
+        "compaction": compaction.stats()
     }
     
     return data_response
 
+# Readiness probe: 503 until startup finished, while draining, or when the database does not answer
+@app.get("/ready")
+async def ready():
+    if lifecycle["state"] != "ready":
+        return FastJSONResponse({"status": lifecycle["state"]}, status_code=503)
+    try:
+        await asyncio.wait_for(mongo.ping(), READY_PING_TIMEOUT)
+    except Exception as e:
+        return FastJSONResponse({"status": "database unavailable", "detail": str(e)}, status_code=503)
+    return {"status": "ready", "startup_seconds": lifecycle["startup_seconds"]}
+
+# Take this worker out of rotation before stopping it, for example from a preStop hook
+@app.post("/drain")
+async def drain_worker(credentials: HTTPBasicCredentials = Depends(security)):
+    verify_credentials(credentials)
+    await drain()
+    return {"status": lifecycle["state"], "sockets": len(sio.eio.sockets)}
+
+# Prometheus scrape endpoint
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    if not METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Metrics are disabled")
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+# Paged snapshot of online users, live changes arrive as user_online/user_offline events
+@app.get("/online_users")
+async def get_online_users(
+    skip: int = Query(0, ge=0),
+    limit: int = Query(ONLINE_USERS_PAGE_SIZE, ge=1, le=1000),
+    username: str = Depends(rate_limited_user)
+):
+    return {"online_users": online_users.snapshot(skip, limit), "total": online_users.count()}
+
 @app.delete("/drop_collections")
 async def drop_collections(credentials: HTTPBasicCredentials = Depends(security)):
     # Verify Basic Auth credentials
@@ -251,8 +576,21 @@ async def drop_collections(credentials: HTTPBasicCredentials = Depends(security)
         
         # Drop chat collection
         chat_result = await chat_collection.drop()
-
-        return {"message": "Users and chat collections dropped successfully"}
+        forget_user()
+        await client_manager.share_invalidation("users")
+
+        # Drop message collection
+        message_result = await message_collection.drop()
+        await inbox_collection.drop()
+        await message_archive_collection.drop()
+        await ensure_indexes()
+        await search_index.clear()
+        tail_cache.clear()
+        sequences.clear()
+        replay_log.clear()
+        stats_service.reset()
+
+        return {"message": "Users, chat and message collections dropped successfully"}
 
     except PyMongoError as e:
         # Handle any pymongo specific errors
@@ -263,7 +601,7 @@ async def drop_collections(credentials: HTTPBasicCredentials = Depends(security)
         raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {str(e)}")
 
 @app.put("/users/{user_id}", response_model=dict)
-async def update_user(user_id: str, user_data: UserUpdateModel, username: str = Depends(authenticate_user)):
+async def update_user(user_id: str, user_data: UserUpdateModel, username: str = Depends(rate_limited_user)):
     print(user_data)
 
     # Update the user document with the new data
@@ -275,10 +613,14 @@ async def update_user(user_id: str, user_data: UserUpdateModel, username: str =
     if update_result.modified_count == 0:
         raise HTTPException(status_code=400, detail="Failed to update user")
 
+    # Cached credentials and profile must not outlive a change to the user record, on any worker
+    forget_user(user_id)
+    await client_manager.share_invalidation("users", user_id)
+
     return {"message": "User updated successfully"}
 
 @app.get("/users/{user_id}")
-async def get_user(user_id: str, username: str = Depends(authenticate_user)):
+async def get_user(user_id: str, username: str = Depends(rate_limited_user)):
     try:
         # Find user by user_id
         user = await find_user_by_username(user_id)
@@ -291,28 +633,18 @@ async def get_user(user_id: str, username: str = Depends(authenticate_user)):
         # Catch any unexpected exceptions and return a 500 Internal Server Error
         raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
 
-# Create a new chat
+# Create a new chat, or return the existing chat of the same participants
 @app.post("/chats/", response_model=dict, summary="Create a new chat")
-async def create_chat(chat: ChatCreate, username: str = Depends(authenticate_user)):
-    unique_chat_paticipants_list = list(set(chat.participants))
-    #print(unique_chat_paticipants_list)
+async def create_chat(chat: ChatCreate, username: str = Depends(rate_limited_user)):
+    # Sorted, so the same participants always give the same chat id and name
+    unique_chat_paticipants_list = sorted(set(chat.participants))
     chat_id = str('_'.join(unique_chat_paticipants_list))
-    
-    # Check if the chat with the same participants already exists
-    query = {
-        "participants": {
-        "$all": unique_chat_paticipants_list,         # Ensure all participants are in the array
-        "$size": len(unique_chat_paticipants_list)  # Ensure the length of the array matches the number of participants
-    }
-    }
-    existing_chat = await chat_collection.find_one(query)
-    if existing_chat:
-        raise HTTPException(status_code=400, detail=f"Chat {existing_chat['name']} with the same participants already exists.")
+    chat_key = participant_key(unique_chat_paticipants_list)
 
-    # Check if all participants exist in the user_collection
+    # Check if all participants exist in the user_collection, one $in query for the uncached ones
+    known_users = await get_profiles(unique_chat_paticipants_list, ("username",))
     for participant in unique_chat_paticipants_list:
-        user = await user_collection.find_one({"username": participant})
-        if not user:
+        if participant not in known_users:
             raise HTTPException(status_code=404, detail=f"User '{participant}' does not exist.")
 
     chat_name = str(' & '.join(unique_chat_paticipants_list))
@@ -323,116 +655,211 @@ async def create_chat(chat: ChatCreate, username: str = Depends(authenticate_use
         "name": chat_name,
         "image": chat_image, 
         "participants": unique_chat_paticipants_list,
+        "participant_key": chat_key,
         "created_at": datetime.utcnow(),
         "created_by": username, # Add the created_by field
         "last_updated":datetime.utcnow(),
         "last_updated_by": username,
         "latestMessage":None,
-        "unreadMessageCounter":0
+        "readSeq": {},  # Highest seq each participant read
+        "last_seq": 0  # Highest seq stored
     }
     
-    new_chat = await chat_collection.insert_one(chat_data)
+    # The unique participant_key index lets concurrent creates of the same chat insert it only once
+    try:
+        await chat_collection.insert_one(chat_data)
+    except DuplicateKeyError:
+        existing_chat = await chat_collection.find_one({"participant_key": chat_key})
+        if existing_chat is None:
+            raise HTTPException(status_code=409, detail=f"Chat id {chat_id} is used by another chat.")
+        return {"chat_id": existing_chat["_id"], "name": existing_chat["name"], "participants": existing_chat["participants"],
+                "image": existing_chat["image"], "created": False}
+    stats_service.chat_added()
+    await add_inbox_rows(chat_data)
+
+    # Subscribe the participants' connected sockets to the new chat room
+    for participant in unique_chat_paticipants_list:
+        for sid in socket_users.get_sids(participant):
+            await sio.enter_room(sid, chat_room(chat_id))
     
     if(len(unique_chat_paticipants_list)>1):
-        # Extract the receiver's username
-        receiver = [user for user in unique_chat_paticipants_list if user != username][0]
-
-        # Emit the new chat event to the receiver
+        # Emit the new chat event to the receivers' rooms only
+        receiver_rooms = [user_room(user) for user in unique_chat_paticipants_list if user != username]
         await sio.emit('new_chat', {
-            "chat_id": str(new_chat.inserted_id),
+            "chat_id": chat_id,
             "name": chat_name,
             "image": chat_image, 
             "participants": unique_chat_paticipants_list
-        })  # Emit the event only to the receiver
+        }, room=receiver_rooms)
     
-    return {"chat_id": str(new_chat.inserted_id),"name":chat_name,"participants":unique_chat_paticipants_list,"image": chat_image}
+    return {"chat_id": chat_id,"name":chat_name,"participants":unique_chat_paticipants_list,"image": chat_image,"created": True}
 
-# Fetch messages for a specific chat room (endpoint example)
+# Fetch messages for a specific chat room, newest page first, using opaque cursors
 @app.get("/chats/{chat_id}/messages")
-async def get_chat_messages(chat_id: str, skip: int = 0, limit: int = 100, username: str = Depends(authenticate_user)):
-    chat = await chat_collection.find_one({"_id": chat_id})
+async def get_chat_messages(
+    chat_id: str,
+    before: Optional[str] = Query(None),  # Return messages older than this cursor (or message time)
+    after: Optional[str] = Query(None),  # Return messages newer than this cursor (or message time)
+    limit: int = Query(100, ge=1, le=500),
+    username: str = Depends(rate_limited_user)
+):
+    try:
+        before_key = decode_message_cursor(before, "before") if before else None
+        after_key = decode_message_cursor(after, "after") if after else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor, expected a next_before/next_after value or an ISO 8601 message time")
+
+    # Recent pages of active chats come from memory, a cached chat is known to exist
+    page = tail_cache.cached_page(chat_id, limit, before=before_key, after=after_key)
+    if page is None:
+        chat = await chat_collection.find_one({"_id": chat_id}, {"_id": 1})
+        if not chat:
+            raise HTTPException(status_code=404, detail="Chat not found")
+        page = await tail_cache.load_page(chat_id, limit, before=before_key, after=after_key)
+    return {
+        "messages": [message for _, message in page],
+        # Pass next_before to load older history and next_after to poll for newer messages
+        "next_before": encode_message_cursor(page[0][0]) if page else before,
+        "next_after": encode_message_cursor(page[-1][0]) if page else after
+    }
+
+# Full-text search in the messages of one chat, best matches first
+@app.get("/chats/{chat_id}/search")
+async def search_chat_messages(
+    chat_id: str,
+    q: str = Query(..., min_length=1),
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0, le=SEARCH_MAX_OFFSET),
+    username: str = Depends(rate_limited_user)
+):
+    chat = await chat_collection.find_one({"_id": chat_id, "participants": username}, {"_id": 1})
     if not chat:
         raise HTTPException(status_code=404, detail="Chat not found")
 
-    messages = chat.get("messages", [])[skip:skip + limit]
-    return {"messages": messages}
+    results, next_offset = await search_index.search(q, [chat_id], limit, offset)
+    return {"results": results, "next_offset": next_offset}
+
+# Full-text search across all chats of the caller
+@app.get("/search")
+async def search_messages(
+    q: str = Query(..., min_length=1),
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0, le=SEARCH_MAX_OFFSET),
+    username: str = Depends(rate_limited_user)
+):
+    chat_ids = [chat["_id"] async for chat in chat_collection.find({"participants": username}, {"_id": 1})]
+    results, next_offset = await search_index.search(q, chat_ids, limit, offset)
+    return {"results": results, "next_offset": next_offset}
 
 @app.get("/export-chat/{chat_id}")
-async def export_chat(chat_id: str,username: str = Depends(authenticate_user)):
-    try:
-        # Fetch the chat messages for the given chat_id
-        chat = await chat_collection.find_one({"_id": chat_id})
+async def export_chat(
+    chat_id: str,
+    format: str = Query("txt"),  # txt, ndjson or csv
+    compress: bool = Query(False),  # gzip the export
+    username: str = Depends(rate_limited_user)
+):
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported export format, use one of {', '.join(EXPORT_FORMATS)}")
 
-        if not chat:
-            raise HTTPException(status_code=404, detail="Chat not found")
+    # Make sure the chat exists for the given chat_id
+    chat = await chat_collection.find_one({"_id": chat_id}, {"_id": 1})
+    if not chat:
+        raise HTTPException(status_code=404, detail="Chat not found")
+
+    # Messages are streamed from a cursor as they are encoded, nothing is buffered up front
+    media_type = "application/gzip" if compress else EXPORT_FORMATS[format][0]
+    response = StreamingResponse(export_chunks(chat_id, format, compress), media_type=media_type)
+    response.headers["Content-Disposition"] = f"attachment; filename={export_filename(chat_id, format, compress)}"
+    return response
+    
+# Retention policy of one chat, applied by the compaction job
+@app.put("/chats/{chat_id}/retention", summary="Set the retention policy of a chat")
+async def set_chat_retention(chat_id: str, policy: RetentionPolicy, credentials: HTTPBasicCredentials = Depends(security)):
+    verify_credentials(credentials)
+    retention = policy.dict()
+    result = await chat_collection.update_one({"_id": chat_id}, {"$set": {"retention": retention}})
+    if result.matched_count == 0:
+        raise HTTPException(status_code=404, detail="Chat not found")
+    return {"chat_id": chat_id, "retention": retention}
 
-        chat_txt = StringIO()
+# Bulk export of many chats as a background job (admin only)
+@app.post("/export-jobs", summary="Start a bulk chat export")
+async def create_export_job(job: ExportJobCreate, credentials: HTTPBasicCredentials = Depends(security)):
+    admin = verify_credentials(credentials)
+    if job.format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported export format, use one of {', '.join(EXPORT_FORMATS)}")
 
-        # Check if there are any messages
-        if "messages" not in chat or len(chat["messages"]) == 0:
-            # No messages found, write the default content
-            chat_txt.write("No messages found\n")
-        else:
-            # Assuming `messages` is a list of dictionaries with 'sender', 'time', and 'content'
-            for message in chat["messages"]:
-                sender = message["sender"]
-                try:
-                    time = parser.isoparse(message["time"])  # Handle ISO 8601 timestamps
-                except ValueError:
-                    time = None  # Handle invalid time format
+    created = await export_jobs.submit(admin, username=job.username, since=job.since, until=job.until, export_format=job.format)
+    return {"job_id": created["_id"], "status": created["status"]}
 
-                content = message["content"]
-                if time:
-                    chat_txt.write(format_message(sender, time, content) + "\n")
-                else:
-                    chat_txt.write(f"{sender} (Unknown time): {content}\n")
+@app.get("/export-jobs/{job_id}", summary="Status of a bulk chat export")
+async def get_export_job(job_id: str, credentials: HTTPBasicCredentials = Depends(security)):
+    verify_credentials(credentials)
+    job = await export_jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Export job not found")
 
-        chat_txt.seek(0)  # Move to the start of the file
+    return {
+        "job_id": job["_id"],
+        "status": job["status"],
+        "params": job["params"],
+        "total_chats": job.get("total_chats"),
+        "exported_chats": job.get("exported_chats", 0),
+        "archive_size": job.get("archive_size"),
+        "error": job.get("error"),
+        "created_at": job["created_at"],
+        "updated_at": job["updated_at"]
+    }
 
-        # Create a streaming response with the file
-        response = StreamingResponse(chat_txt, media_type="text/plain")
-        response.headers["Content-Disposition"] = f"attachment; filename=chat_{chat_id}.txt"
+@app.get("/export-jobs/{job_id}/download", summary="Download a finished bulk chat export")
+async def download_export_job(job_id: str, credentials: HTTPBasicCredentials = Depends(security)):
+    verify_credentials(credentials)
+    job = await export_jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Export job not found")
+    if job["status"] != "completed":
+        raise HTTPException(status_code=409, detail=f"Export job is {job['status']}")
 
-        return response
+    return FileResponse(export_jobs.archive_path(job_id), media_type="application/x-tar", filename=f"export_{job_id}.tar")
 
-    except Exception as e:
-        # Handle any unexpected errors and return an empty file with "No messages found"
-        chat_txt = StringIO()
-        chat_txt.write("No messages found\n")
-        chat_txt.seek(0)
-
-        response = StreamingResponse(chat_txt, media_type="text/plain")
-        response.headers["Content-Disposition"] = f"attachment; filename=chat_{chat_id}.txt"
-        return response
-    
-@app.get("/chats", summary="Fetch chats for a user with pagination")
+@app.get("/chats", summary="Fetch chats for a user with cursor pagination")
 async def get_user_chats(
     user_id: str,
-    skip: Optional[int] = Query(0, ge=0),  # Default to 0, must be >= 0
+    cursor: Optional[str] = Query(None),  # next_cursor of the previous page
+    updated_since: Optional[datetime] = Query(None),  # Only chats updated at or after this time
     limit: Optional[int] = Query(100, ge=1, le=100),  # Default to 100, must be between 1 and 100
     sort_field: Optional[str] = Query("last_updated"),  # Default sort field
     sort_order: Optional[str] = Query("desc"),  # Default sort order
-    username: str = Depends(authenticate_user)
+    username: str = Depends(rate_limited_user)
 ):
+    # Only indexed fields, anything else would sort the user's chats in memory
+    if sort_field not in SORTABLE_CHAT_FIELDS:
+        raise HTTPException(status_code=400, detail=f"sort_field must be one of: {', '.join(SORTABLE_CHAT_FIELDS)}")
+
     # Determine the sorting order
     order = ASCENDING if sort_order.lower() == "asc" else DESCENDING
 
-    # Query to find documents where the username is in the participants array
-    query = {
-        "participants": {
-            "$in": [username]  # Use the $in operator to check if the username exists in the participants array
-        }
-    }
-    excludcols = {"messages": 0}
+    if updated_since is not None:
+        # Delta mode: the chats changed since the last poll, new messages or reads, oldest change first
+        sort_field, order = "changed_at", ASCENDING
+        # Stored times are naive UTC, a time with an offset is converted rather than cut off
+        updated_since = naive_utc(updated_since)
+
+    after = decode_chat_cursor(cursor, sort_field, order) if cursor else None
+
+    # One range read of the user's inbox rows, which carry the user's own unread counter;
+    # one extra chat tells whether there is a next page
+    chats = await get_inbox_page(username, sort_field, order, limit + 1, updated_since, after)
+
+    next_cursor = None
+    if len(chats) > limit:
+        chats = chats[:limit]
+        next_cursor = encode_chat_cursor(sort_field, order, chats[-1])
 
-    # Fetch chats with sorting
-    chats = await chat_collection.find(query, excludcols)\
-        .sort(sort_field, order)\
-        .skip(skip)\
-        .limit(limit)\
-        .to_list(length=limit)
+    # Warm the profile cache for the participants the client is about to show
+    await find_users_by_usernames([participant for chat in chats for participant in chat.get("participants", [])])
 
-    return chats
+    return {"chats": chats, "next_cursor": next_cursor}
 
 # Entry point for running the server
 if __name__ == "__main__":
@@ -1,5 +1,5 @@
 from fastapi import HTTPException, Depends, status
-from fastapi.security import HTTPBasic, HTTPBasicCredentials
+from fastapi.security import HTTPBasic, HTTPBasicCredentials, HTTPBearer, HTTPAuthorizationCredentials
 from passlib.context import CryptContext
 from jose import JWTError, jwt
 from datetime import datetime, timedelta
@@ -8,17 +8,41 @@ import os
 from db import user_collection,ADMIN_PASS,ADMIN_USER,ADMIN_EMAIL,ADMIN_GENDER,ADMIN_TIMEZONE
 from bson.objectid import ObjectId
 from dotenv import load_dotenv
-import bcrypt
+from cache import TTLCache
+from user_cache import get_profile, get_profiles
+from hashing import password_hasher, hash_password, verify_password, HashingBusyError
+from rate_limit import rest_limiter, retry_after_header
+import hashlib
+import hmac
 
 security = HTTPBasic()
 
+# Endpoints accept either a bearer token from /login or Basic credentials
+bearer_scheme = HTTPBearer(auto_error=False)
+basic_scheme = HTTPBasic(auto_error=False)
+
 load_dotenv()
 
-SECRET_KEY = "your-secret-key"
+# Signs the access tokens and keys the credential cache, there is no default: see check_secret_key
+SECRET_KEY = os.getenv("SECRET_KEY")
+# Placeholders that were defaults or examples, anyone could sign tokens with them
+PLACEHOLDER_SECRET_KEYS = {"your-secret-key", "change-me"}
 ALGORITHM = "HS256"
-ACCESS_TOKEN_EXPIRE_MINUTES = 30
+ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "30"))
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+# Basic credentials that already passed bcrypt, username -> password digest
+credential_cache = TTLCache(
+    maxsize=int(os.getenv("AUTH_CACHE_SIZE", "10000")),
+    ttl=int(os.getenv("AUTH_CACHE_TTL", "300"))
+)
+
+def check_secret_key():
+    # Called first on startup, the app refuses to run with a key anyone could know
+    if not SECRET_KEY or SECRET_KEY in PLACEHOLDER_SECRET_KEYS:
+        raise RuntimeError("SECRET_KEY is not set or is a placeholder, set it to a long random value "
+                           "(for example the output of: python -c \"import secrets; print(secrets.token_urlsafe(48))\")")
+
 # User Model
 class User(BaseModel):
     email: str
@@ -45,7 +69,7 @@ async def create_admin_user():
     
     if not user:
         # Hash the admin password
-        hashed_password = hash_password(ADMIN_PASS)
+        hashed_password = await hash_password_async(ADMIN_PASS)
         
         # Create user data
         user_data = {
@@ -69,15 +93,48 @@ async def create_admin_user():
 def get_password_hash(password):
     return pwd_context.hash(password)
 
-def hash_password(password: str) -> str:
-    # Generate a salt and hash the password
-    salt = bcrypt.gensalt()
-    hashed = bcrypt.hashpw(password.encode('utf-8'), salt)
-    return hashed.decode('utf-8')
+# bcrypt takes 100ms+ of CPU, run it on the hashing pool so the event loop keeps serving sockets
+def _hashing_busy(error: HashingBusyError):
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Too many password checks in progress, please retry later",
+        headers={"Retry-After": str(error.retry_after)},
+    )
+
+async def hash_password_async(password: str) -> str:
+    try:
+        return await password_hasher.hash(password)
+    except HashingBusyError as e:
+        raise _hashing_busy(e)
+
+async def verify_password_async(password: str, hashed_password: str) -> bool:
+    try:
+        return await password_hasher.verify(password, hashed_password)
+    except HashingBusyError as e:
+        raise _hashing_busy(e)
+
+def create_access_token(username: str) -> str:
+    expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    return jwt.encode({"sub": username, "exp": expire}, SECRET_KEY, algorithm=ALGORITHM)
+
+def decode_access_token(token: str):
+    # Returns the username of a valid token, None otherwise
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        return None
+    return payload.get("sub")
+
+def _password_digest(password: str) -> bytes:
+    # Keyed digest, so the cache never holds plain text passwords
+    return hmac.new(SECRET_KEY.encode('utf-8'), password.encode('utf-8'), hashlib.sha256).digest()
 
-def verify_password(password: str, hashed_password: str) -> bool:
-    # Verify a stored password against one provided by user
-    return bcrypt.checkpw(password.encode('utf-8'), hashed_password.encode('utf-8'))
+def invalidate_credentials(username: str = None):
+    # Call whenever a password or user record changes, without a username the whole cache is dropped
+    if username is None:
+        credential_cache.clear()
+    else:
+        credential_cache.pop(username)
 
 async def create_user(user: User):
     existing_user = await user_collection.find_one({"email": user.email})
@@ -99,32 +156,25 @@ async def get_user_by_id(user_id: str):
 
 async def find_users_by_usernames(username_list):
     try:
-        # Query to find users with usernames in the provided list
-        users = list(user_collection.find({"username": {"$in": username_list}}))
-        return users
+        # One $in query for the users that are not cached yet
+        profiles = await get_profiles(username_list)
+        return list(profiles.values())
     except Exception as e:
         print("Error fetching users:", e)
         return []
     
 async def find_user_by_username(username):
     try:
-        # Query to find users with usernames in the provided list
-        query_user={"username": username}
-        includcols={"username":1,"aboutme":1,"avatarUrl":1,"_id":0}
-        users = await user_collection.find_one(query_user,includcols)
-        print(users)
-        return users
+        includcols=("username","aboutme","avatarUrl")
+        return await get_profile(username, includcols)
     except Exception as e:
         print("Error fetching users:", e)
         return {}
     
 async def find_user_online_status(username):
     try:
-        # Query to find users with usernames in the provided list
-        query_user={"username": username}
-        includcols={"online_status":1}
-        users = await user_collection.find_one(query_user,includcols)
-        if(users['online_status'] == 'Online'):
+        user = await get_profile(username, ("online_status",))
+        if(user['online_status'] == 'Online'):
             return True
         else:
             return False
@@ -132,13 +182,68 @@ async def find_user_online_status(username):
         print("Error fetching users:", e)
         return False
 
-async def authenticate_user(credentials: HTTPBasicCredentials = Depends(security)):
-    user = await user_collection.find_one({"username": credentials.username})
-    
-    if user and bcrypt.checkpw(credentials.password.encode('utf-8'), user['password'].encode('utf-8')):
-        return credentials.username
+async def check_password(username: str, password: str) -> bool:
+    # Credentials verified recently skip both the database and bcrypt, raises HashingBusyError when the pool is full
+    digest = _password_digest(password)
+    cached = credential_cache.get(username)
+    if cached and hmac.compare_digest(cached, digest):
+        return True
+
+    user = await user_collection.find_one({"username": username}, {"password": 1})
+    if user and await password_hasher.verify(password, user['password']):
+        credential_cache.set(username, digest)
+        return True
+    return False
+
+async def authenticate_user(
+    token: HTTPAuthorizationCredentials = Depends(bearer_scheme),
+    credentials: HTTPBasicCredentials = Depends(basic_scheme)
+):
+    # Signed tokens are checked without touching the database
+    if token is not None:
+        username = decode_access_token(token.credentials)
+        if username:
+            return username
+
+    elif credentials is not None:
+        try:
+            if await check_password(credentials.username, credentials.password):
+                return credentials.username
+        except HashingBusyError as e:
+            raise _hashing_busy(e)
+
     raise HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Invalid credentials",
         headers={"WWW-Authenticate": "Basic"},
-    )
\ No newline at end of file
+    )
+
+async def authenticate_socket(auth):
+    """Username of a Socket.IO connection, from the ``auth`` payload sent with the connect.
+
+    Takes ``{"token": <access_token>}`` like the bearer header, falling back to
+    ``{"username", "password"}`` so a client whose token expired can reconnect.
+    Returns None when neither is valid, raises HashingBusyError like the REST routes.
+    """
+    if not isinstance(auth, dict):
+        return None
+    token = auth.get("token")
+    if isinstance(token, str):
+        username = decode_access_token(token)
+        if username:
+            return username
+    username, password = auth.get("username"), auth.get("password")
+    if isinstance(username, str) and isinstance(password, str) and await check_password(username, password):
+        return username
+    return None
+
+# authenticate_user for API routes, also holding each user to the REST request rate
+async def rate_limited_user(username: str = Depends(authenticate_user)):
+    retry_after = rest_limiter.retry_after(username)
+    if retry_after:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many requests, please retry later",
+            headers={"Retry-After": retry_after_header(retry_after)},
+        )
+    return username
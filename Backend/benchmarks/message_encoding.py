@@ -0,0 +1,121 @@
+"""Microbenchmark of the per-message work on the hot path, before and after ChatMessage.
+
+    python benchmarks/message_encoding.py --messages 20000
+
+``dict`` is the former path: an ad-hoc dict with an ISO string time, encoded
+with the standard json module, and parsed back with dateutil on export.
+``chat_message`` is the current one: a slotted ChatMessage with a native
+datetime, encoded with fast_json, and formatted on export without parsing.
+
+For each path the JSON result gives the time to build, encode and export one
+message, the memory held per queued message and the bytes allocated while
+encoding one.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+from dateutil import parser as dateutil_parser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fast_json  # noqa: E402
+from export import format_message, parse_time_fast  # noqa: E402
+from models import ChatMessage  # noqa: E402
+
+RECEIVERS = ["bob"]
+CONTENT = "Hey, are we still on for lunch tomorrow?"
+
+
+def build_dict(i):
+    now = datetime.utcnow()
+    return {
+        "content": CONTENT,
+        "sender": "alice",
+        "receiver": RECEIVERS,
+        "time": now.isoformat(timespec="milliseconds") + "Z",
+    }
+
+
+def encode_dict(message):
+    payload = dict(message, chat_id="alice_bob")
+    return json.dumps(payload, separators=(",", ":"))
+
+
+def export_dict(message):
+    return format_message(message["sender"], dateutil_parser.isoparse(message["time"]), message["content"])
+
+
+def build_chat_message(i):
+    return ChatMessage.create("alice_bob", "alice", RECEIVERS, CONTENT)
+
+
+def encode_chat_message(message):
+    return fast_json.dumps(message.to_payload())
+
+
+def export_chat_message(message):
+    document = message.to_document()
+    return format_message(document["sender"], parse_time_fast(document["time"]), document["content"])
+
+
+PATHS = {
+    "dict": (build_dict, encode_dict, export_dict),
+    "chat_message": (build_chat_message, encode_chat_message, export_chat_message),
+}
+
+
+def per_message_us(function, items):
+    started = time.perf_counter()
+    for item in items:
+        function(item)
+    return round((time.perf_counter() - started) / len(items) * 1e6, 3)
+
+
+def measure(build, encode, export, count):
+    indexes = range(count)
+    build_us = per_message_us(build, indexes)
+    messages = [build(i) for i in indexes]
+
+    # Memory held by queued messages: everything allocated while building them and still referenced
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    held = [build(i) for i in indexes]
+    retained = tracemalloc.get_traced_memory()[0] - baseline
+    tracemalloc.stop()
+    del held
+
+    # Bytes allocated at the peak of one encode call, freed again once it returns
+    tracemalloc.start()
+    transient = 0
+    sample = messages[:1000]
+    for message in sample:
+        tracemalloc.reset_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        encode(message)
+        transient += tracemalloc.get_traced_memory()[1] - current
+    tracemalloc.stop()
+
+    return {
+        "build_us": build_us,
+        "encode_us": per_message_us(encode, messages),
+        "export_us": per_message_us(export, messages),
+        "retained_bytes_per_message": round(retained / count, 1),
+        "encode_peak_bytes_per_message": round(transient / len(sample), 1),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=20000)
+    args = parser.parse_args()
+
+    results = {name: measure(*functions, args.messages) for name, functions in PATHS.items()}
+    print(json.dumps({
+        "meta": {"messages": args.messages, "json_encoder": fast_json.JSON_ENCODER},
+        "results": results,
+    }, indent=2))
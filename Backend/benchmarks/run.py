@@ -0,0 +1,622 @@
+"""Load test the chat backend and report the results as JSON.
+
+    python benchmarks/run.py --clients 1000 --out results.json
+
+Starts ``benchmarks/server.py`` in a subprocess (in-memory MongoDB stand-in
+unless ``--mongo`` gives a URI), runs the selected scenarios one after the
+other and prints one JSON document: for each scenario the number of
+operations, errors, throughput, p50/p90/p99/max latency and the resident memory
+of the server afterwards. ``meta`` records the commit and settings, so two
+result files can be compared directly.
+
+Server settings are passed with ``--server-env``, for example to compare
+``--server-env MESSAGE_DURABILITY=enqueue`` with the default. ``--workers 2``
+starts two servers behind the loopback Socket.IO broker and spreads the
+clients over them; it needs a real MongoDB, the in-memory one is per process.
+
+Rate limits stay on, except the REST one: every REST scenario sends as one
+or a few users. ``socket_flood`` has one client flood ``message`` events while
+the others keep sending; compare its latencies with ``socket_message``, or
+with a run under ``--server-env RATE_LIMIT_ENABLED=false``.
+
+Thousands of sockets need a matching open file limit (``ulimit -n 65536``).
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+
+import aiohttp
+import socketio
+from jose import jwt
+
+from server import BENCH_PASSWORD, bench_chat, bench_user
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_SECRET_KEY = "benchmark-secret-key"
+BENCH_ADMIN = "benchadmin"
+
+
+def access_token(username):
+    return jwt.encode({"sub": username, "exp": datetime.utcnow() + timedelta(hours=1)}, BENCH_SECRET_KEY, algorithm="HS256")
+
+
+def bearer(username):
+    return {"Authorization": f"Bearer {access_token(username)}"}
+
+
+def socket_auth(username):
+    # Sockets authenticate on connect, the server ignores usernames sent in events
+    return {"token": access_token(username)}
+
+
+def basic(username):
+    credentials = base64.b64encode(f"{username}:{BENCH_PASSWORD}".encode()).decode()
+    return {"Authorization": f"Basic {credentials}"}
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def memory_kb(pid, field):
+    # VmRSS is the current resident size, VmHWM the peak since the process started
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+class Recorder:
+    """Latencies and errors of one scenario."""
+
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self.extra = {}
+        self.started = time.perf_counter()
+        self.finished = None
+
+    def record(self, seconds):
+        self.latencies.append(seconds)
+
+    def stop(self):
+        self.finished = time.perf_counter()
+
+    def summary(self):
+        duration = (self.finished or time.perf_counter()) - self.started
+        latencies = sorted(self.latencies)
+
+        def percentile(fraction):
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(len(latencies) * fraction))] * 1000, 3)
+
+        return dict({
+            "operations": len(latencies),
+            "errors": self.errors,
+            "duration_s": round(duration, 3),
+            "throughput_per_s": round(len(latencies) / duration, 1) if duration else None,
+            "p50_ms": percentile(0.5),
+            "p90_ms": percentile(0.9),
+            "p99_ms": percentile(0.99),
+            "max_ms": round(latencies[-1] * 1000, 3) if latencies else None,
+        }, **self.extra)
+
+
+async def run_concurrently(total, concurrency, operation, recorder):
+    """Call ``operation(i)`` for i in range(total), ``concurrency`` at a time, timing each call."""
+    next_index = 0
+
+    async def worker():
+        nonlocal next_index
+        while next_index < total:
+            index = next_index
+            next_index += 1
+            started = time.perf_counter()
+            try:
+                await operation(index)
+            except Exception:
+                recorder.errors += 1
+            else:
+                recorder.record(time.perf_counter() - started)
+
+    await asyncio.gather(*[worker() for _ in range(min(concurrency, total))])
+    recorder.stop()
+
+
+class Servers:
+    """The backend processes of a run, plus the broker when there are several."""
+
+    def __init__(self, args):
+        self.args = args
+        self.processes = []
+        self.urls = []
+
+    def _spawn(self, command, env):
+        return subprocess.Popen(command, cwd=BACKEND_DIR, env=env,
+                                stdout=subprocess.DEVNULL if not self.args.verbose else None,
+                                stderr=subprocess.DEVNULL if not self.args.verbose else None)
+
+    async def start(self):
+        env = dict(os.environ, SECRET_KEY=BENCH_SECRET_KEY, REST_RATE="1000000", REST_BURST="1000000",
+                   ADMIN_USER=BENCH_ADMIN, ADMIN_PASS=BENCH_PASSWORD)
+        env.update(dict(setting.split("=", 1) for setting in self.args.server_env))
+
+        if self.args.workers > 1:
+            if self.args.mongo == "fake":
+                raise SystemExit("--workers needs --mongo with a MongoDB URI, the in-memory database is per process")
+            broker_port = free_port()
+            self.processes.append(self._spawn([sys.executable, "socket_bus.py", "--port", str(broker_port)], env))
+            env["SOCKETIO_MESSAGE_QUEUE"] = f"tcp://127.0.0.1:{broker_port}"
+
+        for worker in range(self.args.workers):
+            port = free_port()
+            command = [sys.executable, "benchmarks/server.py", "--port", str(port), "--mongo", self.args.mongo,
+                       "--users", str(self.args.clients), "--history", str(self.args.history)]
+            if worker > 0:
+                command.append("--skip-seed")
+            self.processes.append(self._spawn(command, env))
+            self.urls.append(f"http://127.0.0.1:{port}")
+            # Wait for the first worker, it seeds the database the others use; a large --history takes minutes
+            await self._wait_ready(self.urls[-1], timeout=120 + self.args.history // 1000)
+
+    async def _wait_ready(self, url, timeout=120):
+        deadline = time.monotonic() + timeout
+        async with aiohttp.ClientSession() as session:
+            while time.monotonic() < deadline:
+                try:
+                    async with session.get(url + "/ready") as response:
+                        if response.status == 200:
+                            return
+                except aiohttp.ClientError:
+                    pass
+                await asyncio.sleep(0.2)
+        raise RuntimeError(f"Server at {url} did not start within {timeout}s")
+
+    def memory(self):
+        server_pids = [process.pid for process in self.processes[-self.args.workers:]]
+        current = [memory_kb(pid, "VmRSS") for pid in server_pids]
+        peak = [memory_kb(pid, "VmHWM") for pid in server_pids]
+        if None in current:
+            return {}
+        return {"server_rss_mb": round(sum(current) / 1024, 1), "server_peak_rss_mb": round(sum(peak) / 1024, 1)}
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+class Context:
+    def __init__(self, args, servers, session):
+        self.args = args
+        self.servers = servers
+        self.session = session
+        # username -> connected socket.io client
+        self.sockets = {}
+        self.received = {"messages": 0, "bytes": 0}
+
+    def url(self, index=0):
+        return self.servers.urls[index % len(self.servers.urls)]
+
+
+SCENARIOS = {}
+
+
+def scenario(function):
+    SCENARIOS[function.__name__] = function
+    return function
+
+
+async def get_json(context, path, headers, recorder=None):
+    async with context.session.get(context.url() + path, headers=headers) as response:
+        body = await response.read()
+        if response.status != 200:
+            raise RuntimeError(f"GET {path} answered {response.status}")
+        if recorder is not None:
+            recorder.extra["bytes"] = recorder.extra.get("bytes", 0) + len(body)
+        return body
+
+
+@scenario
+async def rest_chats(context, recorder):
+    # First page of a user's chat list
+    async def fetch(index):
+        user = bench_user(index % context.args.clients)
+        await get_json(context, f"/chats?user_id={user}", bearer(user))
+    await run_concurrently(context.args.requests, context.args.concurrency, fetch, recorder)
+
+
+@scenario
+async def rest_create_chat(context, recorder):
+    # The same new group created by its members at once, like a double clicked button;
+    # exactly one request may create it, the others get the existing chat
+    participants = [bench_user(i % context.args.clients) for i in range(3)]
+    created = {True: 0, False: 0}
+
+    async def create(index):
+        user = participants[index % len(participants)]
+        async with context.session.post(context.url(index) + "/chats/", json={"participants": participants},
+                                        headers=bearer(user)) as response:
+            body = await response.json()
+            if response.status != 200:
+                raise RuntimeError(f"POST /chats/ answered {response.status}")
+            created[body["created"]] += 1
+    await run_concurrently(context.args.requests, context.args.concurrency, create, recorder)
+    recorder.extra["created"] = created[True]
+    recorder.extra["existing"] = created[False]
+    # Any chat beyond the first is a duplicate
+    recorder.errors += max(0, created[True] - 1)
+
+
+@scenario
+async def rest_messages(context, recorder):
+    # Newest page of the seeded history
+    headers = bearer(bench_user(0))
+    async def fetch(index):
+        await get_json(context, f"/chats/{bench_chat(0)}/messages?limit=50", headers)
+    await run_concurrently(context.args.requests, context.args.concurrency, fetch, recorder)
+
+
+@scenario
+async def rest_export(context, recorder):
+    # Whole seeded history as text, fewer requests as each one reads everything
+    headers = bearer(bench_user(0))
+    async def fetch(index):
+        await get_json(context, f"/export-chat/{bench_chat(0)}", headers, recorder)
+    await run_concurrently(max(1, context.args.requests // 20), context.args.concurrency, fetch, recorder)
+
+
+@scenario
+async def rest_server_status(context, recorder):
+    # A health checker polling the admin status, its cost should not grow with the user count
+    headers = basic(BENCH_ADMIN)
+    async def fetch(index):
+        await get_json(context, "/server_status", headers)
+    await run_concurrently(context.args.requests, context.args.concurrency, fetch, recorder)
+
+
+@scenario
+async def rest_auth_basic(context, recorder):
+    # Profile reads authenticated with Basic credentials, served by the credential cache
+    users = min(context.args.clients, 50)
+    headers = [basic(bench_user(i)) for i in range(users)]
+    # One bcrypt check per user fills the cache, it is not part of the measurement
+    for i in range(users):
+        await get_json(context, f"/users/{bench_user(i)}", headers[i])
+    recorder.started = time.perf_counter()
+    async def fetch(index):
+        await get_json(context, f"/users/{bench_user(index % users)}", headers[index % users])
+    await run_concurrently(context.args.requests, context.args.concurrency, fetch, recorder)
+
+
+@scenario
+async def rest_auth_bearer(context, recorder):
+    # The same reads with signed tokens
+    users = min(context.args.clients, 50)
+    headers = [bearer(bench_user(i)) for i in range(users)]
+    async def fetch(index):
+        await get_json(context, f"/users/{bench_user(index % users)}", headers[index % users])
+    await run_concurrently(context.args.requests, context.args.concurrency, fetch, recorder)
+
+
+@scenario
+async def socket_connect(context, recorder):
+    # Connect every client and announce it with user_connected, the latency covers both
+    connector = aiohttp.TCPConnector(limit=0)
+    context.socket_session = aiohttp.ClientSession(connector=connector)
+
+    async def on_message(data):
+        context.received["messages"] += 1
+        context.received["bytes"] += len(json.dumps(data))
+
+    async def connect(index):
+        user = bench_user(index)
+        client = socketio.AsyncClient(reconnection=False, http_session=context.socket_session)
+        client.on("new_message", on_message)
+        await client.connect(context.url(index), socketio_path="/socket.io/", transports=["websocket"],
+                             auth=socket_auth(user))
+        context.sockets[user] = client
+        await client.call("user_connected", {}, timeout=60)
+
+    await run_concurrently(context.args.clients, context.args.concurrency, connect, recorder)
+    recorder.extra["connected"] = len(context.sockets)
+
+
+def connected_senders(context):
+    # The first user of every pair, it sends to its partner
+    users = sorted(context.sockets, key=lambda name: int(name[len("bench"):]))
+    return [user for user in users if int(user[len("bench"):]) % 2 == 0]
+
+
+async def send_message(context, sender, index):
+    # Returns the acknowledgement of a message to the sender's chat partner
+    pair = int(sender[len("bench"):]) // 2
+    receiver = bench_user(2 * pair + 1)
+    return await context.sockets[sender].call("message", {
+        "chat_id": bench_chat(pair),
+        "content": f"benchmark message {index}",
+        "sender": sender,
+        "chatparticipants": [sender, receiver],
+    }, timeout=60)
+
+
+@scenario
+async def socket_message(context, recorder):
+    # Every client sends --messages messages to its chat partner, latency is the time to the acknowledgement.
+    # Also reports the bytes sent per message to the chat's room, and what a broadcast to every connected
+    # socket (how messages were fanned out before chat rooms) would have sent for the same messages
+    senders = connected_senders(context)
+    before = dict(context.received)
+
+    async def send(index):
+        ack = await send_message(context, senders[index % len(senders)], index)
+        if not ack or ack.get("status") != "ok":
+            raise RuntimeError(f"message not acknowledged: {ack}")
+
+    await run_concurrently(len(senders) * context.args.messages, context.args.concurrency, send, recorder)
+    # Give the last deliveries a moment to arrive
+    await asyncio.sleep(0.5)
+    delivered = context.received["messages"] - before["messages"]
+    delivered_bytes = context.received["bytes"] - before["bytes"]
+    sent = len(recorder.latencies)
+    recorder.extra["delivered"] = delivered
+    recorder.extra["delivered_bytes"] = delivered_bytes
+    if sent and delivered:
+        payload = delivered_bytes / delivered
+        recorder.extra["bytes_per_message"] = round(delivered_bytes / sent, 1)
+        recorder.extra["receivers_per_message"] = round(delivered / sent, 2)
+        recorder.extra["broadcast_bytes_per_message"] = round(payload * len(context.sockets), 1)
+
+
+@scenario
+async def socket_flood(context, recorder):
+    # One client keeps --flood messages in flight while the others send as in socket_message,
+    # latency is that of the others; the flooder's acknowledgements are counted by status
+    flooder, *senders = connected_senders(context)
+    if not senders:
+        raise SystemExit("socket_flood needs at least 4 clients")
+    flood_acks = {}
+    flooding = True
+
+    async def flood(worker):
+        index = worker
+        while flooding:
+            try:
+                ack = await send_message(context, flooder, index)
+                status = ack.get("status") if ack else "none"
+            except Exception:
+                status = "error"
+            flood_acks[status] = flood_acks.get(status, 0) + 1
+            index += context.args.flood
+
+    async def send(index):
+        ack = await send_message(context, senders[index % len(senders)], index)
+        if not ack or ack.get("status") != "ok":
+            raise RuntimeError(f"message not acknowledged: {ack}")
+
+    flooders = asyncio.gather(*[flood(worker) for worker in range(context.args.flood)])
+    await run_concurrently(len(senders) * context.args.messages, context.args.concurrency, send, recorder)
+    flooding = False
+    await flooders
+    recorder.extra["flood_acks"] = flood_acks
+
+
+@scenario
+async def socket_resume(context, recorder):
+    # Each receiver drops its socket in the middle of a stream of --messages messages and reconnects
+    # with the last seq it saw. Latency is the reconnect plus the catch-up handshake; every message
+    # must then have arrived exactly once, counting the replay
+    senders = [sender for sender in connected_senders(context) if sender != "bench0"][:context.args.concurrency]
+    totals = {"missed": 0, "replayed": 0, "gaps": 0, "replay_duplicates": 0, "live_overlap": 0, "resets": 0}
+    pace = 0.02
+
+    async def connect_receiver(receiver, on_message, resume=None):
+        client = socketio.AsyncClient(reconnection=False, http_session=context.socket_session)
+        client.on("new_message", on_message)
+        await client.connect(context.url(), socketio_path="/socket.io/", transports=["websocket"],
+                             auth=socket_auth(receiver))
+        ack = await client.call("join_rooms", {"resume": resume or {}}, timeout=60)
+        return client, ack
+
+    async def run_pair(sender):
+        pair = int(sender[len("bench"):]) // 2
+        chat_id, receiver = bench_chat(pair), bench_user(2 * pair + 1)
+        live = []
+        sent = []
+
+        async def on_message(data):
+            if data.get("chat_id") == chat_id:
+                live.append(data["seq"])
+
+        async def stream():
+            for index in range(context.args.messages):
+                ack = await send_message(context, sender, index)
+                if not ack or ack.get("status") != "ok":
+                    raise RuntimeError(f"message not acknowledged: {ack}")
+                sent.append(ack["seq"])
+                await asyncio.sleep(pace)
+
+        client, _ = await connect_receiver(receiver, on_message)
+        streaming = asyncio.create_task(stream())
+        await asyncio.sleep(pace * context.args.messages / 3)
+        await client.disconnect()
+        before = list(live)
+        last_seq = max(before, default=0)
+        await asyncio.sleep(pace * context.args.messages / 3)
+
+        started = time.perf_counter()
+        client, ack = await connect_receiver(receiver, on_message, {chat_id: last_seq})
+        recorder.record(time.perf_counter() - started)
+        replay = ack["replay"].get(chat_id, {"messages": [], "reset": False})
+        replayed = [message["seq"] for message in replay["messages"]]
+        await streaming
+        await asyncio.sleep(0.3)
+        await client.disconnect()
+
+        after = live[len(before):]
+        received = set(before) | set(after) | set(replayed)
+        totals["missed"] += len([seq for seq in sent if seq > last_seq and seq not in after])
+        totals["replayed"] += len(replayed)
+        totals["resets"] += int(replay["reset"])
+        totals["gaps"] += len(set(sent) - received)
+        totals["replay_duplicates"] += len(replayed) - len(set(replayed)) + len(set(replayed) & set(before))
+        # Sent live right after the reconnect and also part of the replay, clients drop the repeat by seq
+        totals["live_overlap"] += len(set(replayed) & set(after))
+
+    results = await asyncio.gather(*[run_pair(sender) for sender in senders], return_exceptions=True)
+    recorder.errors += sum(1 for result in results if isinstance(result, Exception))
+    recorder.errors += totals["gaps"] + totals["replay_duplicates"]
+    recorder.extra.update(totals)
+
+
+@scenario
+async def socket_read(context, recorder):
+    # Every client marks its chat as read
+    users = list(context.sockets)
+
+    async def read(index):
+        user = users[index % len(users)]
+        pair = int(user[len("bench"):]) // 2
+        await context.sockets[user].call("read_message", {"chatid": bench_chat(pair)}, timeout=60)
+
+    await run_concurrently(len(users), context.args.concurrency, read, recorder)
+
+
+@scenario
+async def socket_login_burst(context, recorder):
+    # --logins concurrent /login calls, each a bcrypt check, while one socket keeps sending a cheap event;
+    # latency is that event's round trip, which stays flat as long as bcrypt runs off the event loop
+    client = next(iter(context.sockets.values()))
+    statuses = {}
+    login_latencies = []
+
+    async def login(index):
+        started = time.perf_counter()
+        params = {"username": bench_user(index % context.args.clients), "password": BENCH_PASSWORD}
+        async with context.session.post(context.url(index) + "/login", params=params) as response:
+            await response.read()
+            statuses[response.status] = statuses.get(response.status, 0) + 1
+        login_latencies.append(time.perf_counter() - started)
+
+    burst = asyncio.gather(*[login(index) for index in range(context.args.logins)], return_exceptions=True)
+    while not burst.done():
+        started = time.perf_counter()
+        try:
+            await client.call("read_message", {}, timeout=60)
+        except Exception:
+            recorder.errors += 1
+        else:
+            recorder.record(time.perf_counter() - started)
+        await asyncio.sleep(0.01)
+    results = await burst
+    recorder.errors += sum(1 for result in results if isinstance(result, Exception))
+    login_latencies.sort()
+    recorder.extra["login_statuses"] = statuses
+    if login_latencies:
+        recorder.extra["login_p50_ms"] = round(login_latencies[len(login_latencies) // 2] * 1000, 3)
+        recorder.extra["login_max_ms"] = round(login_latencies[-1] * 1000, 3)
+
+
+async def disconnect_all(context):
+    await asyncio.gather(*[client.disconnect() for client in context.sockets.values()], return_exceptions=True)
+    context.sockets = {}
+    if getattr(context, "socket_session", None) is not None:
+        await context.socket_session.close()
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def main(args):
+    names = args.scenarios.split(",") if args.scenarios else list(SCENARIOS)
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        raise SystemExit(f"Unknown scenarios: {', '.join(unknown)}; available: {', '.join(SCENARIOS)}")
+    # Socket scenarios need connected clients
+    if any(name.startswith("socket_") for name in names) and "socket_connect" not in names:
+        names.insert(0, "socket_connect")
+
+    servers = Servers(args)
+    results = {}
+    try:
+        await servers.start()
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+            context = Context(args, servers, session)
+            try:
+                for name in names:
+                    recorder = Recorder()
+                    await SCENARIOS[name](context, recorder)
+                    recorder.stop()
+                    results[name] = dict(recorder.summary(), **servers.memory())
+                    print(f"{name}: {results[name]}", file=sys.stderr)
+            finally:
+                await disconnect_all(context)
+    finally:
+        servers.stop()
+
+    return {
+        "meta": {
+            "commit": git_commit(),
+            "started_at": datetime.utcnow().isoformat() + "Z",
+            "python": platform.python_version(),
+            "mongo": "fake" if args.mongo == "fake" else "mongodb",
+            "clients": args.clients,
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "messages_per_client": args.messages,
+            "history": args.history,
+            "flood": args.flood,
+            "logins": args.logins,
+            "workers": args.workers,
+            "server_env": args.server_env,
+        },
+        "results": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", help=f"Comma separated, default all: {', '.join(SCENARIOS)}")
+    parser.add_argument("--clients", type=int, default=200, help="Seeded users and Socket.IO clients")
+    parser.add_argument("--concurrency", type=int, default=50, help="Operations in flight at a time")
+    parser.add_argument("--requests", type=int, default=2000, help="Requests per REST scenario")
+    parser.add_argument("--messages", type=int, default=10, help="Messages sent per sending client")
+    parser.add_argument("--logins", type=int, default=50, help="Concurrent /login calls of socket_login_burst")
+    parser.add_argument("--flood", type=int, default=200, help="Messages the flooding client of socket_flood keeps in flight")
+    parser.add_argument("--history", type=int, default=2000, help="Messages in the chat read by the history and export scenarios")
+    parser.add_argument("--mongo", default="fake", help="'fake' for the in-memory stand-in, or a MongoDB URI")
+    parser.add_argument("--workers", type=int, default=1, help="Server processes sharing the load through the Socket.IO broker")
+    parser.add_argument("--server-env", action="append", default=[], metavar="KEY=VALUE", help="Setting for the server, repeatable")
+    parser.add_argument("--out", help="Also write the JSON result to this file")
+    parser.add_argument("--verbose", action="store_true", help="Show the server output")
+    args = parser.parse_args()
+
+    result = asyncio.run(main(args))
+    output = json.dumps(result, indent=2)
+    print(output)
+    if args.out:
+        with open(args.out, "w") as out:
+            out.write(output + "\n")
@@ -0,0 +1,127 @@
+"""Start the chat backend for a benchmark run.
+
+    python benchmarks/server.py --port 8100 --mongo fake --users 1000 --history 2000
+
+``--mongo fake`` swaps Motor for mongomock-motor, an in-memory stand-in, so no
+database server is needed. Any other value is used as the MongoDB URI and the
+benchmark database is dropped first.
+
+Before the server starts, ``--users`` users named ``bench<i>`` (password
+``bench``) are inserted, paired up into chats ``bench<2i>_bench<2i+1>``, and
+the first chat gets ``--history`` messages for the history and export
+scenarios. Seeding goes straight to the database, registering thousands of
+users through ``/register`` would mostly measure bcrypt.
+"""
+import argparse
+import asyncio
+import os
+import sys
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BENCH_PASSWORD = "bench"
+
+
+def bench_user(index):
+    return f"bench{index}"
+
+
+def bench_chat(pair):
+    return f"{bench_user(2 * pair)}_{bench_user(2 * pair + 1)}"
+
+
+async def seed(users, history, drop=False):
+    from db import chat_collection, mongo, user_collection
+    from hashing import hash_password
+    from indexes import ensure_indexes, participant_key
+    from message_store import append_messages
+
+    if drop:
+        await mongo.client.drop_database("chatdb")
+    await ensure_indexes()
+    # Every user shares one hash, hashing thousands of passwords would take minutes
+    password = hash_password(BENCH_PASSWORD)
+    now = datetime.utcnow()
+    await user_collection.insert_many([{
+        "email": f"{bench_user(i)}@example.com",
+        "online_status": "Online",
+        "timezone": "UTC",
+        "aboutme": "benchmark user",
+        "username": bench_user(i),
+        "password": password,
+        "gender": "male",
+        "avatarUrl": "",
+        "creation_date": now,
+    } for i in range(users)])
+
+    chats = []
+    for pair in range(users // 2):
+        participants = [bench_user(2 * pair), bench_user(2 * pair + 1)]
+        chats.append({
+            "_id": bench_chat(pair),
+            "name": " & ".join(participants),
+            "image": "",
+            "participants": participants,
+            "participant_key": participant_key(participants),
+            "created_at": now,
+            "created_by": participants[0],
+            "last_updated": now - timedelta(seconds=pair),
+            "last_updated_by": participants[0],
+            "latestMessage": None,
+            "readSeq": {},
+            "last_seq": 0,
+        })
+    if chats:
+        await chat_collection.insert_many(chats)
+
+    if history and chats:
+        start = now - timedelta(seconds=history)
+        batch = []
+        for i in range(history):
+            sender, receiver = (bench_user(0), bench_user(1)) if i % 2 == 0 else (bench_user(1), bench_user(0))
+            batch.append({
+                "content": f"history message {i} " + "x" * 40,
+                "sender": sender,
+                "receiver": [receiver],
+                "time": (start + timedelta(seconds=i)).isoformat(timespec="milliseconds") + "Z",
+            })
+            if len(batch) == 100:
+                await append_messages(bench_chat(0), batch)
+                batch = []
+        if batch:
+            await append_messages(bench_chat(0), batch)
+    print(f"Seeded {users} users, {len(chats)} chats and {history} messages", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--mongo", default="fake", help="'fake' for the in-memory stand-in, or a MongoDB URI")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--history", type=int, default=2000)
+    parser.add_argument("--skip-seed", action="store_true", help="Use the data another worker seeded")
+    args = parser.parse_args()
+
+    if args.mongo == "fake":
+        import motor.motor_asyncio
+        from mongomock_motor import AsyncMongoMockClient
+        motor.motor_asyncio.AsyncIOMotorClient = AsyncMongoMockClient
+    else:
+        os.environ["MONGO_URI"] = args.mongo
+
+    import uvicorn
+
+    # The in-memory database lives in this process, seed it on the loop uvicorn will use
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    if not args.skip_seed:
+        loop.run_until_complete(seed(args.users, args.history, drop=args.mongo != "fake"))
+
+    from app import app
+    config = uvicorn.Config(app, host="127.0.0.1", port=args.port, log_level="warning", loop="none")
+    loop.run_until_complete(uvicorn.Server(config).serve())
+
+
+if __name__ == "__main__":
+    main()
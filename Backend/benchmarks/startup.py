@@ -0,0 +1,111 @@
+"""Measure how long a worker takes to start and to stop.
+
+    python benchmarks/startup.py --runs 5
+
+``import`` is the time a fresh interpreter spends importing ``app``, and
+whether that already created the MongoDB client (it should not, the client is
+created when startup first uses it). ``ready`` starts ``benchmarks/server.py``
+and times the spawn until ``/ready`` first answers 200, that is interpreter
+start, imports, waiting for the database, indexes and the admin user.
+``shutdown`` is the time from SIGTERM until the process exited, with the
+graceful drain. Each gives min, median and max over ``--runs`` processes.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from run import BACKEND_DIR, free_port  # noqa: E402
+
+IMPORT_PROBE = """
+import json, time
+started = time.perf_counter()
+import app
+import db
+print(json.dumps({"seconds": time.perf_counter() - started, "client_created": db.mongo._client is not None}))
+"""
+
+
+def summary(samples):
+    return {"min_s": round(min(samples), 3), "median_s": round(statistics.median(samples), 3),
+            "max_s": round(max(samples), 3)}
+
+
+def measure_import(env):
+    output = subprocess.run([sys.executable, "-c", IMPORT_PROBE], cwd=BACKEND_DIR, env=env,
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def wait_ready(process, url, timeout):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with status {process.returncode} before it was ready")
+        try:
+            with urllib.request.urlopen(url + "/ready", timeout=1) as response:
+                if response.status == 200:
+                    return
+        except (urllib.error.URLError, ConnectionError):
+            pass
+        time.sleep(0.01)
+    raise RuntimeError(f"Server at {url} was not ready within {timeout}s")
+
+
+def measure_server(args, env):
+    port = free_port()
+    command = [sys.executable, "benchmarks/server.py", "--port", str(port), "--mongo", args.mongo, "--skip-seed"]
+    started = time.perf_counter()
+    process = subprocess.Popen(command, cwd=BACKEND_DIR, env=env,
+                               stdout=subprocess.DEVNULL if not args.verbose else None,
+                               stderr=subprocess.DEVNULL if not args.verbose else None)
+    try:
+        wait_ready(process, f"http://127.0.0.1:{port}", args.timeout)
+        ready = time.perf_counter() - started
+        stopping = time.perf_counter()
+        process.terminate()
+        process.wait(timeout=args.timeout)
+        return ready, time.perf_counter() - stopping
+    finally:
+        if process.poll() is None:
+            process.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--mongo", default="fake", help="'fake' for the in-memory stand-in, or a MongoDB URI")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--server-env", action="append", default=[], metavar="NAME=VALUE")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    # The app refuses to start without a SECRET_KEY
+    env = dict(os.environ, SECRET_KEY=os.getenv("SECRET_KEY") or "startup-benchmark-secret-key")
+    env.update(dict(setting.split("=", 1) for setting in args.server_env))
+    if args.mongo != "fake":
+        env["MONGO_URI"] = args.mongo
+
+    imports = [measure_import(env) for _ in range(args.runs)]
+    servers = [measure_server(args, env) for _ in range(args.runs)]
+    print(json.dumps({
+        "meta": {"runs": args.runs, "mongo": "fake" if args.mongo == "fake" else "uri",
+                 "server_env": args.server_env, "python": sys.version.split()[0]},
+        "results": {
+            "import": dict(summary([sample["seconds"] for sample in imports]),
+                           client_created=any(sample["client_created"] for sample in imports)),
+            "ready": summary([ready for ready, _ in servers]),
+            "shutdown": summary([shutdown for _, shutdown in servers]),
+        },
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
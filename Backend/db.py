@@ -1,11 +1,13 @@
 from motor.motor_asyncio import AsyncIOMotorClient
-from pymongo import MongoClient
+import asyncio
 import os
 from dotenv import load_dotenv
+from metrics import InstrumentedCollection
 
 load_dotenv()
 
 MONGO_DETAILS = os.getenv("MONGO_URI")
+DATABASE_NAME = "chatdb"
 # Assume these environment variables are set for the admin details
 ADMIN_USER = os.getenv('ADMIN_USER', 'admin')
 ADMIN_PASS = os.getenv('ADMIN_PASS', 'password123')
@@ -13,8 +15,94 @@ ADMIN_GENDER = os.getenv('ADMIN_GENDER', 'male')
 ADMIN_EMAIL = os.getenv('ADMIN_EMAIL', 'admin@example.com')
 ADMIN_TIMEZONE = os.getenv('ADMIN_TIMEZONE', 'Asia/Kolkata')
 
+# Connection pool of each worker
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "0"))
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "100"))
+# How long an operation waits for a free connection before it fails, instead of waiting forever
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", "10000"))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000"))
+# Comma separated wire compressors, e.g. "zstd,zlib"; zstd and snappy need their python packages
+MONGO_COMPRESSORS = os.getenv("MONGO_COMPRESSORS", "")
+# Seconds startup waits for the database to answer
+MONGO_STARTUP_TIMEOUT = float(os.getenv("MONGO_STARTUP_TIMEOUT", "30"))
 
-client = AsyncIOMotorClient(MONGO_DETAILS)
-db = client['chatdb']
-user_collection = db['users']
-chat_collection = db['chats']
\ No newline at end of file
+
+def client_options():
+    options = {
+        "minPoolSize": MONGO_MIN_POOL_SIZE,
+        "maxPoolSize": MONGO_MAX_POOL_SIZE,
+        "waitQueueTimeoutMS": MONGO_WAIT_QUEUE_TIMEOUT_MS,
+        "serverSelectionTimeoutMS": MONGO_SERVER_SELECTION_TIMEOUT_MS,
+    }
+    if MONGO_COMPRESSORS:
+        options["compressors"] = MONGO_COMPRESSORS
+    return options
+
+
+class Mongo:
+    """The Motor client, created on first use so importing the app opens no connection."""
+
+    def __init__(self, uri=MONGO_DETAILS):
+        self.uri = uri
+        self._client = None
+        # name -> collection of the current client, Motor builds a new object per lookup otherwise
+        self._collections = {}
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = AsyncIOMotorClient(self.uri, **client_options())
+        return self._client
+
+    @property
+    def database(self):
+        return self.client[DATABASE_NAME]
+
+    def collection(self, name):
+        collection = self._collections.get(name)
+        if collection is None:
+            collection = self._collections[name] = self.database[name]
+        return collection
+
+    async def ping(self):
+        await self.client.admin.command("ping")
+
+    async def wait_ready(self, timeout=MONGO_STARTUP_TIMEOUT):
+        # Retry until the database answers, so a worker started before it can still come up
+        deadline = asyncio.get_running_loop().time() + timeout
+        delay = 0.1
+        while True:
+            try:
+                await self.ping()
+                return
+            except Exception as e:
+                if asyncio.get_running_loop().time() + delay > deadline:
+                    raise RuntimeError(f"MongoDB did not answer within {timeout}s: {e}")
+                print(f"Waiting for MongoDB: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 2)
+
+    def close(self):
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+            self._collections.clear()
+
+
+class LazyCollection:
+    # Stands in for a collection of the current client, resolved on every use
+    def __init__(self, name):
+        self.name = name
+
+    def __getattr__(self, attribute):
+        return getattr(mongo.collection(self.name), attribute)
+
+
+mongo = Mongo()
+# Every call through these collections is timed for /metrics
+user_collection = InstrumentedCollection(LazyCollection('users'))
+chat_collection = InstrumentedCollection(LazyCollection('chats'))
+message_collection = InstrumentedCollection(LazyCollection('messages'))
+export_job_collection = InstrumentedCollection(LazyCollection('export_jobs'))
+inbox_collection = InstrumentedCollection(LazyCollection('inbox'))
+message_archive_collection = InstrumentedCollection(LazyCollection('message_archive'))
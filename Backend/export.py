@@ -0,0 +1,122 @@
+"""Streaming chat export.
+
+``export_chunks`` reads a chat bucket by bucket from a database cursor and
+yields encoded chunks as soon as ``EXPORT_CHUNK_SIZE`` bytes are ready, so
+memory stays flat and the first bytes go out before the whole history is read.
+Plain text, NDJSON and CSV are supported, each optionally gzip compressed.
+"""
+import csv
+import io
+import os
+import zlib
+
+from fast_json import dumps
+from message_store import iter_messages, parse_message_time
+from models import format_message_time
+
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", str(64 * 1024)))
+
+# format -> (media type, file extension)
+EXPORT_FORMATS = {
+    "txt": ("text/plain", "txt"),
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "csv": ("text/csv", "csv"),
+}
+
+
+def format_message(sender, time_str, content):
+    # Ensure the time is formatted as dd/mm/yy hh:mm:ss
+    formatted_time = time_str.strftime("%d/%m/%y %H:%M:%S")
+    return f"{sender} ({formatted_time}): {content}"
+
+
+def parse_time_fast(value):
+    """Parse a message time, None when it cannot be parsed."""
+    try:
+        return parse_message_time(value)
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+def export_filename(chat_id, export_format, compress):
+    extension = EXPORT_FORMATS[export_format][1]
+    return f"chat_{chat_id}.{extension}" + (".gz" if compress else "")
+
+
+def encode_txt(message):
+    time = parse_time_fast(message.get("time"))
+    if time:
+        return format_message(message["sender"], time, message["content"]) + "\n"
+    return f"{message['sender']} (Unknown time): {message['content']}\n"
+
+
+def encode_ndjson(message):
+    return dumps({
+        "sender": message["sender"],
+        "receiver": message.get("receiver", []),
+        "time": format_message_time(message.get("time")),
+        "content": message["content"],
+    }) + "\n"
+
+
+class CsvEncoder:
+    # csv.writer needs a file, reuse one small buffer for every row
+    def __init__(self):
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer)
+
+    def row(self, values):
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        self._writer.writerow(values)
+        return self._buffer.getvalue()
+
+    def __call__(self, message):
+        return self.row([message["sender"], format_message_time(message.get("time")), message["content"]])
+
+
+async def export_chunks(chat_id, export_format="txt", compress=False, messages=None):
+    """Yield the encoded export of a chat in chunks of about EXPORT_CHUNK_SIZE bytes.
+
+    ``messages`` can replace the message source, it defaults to reading the
+    chat from the message store.
+    """
+    compressor = zlib.compressobj(wbits=31) if compress else None  # wbits=31 writes a gzip header
+    pending = []
+    pending_size = 0
+
+    def take():
+        nonlocal pending, pending_size
+        data = "".join(pending).encode("utf-8")
+        pending = []
+        pending_size = 0
+        return compressor.compress(data) if compressor else data
+
+    if export_format == "csv":
+        encode = CsvEncoder()
+        pending.append(encode.row(["sender", "time", "content"]))
+    elif export_format == "ndjson":
+        encode = encode_ndjson
+    else:
+        encode = encode_txt
+
+    message_count = 0
+    async for message in (messages if messages is not None else iter_messages(chat_id)):
+        line = encode(message)
+        pending.append(line)
+        pending_size += len(line)
+        message_count += 1
+        if pending_size >= EXPORT_CHUNK_SIZE:
+            chunk = take()
+            if chunk:
+                yield chunk
+
+    if message_count == 0 and export_format == "txt":
+        # No messages found, write the default content
+        pending.append("No messages found\n")
+
+    chunk = take()
+    if compressor:
+        chunk += compressor.flush()
+    if chunk:
+        yield chunk
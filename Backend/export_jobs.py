@@ -0,0 +1,319 @@
+"""Background bulk export of many chats into one archive.
+
+A job selects chats (optionally those of one user) and a message time range.
+Its chats are exported in parallel by ``EXPORT_CHAT_CONCURRENCY`` readers, each
+one gzip compressing a chat into a temporary file, and appended one by one to
+``<EXPORT_DIR>/export_<job_id>.tar`` as ``chat_<id>.<format>.gz`` members.
+
+Chats are read in ``_id`` order and appended in that same order, however their
+exports finish. After every appended chat the job document records its id as
+a watermark (``last_chat_id``) along with the archive offset, so the
+checkpoint stays the same size whatever the number of chats. A job interrupted
+by a restart is picked up again, the archive is cut back to the last
+checkpoint and only the chats after the watermark are exported.
+
+Jobs are claimed from the database with a lease, so several app workers can
+share the work without running a job twice. ``EXPORT_MAX_MESSAGES_PER_SECOND``
+caps the read rate of all jobs together to keep exports from starving live
+traffic.
+"""
+import asyncio
+import glob
+import os
+import tarfile
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from pymongo import ReturnDocument
+
+from db import chat_collection, export_job_collection
+from export import EXPORT_FORMATS, export_chunks
+from message_store import iter_messages
+from models import naive_utc
+
+EXPORT_DIR = os.getenv("EXPORT_DIR", "exports")
+EXPORT_JOB_WORKERS = int(os.getenv("EXPORT_JOB_WORKERS", "1"))
+EXPORT_CHAT_CONCURRENCY = int(os.getenv("EXPORT_CHAT_CONCURRENCY", "4"))
+EXPORT_MAX_MESSAGES_PER_SECOND = int(os.getenv("EXPORT_MAX_MESSAGES_PER_SECOND", "0"))  # 0 means no limit
+EXPORT_JOB_LEASE_SECONDS = int(os.getenv("EXPORT_JOB_LEASE_SECONDS", "60"))
+EXPORT_JOB_POLL_SECONDS = int(os.getenv("EXPORT_JOB_POLL_SECONDS", "5"))
+
+
+async def in_thread(function, *args):
+    # File writes off the event loop; asyncio.to_thread needs Python 3.9
+    return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+
+class Throttle:
+    """Spaces out work so that at most ``rate`` units per second go through."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._next = time.monotonic()
+
+    async def wait(self, units=1):
+        if not self.rate:
+            return
+        now = time.monotonic()
+        start = max(self._next, now)
+        self._next = start + units / self.rate
+        if start > now:
+            await asyncio.sleep(start - now)
+
+
+class ExportJobManager:
+    def __init__(self, export_dir=EXPORT_DIR, workers=EXPORT_JOB_WORKERS,
+                 chat_concurrency=EXPORT_CHAT_CONCURRENCY,
+                 max_messages_per_second=EXPORT_MAX_MESSAGES_PER_SECOND):
+        self.export_dir = export_dir
+        self.workers = workers
+        self.chat_concurrency = chat_concurrency
+        self.throttle = Throttle(max_messages_per_second)
+        self.host_id = uuid.uuid4().hex
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+
+    def archive_path(self, job_id):
+        return os.path.join(self.export_dir, f"export_{job_id}.tar")
+
+    async def submit(self, created_by, username=None, since=None, until=None, export_format="txt"):
+        if export_format not in EXPORT_FORMATS:
+            raise ValueError(f"Unsupported export format: {export_format}")
+
+        now = datetime.utcnow()
+        job = {
+            "_id": uuid.uuid4().hex,
+            "status": "queued",
+            "created_by": created_by,
+            "created_at": now,
+            "updated_at": now,
+            # Stored as naive UTC like every other date in the database
+            "params": {
+                "username": username,
+                "since": naive_utc(since),
+                "until": naive_utc(until),
+                "format": export_format,
+            },
+            "total_chats": None,
+            # Checkpoint: every chat up to this _id is in the archive, which ends at archive_offset
+            "last_chat_id": None,
+            "exported_chats": 0,
+            "archive_offset": 0,
+            "lease_until": None,
+            "error": None,
+        }
+        await export_job_collection.insert_one(job)
+        self._wakeup.set()
+        return job
+
+    async def get(self, job_id):
+        return await export_job_collection.find_one({"_id": job_id})
+
+    def start(self):
+        os.makedirs(self.export_dir, exist_ok=True)
+        for _ in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker()))
+
+    async def stop(self):
+        # Running jobs keep their checkpoint and resume on the next start
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _claim(self):
+        # Queued jobs, or running jobs whose worker stopped renewing the lease
+        now = datetime.utcnow()
+        return await export_job_collection.find_one_and_update(
+            {"$or": [
+                {"status": "queued"},
+                {"status": "running", "lease_until": {"$lt": now}},
+            ]},
+            {"$set": {
+                "status": "running",
+                "owner": self.host_id,
+                "lease_until": now + timedelta(seconds=EXPORT_JOB_LEASE_SECONDS),
+                "updated_at": now,
+            }},
+            sort=[("created_at", 1)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    async def _worker(self):
+        while True:
+            try:
+                job = await self._claim()
+            except Exception as e:
+                print(f"Claiming an export job failed: {e}")
+                job = None
+
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), EXPORT_JOB_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            lease = asyncio.create_task(self._renew_lease(job["_id"]))
+            try:
+                await self._run(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Export job {job['_id']} failed: {e}")
+                await export_job_collection.update_one(
+                    {"_id": job["_id"]},
+                    {"$set": {"status": "failed", "error": str(e), "updated_at": datetime.utcnow()}},
+                )
+            finally:
+                lease.cancel()
+
+    async def _renew_lease(self, job_id):
+        while True:
+            await asyncio.sleep(EXPORT_JOB_LEASE_SECONDS / 3)
+            await export_job_collection.update_one(
+                {"_id": job_id, "owner": self.host_id},
+                {"$set": {"lease_until": datetime.utcnow() + timedelta(seconds=EXPORT_JOB_LEASE_SECONDS)}},
+            )
+
+    async def _throttled_messages(self, chat_id, since, until):
+        batch = 0
+        async for message in iter_messages(chat_id, since=since, until=until):
+            batch += 1
+            if batch == 100:
+                await self.throttle.wait(batch)
+                batch = 0
+            yield message
+        if batch:
+            await self.throttle.wait(batch)
+
+    async def _export_chat(self, job, chat_id):
+        # Write one chat, gzip compressed, to a temporary file next to the archive
+        params = job["params"]
+        path = os.path.join(self.export_dir, f"export_{job['_id']}_{uuid.uuid4().hex}.part")
+        messages = self._throttled_messages(chat_id, params["since"], params["until"])
+        with open(path, "wb") as part:
+            async for chunk in export_chunks(chat_id, params["format"], compress=True, messages=messages):
+                await in_thread(part.write, chunk)
+        return path
+
+    def _chat_query(self, params):
+        query = {}
+        if params["username"]:
+            query["participants"] = params["username"]
+        if params["since"]:
+            # Chats without activity since the start of the range have nothing to export
+            query["last_updated"] = {"$gte": params["since"]}
+        if params["until"]:
+            query["created_at"] = {"$lte": params["until"]}
+        return query
+
+    async def _run(self, job):
+        job_id = job["_id"]
+        params = job["params"]
+        query = self._chat_query(params)
+        last_chat_id = job.get("last_chat_id")
+
+        total = await chat_collection.count_documents(query)
+        await export_job_collection.update_one({"_id": job_id}, {"$set": {"total_chats": total}})
+
+        # Cut the archive back to the last checkpoint, anything after it belongs to an interrupted write
+        for part_path in glob.glob(os.path.join(self.export_dir, f"export_{job_id}_*.part")):
+            os.remove(part_path)
+        path = self.archive_path(job_id)
+        archive = open(path, "r+b" if os.path.exists(path) else "w+b")
+        try:
+            archive.seek(job.get("archive_offset", 0))
+            archive.truncate()
+            tar = tarfile.open(fileobj=archive, mode="w")
+
+            pending_ids = asyncio.Queue()
+            finished = asyncio.Queue()
+            # Chats fed but not appended yet, bounds the exports finished ahead of a slow one
+            in_flight = asyncio.Semaphore(self.chat_concurrency * 2)
+
+            async def feed():
+                remaining = dict(query)
+                if last_chat_id is not None:
+                    remaining["_id"] = {"$gt": last_chat_id}
+                position = 0
+                async for chat in chat_collection.find(remaining, {"_id": 1}).sort("_id", 1):
+                    await in_flight.acquire()
+                    await pending_ids.put((position, chat["_id"]))
+                    position += 1
+                for _ in range(self.chat_concurrency):
+                    await pending_ids.put(None)
+
+            async def read():
+                while True:
+                    entry = await pending_ids.get()
+                    if entry is None:
+                        await finished.put(None)
+                        return
+                    position, chat_id = entry
+                    try:
+                        await finished.put((position, chat_id, await self._export_chat(job, chat_id)))
+                    except Exception as e:
+                        await finished.put((position, chat_id, e))
+
+            tasks = [asyncio.create_task(feed())]
+            tasks += [asyncio.create_task(read()) for _ in range(self.chat_concurrency)]
+            try:
+                readers_left = self.chat_concurrency
+                # Finished exports waiting for an earlier chat, position -> (chat_id, part_path)
+                ready = {}
+                next_position = 0
+                while readers_left:
+                    result = await finished.get()
+                    if result is None:
+                        readers_left -= 1
+                        continue
+                    position, chat_id, part_path = result
+                    if isinstance(part_path, Exception):
+                        raise part_path
+                    ready[position] = (chat_id, part_path)
+
+                    # Append in _id order, so everything up to the watermark is in the archive
+                    while next_position in ready:
+                        chat_id, part_path = ready.pop(next_position)
+                        next_position += 1
+                        extension = EXPORT_FORMATS[params["format"]][1]
+                        await in_thread(tar.add, part_path, f"chat_{chat_id}.{extension}.gz")
+                        await in_thread(archive.flush)
+                        os.remove(part_path)
+                        in_flight.release()
+
+                        # Checkpoint: the chats up to this one are in the archive up to tar.offset
+                        await export_job_collection.update_one(
+                            {"_id": job_id},
+                            {
+                                "$set": {"last_chat_id": chat_id, "archive_offset": tar.offset,
+                                         "updated_at": datetime.utcnow()},
+                                "$inc": {"exported_chats": 1},
+                            },
+                        )
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+            # Writes the end-of-archive blocks
+            tar.close()
+        finally:
+            archive.close()
+
+        await export_job_collection.update_one(
+            {"_id": job_id},
+            {"$set": {
+                "status": "completed",
+                "archive_size": os.path.getsize(path),
+                "completed_at": datetime.utcnow(),
+                "updated_at": datetime.utcnow(),
+                "lease_until": None,
+            }},
+        )
+
+
+export_jobs = ExportJobManager()
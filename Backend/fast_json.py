@@ -0,0 +1,50 @@
+"""JSON encoding for Socket.IO payloads and REST responses.
+
+``JSON_ENCODER`` picks the implementation: ``orjson`` (the default when the
+package is installed, several times faster) or ``json`` from the standard
+library. The module itself is handed to python-socketio as its ``json``
+module, so it offers the same ``dumps``/``loads`` functions.
+"""
+import json
+import os
+
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSON_ENCODER = os.getenv("JSON_ENCODER", "orjson" if orjson else "json")
+if JSON_ENCODER == "orjson" and orjson is None:
+    print("JSON_ENCODER=orjson but orjson is not installed, using json")
+    JSON_ENCODER = "json"
+
+
+if JSON_ENCODER == "orjson":
+    def dumps_bytes(obj):
+        return orjson.dumps(obj)
+
+    def dumps(obj, **kwargs):
+        # Keyword arguments of json.dumps (separators, ...) are ignored, orjson output is always compact
+        return orjson.dumps(obj).decode("utf-8")
+
+    def loads(data, **kwargs):
+        return orjson.loads(data)
+else:
+    def dumps_bytes(obj):
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    def dumps(obj, **kwargs):
+        kwargs.setdefault("separators", (",", ":"))
+        return json.dumps(obj, **kwargs)
+
+    def loads(data, **kwargs):
+        return json.loads(data, **kwargs)
+
+
+class FastJSONResponse(JSONResponse):
+    """Default response class of the app, renders with the selected encoder."""
+
+    def render(self, content):
+        return dumps_bytes(content)
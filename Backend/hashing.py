@@ -0,0 +1,139 @@
+"""Password hashing off the event loop.
+
+bcrypt is deliberately slow (100-300 ms of CPU per call). Running it inside an
+async handler freezes every socket served by the worker, so all hashing goes
+through ``password_hasher``, which runs it on a bounded thread or process pool.
+When more than ``PASSWORD_HASH_MAX_PENDING`` operations are waiting, new ones
+are rejected with ``HashingBusyError`` instead of queueing without limit.
+"""
+import asyncio
+import math
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import bcrypt
+
+from metrics import password_hash_duration
+
+PASSWORD_HASH_EXECUTOR = os.getenv("PASSWORD_HASH_EXECUTOR", "thread")  # thread or process
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(os.cpu_count() or 2)))
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", str(PASSWORD_HASH_WORKERS * 8)))
+
+
+def hash_password(password: str) -> str:
+    # Generate a salt and hash the password
+    salt = bcrypt.gensalt()
+    hashed = bcrypt.hashpw(password.encode('utf-8'), salt)
+    return hashed.decode('utf-8')
+
+
+def verify_password(password: str, hashed_password: str) -> bool:
+    # Verify a stored password against one provided by user
+    return bcrypt.checkpw(password.encode('utf-8'), hashed_password.encode('utf-8'))
+
+
+class HashingBusyError(Exception):
+    def __init__(self, retry_after):
+        super().__init__("Password hashing queue is full")
+        self.retry_after = retry_after
+
+
+class OperationStats:
+    def __init__(self):
+        self.count = 0
+        self.rejected = 0
+        self.total_seconds = 0.0
+        # Recent latencies, enough for percentiles without keeping history forever
+        self.recent = deque(maxlen=512)
+
+    def record(self, seconds):
+        self.count += 1
+        self.total_seconds += seconds
+        self.recent.append(seconds)
+
+    def average(self):
+        return self.total_seconds / self.count if self.count else 0.0
+
+    def snapshot(self):
+        recent = sorted(self.recent)
+
+        def percentile(fraction):
+            if not recent:
+                return 0.0
+            return round(recent[min(len(recent) - 1, int(len(recent) * fraction))] * 1000, 2)
+
+        return {
+            "count": self.count,
+            "rejected": self.rejected,
+            "avg_ms": round(self.average() * 1000, 2),
+            "p50_ms": percentile(0.5),
+            "p99_ms": percentile(0.99),
+        }
+
+
+class PasswordHasher:
+    def __init__(self, executor=PASSWORD_HASH_EXECUTOR, workers=PASSWORD_HASH_WORKERS,
+                 max_pending=PASSWORD_HASH_MAX_PENDING):
+        self.executor_kind = executor
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self._executor = None
+        self._stats = {"hash": OperationStats(), "verify": OperationStats()}
+
+    def _get_executor(self):
+        # Created on first use, so importing the module does not start processes
+        if self._executor is None:
+            if self.executor_kind == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="bcrypt")
+        return self._executor
+
+    def retry_after(self):
+        # Seconds until the current backlog should be worked off
+        average = max(self._stats["hash"].average(), self._stats["verify"].average(), 0.1)
+        return max(1, math.ceil(self.pending / self.workers * average))
+
+    async def _run(self, operation, function, *args):
+        stats = self._stats[operation]
+        if self.pending >= self.max_pending:
+            stats.rejected += 1
+            raise HashingBusyError(self.retry_after())
+
+        self.pending += 1
+        started = time.perf_counter()
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._get_executor(), function, *args)
+        finally:
+            self.pending -= 1
+            elapsed = time.perf_counter() - started
+            stats.record(elapsed)
+            password_hash_duration.observe(elapsed, operation)
+
+    async def hash(self, password):
+        return await self._run("hash", hash_password, password)
+
+    async def verify(self, password, hashed_password):
+        return await self._run("verify", verify_password, password, hashed_password)
+
+    def stats(self):
+        return {
+            "executor": self.executor_kind,
+            "workers": self.workers,
+            "pending": self.pending,
+            "max_pending": self.max_pending,
+            "hash": self._stats["hash"].snapshot(),
+            "verify": self._stats["verify"].snapshot(),
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+password_hasher = PasswordHasher()
@@ -0,0 +1,258 @@
+"""Materialized chat list of every user.
+
+The chat list used to be read from the ``chats`` collection, where the preview
+and the unread counter are shared by all participants. The
+``inbox`` collection holds one row per user and chat instead:
+
+    {
+        "user": "alice",
+        "chat_id": "alice_bob",
+        "name", "image", "participants", "created_at", "created_by",
+        "last_updated": <time of the last message>,
+        "last_updated_by": "bob",
+        "latestMessage": <preview of the last message>,
+        "read_seq": 41,
+        "unread_seqs": [40, 42, 43],
+        "unread": 0,
+        "changed_at": <time of the last write to the row>
+    }
+
+so a page of a user's chats is one range read of an index on (user, sort
+field). Rows are written along with the chat: ``create_chat`` adds one per
+participant, ``persist_messages`` moves every row of the chat and pushes the
+seqs of the new messages to the receivers' ``unread_seqs``, ``read_message``
+raises the reader's ``read_seq`` watermark with ``$max``. The unread count is
+the number of ``unread_seqs`` above ``read_seq`` (plus ``unread``, the counter
+of rows from before the watermark). Both writes commute, so a read and a
+batch of messages give the same count whichever is written first; a plain
+counter reset to zero would wipe messages stored just before it. Every write
+also sets ``changed_at``, which ``updated_since`` polls read, so a read shows
+up there without moving the chat in the list.
+
+The chat document and the message store stay the source of truth, the rows can
+be regenerated from them in one streaming pass:
+
+    python inbox.py --rebuild
+"""
+import asyncio
+import os
+import sys
+from datetime import datetime
+
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import DuplicateKeyError
+
+from db import chat_collection, inbox_collection
+from message_store import iter_buckets
+
+# Chat fields copied into every row
+CHAT_FIELDS = ("name", "image", "participants", "created_at", "created_by",
+               "last_updated", "last_updated_by", "latestMessage")
+INBOX_PROJECTION = dict({field: 1 for field in CHAT_FIELDS}, chat_id=1, unread=1, read_seq=1, unread_seqs=1,
+                        changed_at=1, _id=0)
+REBUILD_BATCH_SIZE = 500
+# Unread seqs kept per row, the newest ones; the count shown stops growing there
+UNREAD_SEQS_MAX = int(os.getenv("UNREAD_SEQS_MAX", "1000"))
+
+INBOX_INDEXES = [
+    # One row per user and chat, also finds the row of a reader
+    IndexModel([("user", ASCENDING), ("chat_id", ASCENDING)], name="user_chat_id_unique", unique=True),
+    # A stored batch updates every row of its chat
+    IndexModel([("chat_id", ASCENDING)], name="chat_id"),
+    # Chat list pages, sorted like the SORTABLE_CHAT_FIELDS; chat_id keeps pages stable between equal times
+    IndexModel([("user", ASCENDING), ("last_updated", DESCENDING), ("chat_id", DESCENDING)],
+               name="user_last_updated_chat_id"),
+    IndexModel([("user", ASCENDING), ("created_at", DESCENDING), ("chat_id", DESCENDING)],
+               name="user_created_at_chat_id"),
+    # updated_since polls, oldest change first
+    IndexModel([("user", ASCENDING), ("changed_at", ASCENDING), ("chat_id", ASCENDING)],
+               name="user_changed_at_chat_id"),
+]
+
+
+def unread_key(username):
+    # Usernames are keys of the readSeq map, '.' and '$' are not allowed in MongoDB field names
+    return username.replace(".", "\uff0e").replace("$", "\uff04")
+
+
+def legacy_unread_count(chat, username):
+    # The counter chats shared before the read watermarks, it counted for everyone but the last sender
+    if chat.get("last_updated_by") != username:
+        return chat.get("unreadMessageCounter", 0)
+    return 0
+
+
+def read_watermark(chat, username):
+    # Highest seq the user read, None while only the counters from before the watermarks know the count
+    read_seq = chat.get("readSeq", {}).get(unread_key(username))
+    if read_seq is None and "unreadMessageCounter" not in chat:
+        return 0
+    return read_seq
+
+
+def unread_count(row):
+    read_seq = row.get("read_seq", 0)
+    return row.get("unread", 0) + sum(1 for seq in row.get("unread_seqs", ()) if seq > read_seq)
+
+
+def inbox_row(chat, user, unread_seqs=()):
+    row = {field: chat.get(field) for field in CHAT_FIELDS}
+    read_seq = read_watermark(chat, user)
+    row.update(user=user, chat_id=chat["_id"], read_seq=read_seq or 0, unread_seqs=sorted(unread_seqs),
+               unread=legacy_unread_count(chat, user) if read_seq is None else 0,
+               changed_at=chat.get("last_updated"))
+    return row
+
+
+def row_to_chat(row):
+    # Shaped like the chat documents the list returned before
+    chat = {"_id": row.pop("chat_id")}
+    unread = unread_count(row)
+    row.pop("read_seq", None)
+    row.pop("unread_seqs", None)
+    row.pop("unread", None)
+    chat.update(row)
+    chat["unreadMessageCounter"] = unread
+    return chat
+
+
+async def add_chat(chat):
+    # Upserts, so a rebuild running at the same time does not make this fail
+    await asyncio.gather(*[
+        inbox_collection.update_one({"user": user, "chat_id": chat["_id"]},
+                                    {"$setOnInsert": inbox_row(chat, user)}, upsert=True)
+        for user in chat["participants"]
+    ])
+
+
+async def record_messages(chat_id, last_updated, last_updated_by, preview, unread_seqs_by_user):
+    """Move every row of the chat to its newest message and add unread_seqs_by_user {user: [seq, ...]}."""
+    await asyncio.gather(
+        inbox_collection.update_many({"chat_id": chat_id}, {"$set": {
+            "last_updated": last_updated,
+            "last_updated_by": last_updated_by,
+            "latestMessage": preview,
+            "changed_at": last_updated,
+        }}),
+        *[inbox_collection.update_one({"user": user, "chat_id": chat_id}, {"$push": {"unread_seqs": {
+            "$each": seqs, "$sort": 1, "$slice": -UNREAD_SEQS_MAX}}})
+          for user, seqs in unread_seqs_by_user.items()],
+    )
+
+
+async def mark_read(reads_by_chat):
+    """Raise the read watermark of {chat_id: {reader: seq}}, dropping the seqs it covers."""
+    # A changed unread count is a change for updated_since polls, last_updated stays the time of the last message
+    changed_at = datetime.utcnow()
+    await asyncio.gather(*[
+        inbox_collection.update_one({"user": reader, "chat_id": chat_id}, {
+            "$max": {"read_seq": seq},
+            "$pull": {"unread_seqs": {"$lte": seq}},
+            # The counter from before the watermarks is covered by any read
+            "$set": {"unread": 0, "changed_at": changed_at},
+        })
+        for chat_id, reads in reads_by_chat.items() for reader, seq in reads.items()
+    ])
+
+
+async def get_inbox_page(user, sort_field, order, limit, updated_since=None, after=None):
+    """Chats of a user sorted by sort_field, after=(value, chat_id) continues from a cursor.
+
+    With updated_since, the rows changed at or after it, sort_field being changed_at.
+    """
+    query = {"user": user}
+    if updated_since is not None:
+        query["changed_at"] = {"$gte": updated_since}
+    if after is not None:
+        # Rows after (value, chat_id) in the page order; chat_id breaks ties between equal timestamps
+        value, chat_id = after
+        operator = "$gt" if order == ASCENDING else "$lt"
+        query["$or"] = [
+            {sort_field: {operator: value}},
+            {sort_field: value, "chat_id": {operator: chat_id}},
+        ]
+    rows = await inbox_collection.find(query, INBOX_PROJECTION)\
+        .sort([(sort_field, order), ("chat_id", order)])\
+        .limit(limit)\
+        .to_list(length=limit)
+    return [row_to_chat(row) for row in rows]
+
+
+async def unread_seqs_by_user(chat):
+    """Seqs of the messages each participant has not read, the newest UNREAD_SEQS_MAX, from the message store."""
+    watermarks = {user: read_watermark(chat, user) for user in chat.get("participants", [])}
+    watermarks = {user: read_seq for user, read_seq in watermarks.items() if read_seq is not None}
+    unread = {user: [] for user in watermarks}
+    if not watermarks:
+        return unread
+    # Newest buckets first, until every reader has all its unread messages or the most it keeps
+    query = {"chat_id": chat["_id"], "last_seq": {"$gt": min(watermarks.values())}}
+    async for bucket in iter_buckets(query, "last_seq", DESCENDING, {"messages": 1, "last_seq": 1}):
+        for message in bucket["messages"]:
+            seq = message.get("seq")
+            if seq is None:
+                continue
+            for user in message.get("receiver", ()):
+                if user in unread and seq > watermarks[user]:
+                    unread[user].append(seq)
+        if all(len(seqs) >= UNREAD_SEQS_MAX or bucket["last_seq"] <= watermarks[user]
+               for user, seqs in unread.items()):
+            break
+    return {user: sorted(seqs)[-UNREAD_SEQS_MAX:] for user, seqs in unread.items()}
+
+
+async def _write_row(row):
+    # A row that live traffic moved past the chat snapshot read here keeps its newer values,
+    # and a read since the snapshot keeps its higher watermark
+    row = dict(row)
+    read_seq = row.pop("read_seq")
+    # Rewritten counts are news to pollers
+    row["changed_at"] = datetime.utcnow()
+    try:
+        await inbox_collection.update_one(
+            {"user": row["user"], "chat_id": row["chat_id"],
+             "$or": [{"last_updated": {"$lte": row["last_updated"]}}, {"last_updated": None}]},
+            {"$set": row, "$max": {"read_seq": read_seq}}, upsert=True)
+    except DuplicateKeyError:
+        pass
+
+
+async def rebuild_inboxes():
+    """Write the rows of every chat again, holding one batch of rows in memory at a time."""
+    written = 0
+    rows = []
+    async for chat in chat_collection.find({}, dict({field: 1 for field in CHAT_FIELDS},
+                                                    readSeq=1, unreadMessageCounter=1)):
+        unread = await unread_seqs_by_user(chat)
+        rows.extend(inbox_row(chat, user, unread.get(user, ())) for user in chat.get("participants", []))
+        if len(rows) >= REBUILD_BATCH_SIZE:
+            await asyncio.gather(*[_write_row(row) for row in rows])
+            written += len(rows)
+            rows = []
+    if rows:
+        await asyncio.gather(*[_write_row(row) for row in rows])
+        written += len(rows)
+    return written
+
+
+async def backfill_inboxes():
+    # Chats created before the inbox existed, skipped once it holds any row
+    if await inbox_collection.find_one({}, {"_id": 1}) is not None:
+        return 0
+    if await chat_collection.find_one({}, {"_id": 1}) is None:
+        return 0
+    written = await rebuild_inboxes()
+    print(f"Built {written} inbox rows from the existing chats")
+    return written
+
+
+if __name__ == "__main__":
+    if "--rebuild" not in sys.argv:
+        print("Usage: python inbox.py --rebuild")
+        sys.exit(1)
+
+    async def main():
+        written = await rebuild_inboxes()
+        print(f"Wrote {written} inbox rows")
+
+    asyncio.run(main())
@@ -0,0 +1,184 @@
+"""Index bootstrap and query plan checks.
+
+Every index the app relies on is declared here and created by ``ensure_indexes``
+on startup. ``create_indexes`` does nothing for indexes that already exist, so
+running it on every start is cheap.
+
+``check_query_plans`` runs ``explain()`` on each hot query and reports the ones
+whose winning plan still scans a whole collection. It runs on startup when
+``QUERY_PLAN_CHECK`` is set, and from the command line:
+
+    python indexes.py --check-plans
+"""
+import asyncio
+import json
+import os
+import sys
+from datetime import datetime
+
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import OperationFailure
+
+from db import (chat_collection, export_job_collection, inbox_collection, message_archive_collection,
+                message_collection, user_collection)
+from inbox import INBOX_INDEXES, backfill_inboxes
+from message_store import ARCHIVE_INDEXES, MESSAGE_INDEXES, migrate_embedded_messages
+
+QUERY_PLAN_CHECK = os.getenv("QUERY_PLAN_CHECK", "false").lower() == "true"
+
+# Fields a chat list can be sorted by, each one backs a (user, field) inbox index
+SORTABLE_CHAT_FIELDS = ("last_updated", "created_at")
+
+USER_INDEXES = [
+    # register, login and authentication look users up by name
+    IndexModel([("username", ASCENDING)], name="username_unique", unique=True),
+]
+
+CHAT_INDEXES = [
+    # The chats of a user, for joining rooms and search; the chat list itself reads the inbox.
+    # Not including last_updated keeps it untouched by message writes
+    IndexModel([("participants", ASCENDING)], name="participants"),
+    # Finds the chat of a participant set without comparing arrays, and allows only one chat per set
+    IndexModel([("participant_key", ASCENDING)], name="participant_key_unique", unique=True),
+]
+
+EXPORT_JOB_INDEXES = [
+    # Workers claim the oldest queued or abandoned job
+    IndexModel([("status", ASCENDING), ("created_at", ASCENDING)], name="status_created_at"),
+]
+
+COLLECTION_INDEXES = [
+    (user_collection, USER_INDEXES),
+    (chat_collection, CHAT_INDEXES),
+    (message_collection, MESSAGE_INDEXES),
+    (export_job_collection, EXPORT_JOB_INDEXES),
+    (inbox_collection, INBOX_INDEXES),
+    (message_archive_collection, ARCHIVE_INDEXES),
+]
+
+
+def participant_key(participants):
+    # Same key for the same set of participants, whatever their order or repetitions
+    return json.dumps(sorted(set(participants)), separators=(",", ":"))
+
+
+async def ensure_indexes():
+    for collection, indexes in COLLECTION_INDEXES:
+        try:
+            await collection.create_indexes(indexes)
+        except OperationFailure:
+            # Again one by one, to tell which index failed
+            for index in indexes:
+                try:
+                    await collection.create_indexes([index])
+                except OperationFailure as e:
+                    name = index.document["name"]
+                    if index.document.get("unique"):
+                        # Unique indexes are what keeps users and chats from being created twice, don't run without them
+                        raise RuntimeError(f"Creating the unique index {name} on {collection.name} failed, "
+                                           f"remove the duplicate documents and start again: {e}")
+                    # A plain index only costs speed
+                    print(f"Creating index {name} on {collection.name} failed: {e}")
+
+
+async def backfill_participant_keys():
+    # Chats created before participant_key existed
+    updated = 0
+    async for chat in chat_collection.find({"participant_key": {"$exists": False}}, {"participants": 1}):
+        await chat_collection.update_one(
+            {"_id": chat["_id"]},
+            {"$set": {"participant_key": participant_key(chat.get("participants", []))}},
+        )
+        updated += 1
+    if updated:
+        print(f"Added participant_key to {updated} chats")
+    return updated
+
+
+def hot_queries():
+    # (name, cursor) for every query on a request path, the values only need the right types
+    return [
+        ("users by username", user_collection.find({"username": "plan-check"})),
+        ("chat by participant set", chat_collection.find({"participant_key": participant_key(["plan-check"])})),
+        ("chat rooms of a user", chat_collection.find({"participants": "plan-check"}, {"_id": 1})),
+    ] + [
+        (f"chat list by {field}",
+         inbox_collection.find({"user": "plan-check"}).sort([(field, DESCENDING), ("chat_id", DESCENDING)]).limit(101))
+        for field in SORTABLE_CHAT_FIELDS
+    ] + [
+        ("chats updated since",
+         inbox_collection.find({"user": "plan-check", "changed_at": {"$gte": datetime.utcnow()}})
+         .sort([("changed_at", ASCENDING), ("chat_id", ASCENDING)]).limit(101)),
+        ("inbox rows of a chat", inbox_collection.find({"chat_id": "plan-check"})),
+        ("inbox row of a reader", inbox_collection.find({"user": "plan-check", "chat_id": "plan-check"})),
+        ("open message bucket",
+         message_collection.find({"chat_id": "plan-check", "count": {"$lt": 1}}).limit(1)),
+        ("message page",
+         message_collection.find({"chat_id": "plan-check"}).sort("start", DESCENDING).limit(1)),
+        ("message page after a cursor",
+         message_collection.find({"chat_id": "plan-check", "end": {"$gt": datetime.utcnow()}}).sort("start", ASCENDING).limit(1)),
+        ("messages after a seq",
+         message_collection.find({"chat_id": "plan-check", "last_seq": {"$gt": 0}}).sort("last_seq", ASCENDING)),
+        ("archived message page",
+         message_archive_collection.find({"chat_id": "plan-check"}).sort("start", DESCENDING).limit(1)),
+        ("archived messages after a cursor",
+         message_archive_collection.find({"chat_id": "plan-check", "end": {"$gt": datetime.utcnow()}}).sort("start", ASCENDING)),
+        ("buckets to archive",
+         message_collection.find({"chat_id": "plan-check", "end": {"$lt": datetime.utcnow()}, "count": {"$gte": 1}})
+         .sort("start", ASCENDING)),
+        ("export job claim",
+         export_job_collection.find({"status": "queued"}).sort("created_at", ASCENDING).limit(1)),
+    ]
+
+
+def plan_stages(plan):
+    # Every stage name in an explain() plan tree, classic and slot based engines nest them differently
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for value in plan.values():
+            yield from plan_stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from plan_stages(value)
+
+
+async def check_query_plans():
+    """Return the names of the hot queries whose winning plan contains a COLLSCAN."""
+    failures = []
+    for name, cursor in hot_queries():
+        explained = await cursor.explain()
+        winning_plan = explained.get("queryPlanner", {}).get("winningPlan", {})
+        if "COLLSCAN" in plan_stages(winning_plan):
+            failures.append(name)
+    return failures
+
+
+async def bootstrap():
+    # Keys first: the unique participant_key index cannot be built while existing chats lack one
+    await backfill_participant_keys()
+    await ensure_indexes()
+    # Before serving, so legacy chats never show an empty history; the inbox rebuild reads the moved messages
+    migrated = await migrate_embedded_messages()
+    if migrated["chats"]:
+        print(f"Moved {migrated['messages']} messages of {migrated['chats']} chats into the message store")
+    await backfill_inboxes()
+    if QUERY_PLAN_CHECK:
+        failures = await check_query_plans()
+        if failures:
+            raise RuntimeError(f"Queries without a usable index: {', '.join(failures)}")
+
+
+if __name__ == "__main__":
+    async def main():
+        await backfill_participant_keys()
+        await ensure_indexes()
+        if "--check-plans" in sys.argv:
+            failures = await check_query_plans()
+            for name in failures:
+                print(f"COLLSCAN: {name}")
+            print("Query plans OK" if not failures else f"{len(failures)} queries scan a whole collection")
+            return 1 if failures else 0
+        return 0
+
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,186 @@
+"""Write-behind persistence for incoming chat messages.
+
+The ``message`` socket handler fans a message out right away and hands it to
+``MessagePipeline``, which groups the messages of each chat and writes them
+with one bulk update per batch. A chat's batch is flushed once it holds
+``MESSAGE_BATCH_SIZE`` messages or its oldest message has waited
+``MESSAGE_FLUSH_INTERVAL_MS``. Batches of the same chat are written one after
+the other, so messages are stored in the order they arrived.
+
+``MESSAGE_DURABILITY`` decides when the sender gets its acknowledgement:
+``persist`` (default) waits for the batch to be written, ``enqueue`` answers as
+soon as the message is queued and trades durability on a crash for latency.
+
+``ReadReceiptBatcher`` does the same for ``read_message``: the reads within
+``READ_RECEIPT_INTERVAL_MS`` are written together, keeping the highest seq each
+reader has read, and a client sending the event over and over costs one write
+per interval. The seq is stored as a watermark with ``$max``, so it does not
+matter whether a read is written before or after the batch of messages it
+covers. ``DeliveryAckBatcher`` coalesces delivery acknowledgements the same
+way.
+"""
+import asyncio
+import os
+import time
+
+MESSAGE_BATCH_SIZE = int(os.getenv("MESSAGE_BATCH_SIZE", "100"))
+MESSAGE_FLUSH_INTERVAL_MS = int(os.getenv("MESSAGE_FLUSH_INTERVAL_MS", "50"))
+MESSAGE_DURABILITY = os.getenv("MESSAGE_DURABILITY", "persist")  # persist or enqueue
+READ_RECEIPT_INTERVAL_MS = int(os.getenv("READ_RECEIPT_INTERVAL_MS", "250"))
+
+
+class MessagePipeline:
+    def __init__(self, persist_batch, batch_size=MESSAGE_BATCH_SIZE,
+                 flush_interval=MESSAGE_FLUSH_INTERVAL_MS / 1000):
+        # persist_batch(chat_id, messages) writes one batch of a chat
+        self._persist_batch = persist_batch
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # chat_id -> (time the oldest message was queued, [(message, future), ...])
+        self._pending = {}
+        # chat_id -> the task writing that chat, at most one per chat keeps the order
+        self._flushing = {}
+        self._timer_task = None
+        self._stopping = False
+        self.persisted = 0
+        self.failed = 0
+
+    def start(self):
+        if self._timer_task is None:
+            self._timer_task = asyncio.create_task(self._flush_due_chats())
+
+    def depth(self):
+        # Messages queued but not written yet
+        return sum(len(entries) for _, entries in self._pending.values())
+
+    def submit(self, chat_id, message):
+        """Queue a message and return a future resolved once it is stored."""
+        future = asyncio.get_running_loop().create_future()
+        queued = self._pending.get(chat_id)
+        if queued is None:
+            queued = (time.monotonic(), [])
+            self._pending[chat_id] = queued
+        queued[1].append((message, future))
+
+        if len(queued[1]) >= self.batch_size:
+            self._schedule_flush(chat_id)
+        return future
+
+    def _schedule_flush(self, chat_id):
+        if chat_id not in self._flushing:
+            self._flushing[chat_id] = asyncio.create_task(self._flush_chat(chat_id))
+
+    async def _flush_chat(self, chat_id):
+        while True:
+            queued = self._pending.pop(chat_id, None)
+            if queued is None:
+                break
+            entries = queued[1]
+            try:
+                await self._persist_batch(chat_id, [message for message, _ in entries])
+            except Exception as e:
+                self.failed += len(entries)
+                print(f"Persisting {len(entries)} messages of chat {chat_id} failed: {e}")
+                for _, future in entries:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                self.persisted += len(entries)
+                for _, future in entries:
+                    if not future.done():
+                        future.set_result(True)
+
+            # Keep going while a full batch piled up during the write, the timer flushes the rest
+            queued = self._pending.get(chat_id)
+            if queued is None or (len(queued[1]) < self.batch_size and not self._stopping):
+                break
+        del self._flushing[chat_id]
+
+    async def _flush_due_chats(self):
+        while True:
+            await asyncio.sleep(self.flush_interval / 2)
+            deadline = time.monotonic() - self.flush_interval
+            for chat_id, (queued_at, _) in list(self._pending.items()):
+                if queued_at <= deadline:
+                    self._schedule_flush(chat_id)
+
+    async def stop(self):
+        # Write everything still queued, used on graceful shutdown
+        self._stopping = True
+        if self._timer_task is not None:
+            self._timer_task.cancel()
+            self._timer_task = None
+        while self._pending or self._flushing:
+            for chat_id in list(self._pending):
+                self._schedule_flush(chat_id)
+            await asyncio.gather(*self._flushing.values(), return_exceptions=True)
+
+    def stats(self):
+        return {
+            "queued": self.depth(),
+            "persisted": self.persisted,
+            "failed": self.failed,
+            "durability": MESSAGE_DURABILITY,
+        }
+
+
+class ReadReceiptBatcher:
+    name = "read receipts"
+
+    def __init__(self, write_batch, interval=READ_RECEIPT_INTERVAL_MS / 1000):
+        # write_batch({chat_id: {reader: highest seq read}}) moves the readers' read watermarks
+        self._write_batch = write_batch
+        self.interval = interval
+        self._pending = {}
+        self._timer_task = None
+        # The flush the timer is running, stop() waits for it instead of cancelling it halfway
+        self._timer_flush = None
+        self.received = 0
+        self.written = 0
+
+    def start(self):
+        if self._timer_task is None:
+            self._timer_task = asyncio.create_task(self._flush_periodically())
+
+    def depth(self):
+        return sum(len(readers) for readers in self._pending.values())
+
+    def submit(self, chat_id, user, seq):
+        # Repeated reads (or acks) of a chat by the same user collapse into the highest seq
+        seqs = self._pending.setdefault(chat_id, {})
+        if seq > seqs.get(user, -1):
+            seqs[user] = seq
+        self.received += 1
+
+    async def flush(self):
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        try:
+            await self._write_batch(pending)
+            self.written += sum(len(readers) for readers in pending.values())
+        except Exception as e:
+            print(f"Writing {self.name} of {len(pending)} chats failed: {e}")
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self._timer_flush = asyncio.ensure_future(self.flush())
+            await asyncio.shield(self._timer_flush)
+
+    async def stop(self):
+        if self._timer_task is not None:
+            self._timer_task.cancel()
+            self._timer_task = None
+        if self._timer_flush is not None:
+            await asyncio.gather(self._timer_flush, return_exceptions=True)
+            self._timer_flush = None
+        await self.flush()
+
+    def stats(self):
+        return {"queued": self.depth(), "received": self.received, "written": self.written}
+
+
+class DeliveryAckBatcher(ReadReceiptBatcher):
+    # write_batch({chat_id: {user: highest acknowledged seq}})
+    name = "delivery acks"
@@ -0,0 +1,410 @@
+"""Bucketed message storage.
+
+Messages used to be pushed into a ``messages`` array embedded in each chat
+document. They now live in the ``messages`` collection, grouped into buckets of
+at most ``MESSAGE_BUCKET_SIZE`` messages per chat:
+
+    {
+        "chat_id": "alice_bob",
+        "start": <datetime of the oldest message>,
+        "end": <datetime of the newest message>,
+        "count": 3,
+        "last_seq": <highest message seq>,
+        "messages": [{"content", "sender", "receiver", "time", "seq"}, ...]
+    }
+
+Buckets are numbered per chat, their ``_id`` is ``<chat_id>:<n>``. A chat has
+at most one open (not full) bucket: the next one is only started when none is
+open, and two writers starting it at the same time collide on the ``_id``.
+Buckets moved from the legacy embedded arrays are ``<chat_id>:legacy-<n>``
+instead, so the migration never writes over a bucket the app started.
+
+Reading a page only touches the few buckets around the cursor, so the cost of a
+history request depends on the page size and not on the length of the chat.
+Pages are cut at a message key, (time, seq) or for messages stored before seqs
+existed (time, bucket, slot), so messages sharing a time are never skipped.
+
+Old full buckets are moved to the ``message_archive`` collection by the
+compaction job (see ``retention.py``), with the same fields except that the
+messages are a zlib compressed BSON blob in ``data``. They are always the
+oldest buckets of their chat, so the readers below walk the live buckets and
+the archive as one sequence.
+"""
+import asyncio
+import base64
+import binascii
+import heapq
+import json
+import os
+import zlib
+from datetime import datetime
+
+import bson
+from dateutil import parser
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import DuplicateKeyError
+
+from db import chat_collection, message_archive_collection, message_collection
+from models import format_message_time, naive_utc
+
+MESSAGE_BUCKET_SIZE = int(os.getenv("MESSAGE_BUCKET_SIZE", "200"))
+ARCHIVE_COMPRESSION_LEVEL = int(os.getenv("ARCHIVE_COMPRESSION_LEVEL", "6"))
+
+MESSAGE_INDEXES = [
+    # Page reads walk the buckets of one chat in time order
+    IndexModel([("chat_id", ASCENDING), ("start", DESCENDING)], name="chat_id_start"),
+    IndexModel([("chat_id", ASCENDING), ("end", DESCENDING)], name="chat_id_end"),
+    # Lets append_messages find the open (not yet full) bucket of a chat directly
+    IndexModel([("chat_id", ASCENDING), ("count", ASCENDING)], name="chat_id_count"),
+    # Catch-up reads find the buckets holding messages after a sequence number
+    IndexModel([("chat_id", ASCENDING), ("last_seq", ASCENDING)], name="chat_id_last_seq"),
+]
+
+# The archive is read with the same queries
+ARCHIVE_INDEXES = [
+    IndexModel([("chat_id", ASCENDING), ("start", DESCENDING)], name="chat_id_start"),
+    IndexModel([("chat_id", ASCENDING), ("end", DESCENDING)], name="chat_id_end"),
+    IndexModel([("chat_id", ASCENDING), ("last_seq", ASCENDING)], name="chat_id_last_seq"),
+]
+
+
+def parse_message_time(value):
+    # Message times are stored as naive UTC datetimes, older messages as ISO strings ending in 'Z'
+    if isinstance(value, datetime):
+        return naive_utc(value)
+    try:
+        # The common 'YYYY-MM-DDTHH:MM:SS.fffZ' form, without the cost of dateutil
+        if value.endswith("Z"):
+            return datetime.fromisoformat(value[:-1])
+    except ValueError:
+        pass
+    return naive_utc(parser.isoparse(value))
+
+
+async def ensure_message_indexes():
+    await message_collection.create_indexes(MESSAGE_INDEXES)
+
+
+async def append_messages(chat_id, messages):
+    times = [parse_message_time(message["time"]) for message in messages]
+    newest = {"end": max(times)}
+    seqs = [message["seq"] for message in messages if message.get("seq") is not None]
+    if seqs:
+        newest["last_seq"] = max(seqs)
+    while True:
+        # Push into the open bucket of the chat.
+        # A batch always lands in a single bucket, which may then go slightly over the size.
+        result = await message_collection.update_one(
+            {"chat_id": chat_id, "count": {"$lt": MESSAGE_BUCKET_SIZE}},
+            {
+                "$push": {"messages": {"$each": messages}},
+                "$inc": {"count": len(messages)},
+                "$min": {"start": min(times)},
+                "$max": newest,
+            },
+        )
+        if result.matched_count:
+            return
+        if await _start_bucket(chat_id, dict(newest, start=min(times), count=len(messages), messages=messages)):
+            return
+
+
+async def _start_bucket(chat_id, bucket):
+    # Insert the next numbered bucket of a chat, False when another writer took the number first
+    chat = await chat_collection.find_one({"_id": chat_id}, {"next_bucket": 1})
+    if chat is None:
+        raise ValueError(f"Chat {chat_id} does not exist")
+    number = chat.get("next_bucket", 0)
+    bucket_id = f"{chat_id}:{number}"
+    created = False
+    # An archived bucket keeps its _id, so its number is not used again
+    if await message_archive_collection.find_one({"_id": bucket_id}, {"_id": 1}) is None:
+        try:
+            await message_collection.insert_one(dict(bucket, _id=bucket_id, chat_id=chat_id))
+            created = True
+        except DuplicateKeyError:
+            # Started by another writer, the caller pushes into it on its next try
+            pass
+    await chat_collection.update_one({"_id": chat_id}, {"$max": {"next_bucket": number + 1}})
+    return created
+
+
+async def append_message(chat_id, message):
+    await append_messages(chat_id, [message])
+
+
+def sortable_time(value):
+    # Fixed width ISO text, compares like the datetime it came from
+    return value.isoformat(timespec="microseconds")
+
+
+def bucket_rank(bucket_id):
+    # Numbered buckets sort by number, migrated and older buckets before them by their _id
+    if isinstance(bucket_id, str):
+        prefix, _, number = bucket_id.rpartition(":")
+        if prefix and number.isdigit():
+            return int(number), ""
+    return -1, str(bucket_id)
+
+
+def message_key(time, seq, bucket_id=None, index=0):
+    """Position of a message in its chat, unique and ordered by time.
+
+    Messages sharing a time are ordered by seq, and the ones stored before
+    seqs existed by their bucket and slot in it.
+    """
+    if seq is not None:
+        return (sortable_time(time), 1, seq)
+    number, name = bucket_rank(bucket_id)
+    return (sortable_time(time), 0, number, name, index)
+
+
+def keyed_messages(bucket):
+    # (key, message) of every message of a bucket
+    for index, message in enumerate(bucket["messages"]):
+        try:
+            message_time = parse_message_time(message["time"])
+        except (KeyError, TypeError, ValueError):
+            # A broken time sorts with the start of its bucket
+            message_time = bucket["start"]
+        yield message_key(message_time, message.get("seq"), bucket["_id"], index), message
+
+
+def key_time(key):
+    return datetime.fromisoformat(key[0])
+
+
+def _is_key(key):
+    if len(key) == 3:
+        return key[1] == 1 and isinstance(key[2], int)
+    if len(key) == 5:
+        return key[1] == 0 and isinstance(key[2], int) and isinstance(key[3], str) and isinstance(key[4], int)
+    return False
+
+
+def encode_message_cursor(key):
+    # Opaque continuation token: the key of the first or last message of a page
+    return base64.urlsafe_b64encode(json.dumps(key, separators=(",", ":")).encode("utf-8")).decode("ascii")
+
+
+def decode_message_cursor(cursor, side):
+    """Key of a next_before / next_after cursor, ``side`` is "before" or "after".
+
+    A plain message time, as clients sent before the cursors, still works:
+    before it means before every message of that time, after it after all of
+    them. Raises ValueError for anything else.
+    """
+    try:
+        key = tuple(json.loads(base64.urlsafe_b64decode(cursor.encode("ascii"))))
+        if isinstance(key[0], str) and _is_key(key):
+            key_time(key)
+            return key
+    except (ValueError, TypeError, IndexError, binascii.Error):
+        pass
+    text = sortable_time(parse_message_time(cursor))
+    return (text,) if side == "before" else (text, 2)
+
+
+def compress_messages(messages):
+    # BSON keeps the datetimes that JSON would turn into strings
+    return zlib.compress(bson.encode({"messages": messages}), ARCHIVE_COMPRESSION_LEVEL)
+
+
+def archived_messages(segment):
+    return bson.decode(zlib.decompress(segment["data"]))["messages"]
+
+
+async def iter_buckets(query, sort_field, direction, projection=None, batch_size=None):
+    """Yield the live and archived buckets matching ``query``, ordered by ``sort_field``.
+
+    Archived buckets come first when walking forward and last when walking
+    back, with their messages decompressed. A bucket found in both places (the
+    compaction stopped between copying and deleting it) is yielded once.
+    """
+    seen = set()
+    sources = [(message_archive_collection, None), (message_collection, projection)]
+    if direction == DESCENDING:
+        sources.reverse()
+    for collection, fields in sources:
+        cursor = collection.find(query, fields).sort(sort_field, direction)
+        if batch_size is not None:
+            cursor = cursor.batch_size(batch_size)
+        async for bucket in cursor:
+            if bucket["_id"] in seen:
+                continue
+            seen.add(bucket["_id"])
+            if "data" in bucket:
+                bucket["messages"] = archived_messages(bucket)
+            yield bucket
+
+
+def to_wire(messages):
+    # Clients get every message time as an ISO string, whichever way it is stored
+    for message in messages:
+        message["time"] = format_message_time(message.get("time"))
+    return messages
+
+
+async def get_message_page(chat_id, limit, before=None, after=None):
+    """Return up to ``limit`` (key, message) pairs of a chat in chronological order.
+
+    Without cursors the newest page is returned. ``before`` returns the newest
+    messages whose key is below the given key, ``after`` the oldest ones above
+    it (used to catch up); both can be combined to read a window.
+    """
+    def in_range(bucket):
+        for key, message in keyed_messages(bucket):
+            if (before is None or key < before) and (after is None or key > after):
+                yield key, message
+
+    def by_key(pair):
+        return pair[0]
+
+    query = {"chat_id": chat_id}
+    if before is not None:
+        query["start"] = {"$lte": key_time(before)}
+    if after is not None:
+        query["end"] = {"$gte": key_time(after)}
+
+    # Buckets written by several workers can overlap a little in time, so a walk
+    # only stops at a bucket that cannot hold any message of the page
+    page = []
+    if after is not None and before is None:
+        # Walk forward from the cursor, by start: later buckets start later
+        async for bucket in iter_buckets(query, "start", ASCENDING):
+            if len(page) >= limit and sortable_time(bucket["start"]) > page[-1][0][0]:
+                break
+            page.extend(in_range(bucket))
+            page.sort(key=by_key)
+            del page[limit:]
+    else:
+        # Walk backwards from the newest bucket (or the cursor), by end: earlier buckets end earlier
+        async for bucket in iter_buckets(query, "end", DESCENDING):
+            if len(page) >= limit and sortable_time(bucket["end"]) < page[0][0][0]:
+                break
+            page.extend(in_range(bucket))
+            page.sort(key=by_key)
+            del page[:-limit]
+    to_wire([message for _, message in page])
+    return page
+
+
+async def get_messages_after_seq(chat_id, after_seq, before_seq=None, limit=500):
+    """Return up to ``limit`` messages with ``after_seq < seq < before_seq``, in seq order.
+
+    Only the buckets whose newest message is past ``after_seq`` are read, the
+    cost follows the number of messages returned and not the chat's length.
+    """
+    query = {"chat_id": chat_id, "last_seq": {"$gt": after_seq}}
+    page = []
+    async for bucket in iter_buckets(query, "last_seq", ASCENDING):
+        for message in bucket["messages"]:
+            seq = message.get("seq")
+            if seq is not None and seq > after_seq and (before_seq is None or seq < before_seq):
+                page.append(message)
+        if len(page) >= limit:
+            break
+        if before_seq is not None and bucket["last_seq"] >= before_seq:
+            break
+    page.sort(key=lambda message: message["seq"])
+    return to_wire(page[:limit])
+
+
+async def iter_messages(chat_id, batch_size=8, since=None, until=None):
+    """Yield the messages of a chat, oldest first, holding only a few buckets in memory at a time.
+
+    ``since`` and ``until`` (naive UTC datetimes) limit the messages to a time range.
+    """
+    query = {"chat_id": chat_id}
+    if since is not None:
+        query["end"] = {"$gte": since}
+    if until is not None:
+        query["start"] = {"$lte": until}
+
+    # (key, arrival, message) heap; buckets can overlap a little, a message waits here until no later bucket can precede it
+    pending = []
+    arrival = 0
+    async for bucket in iter_buckets(query, "start", ASCENDING, {"messages": 1, "start": 1}, batch_size):
+        boundary = sortable_time(bucket["start"])
+        while pending and pending[0][0][0] < boundary:
+            yield heapq.heappop(pending)[2]
+        for key, message in keyed_messages(bucket):
+            if since is not None or until is not None:
+                try:
+                    message_time = parse_message_time(message["time"])
+                except (KeyError, TypeError, ValueError):
+                    continue
+                if (since is not None and message_time < since) or (until is not None and message_time > until):
+                    continue
+            heapq.heappush(pending, (key, arrival, message))
+            arrival += 1
+    while pending:
+        yield heapq.heappop(pending)[2]
+
+
+async def migrate_embedded_messages():
+    """Move the legacy embedded ``messages`` arrays into the bucketed store.
+
+    Each chat is read ``MESSAGE_BUCKET_SIZE`` messages at a time with a
+    ``$slice`` projection, so the full array is never loaded at once. Migrated
+    buckets get a deterministic ``_id`` of their own, ``<chat_id>:legacy-<n>``,
+    which makes the routine safe to re-run after an interruption and keeps it
+    off the numbered buckets the app writes new messages to meanwhile. Runs on
+    startup, before the app serves requests.
+    """
+    migrated_chats = 0
+    migrated_messages = 0
+
+    async for chat in chat_collection.find({"messages": {"$exists": True}}, {"_id": 1}):
+        chat_id = chat["_id"]
+        offset = 0
+        bucket_index = 0
+        last_time = datetime.min
+        while True:
+            chunk = await chat_collection.find_one(
+                {"_id": chat_id},
+                {"_id": 1, "messages": {"$slice": [offset, MESSAGE_BUCKET_SIZE]}},
+            )
+            messages = (chunk or {}).get("messages", [])
+            if not messages:
+                break
+
+            times = []
+            for message in messages:
+                try:
+                    times.append(parse_message_time(message["time"]))
+                except (KeyError, TypeError, ValueError):
+                    # Keep messages with a broken time next to their neighbours
+                    times.append(times[-1] if times else last_time)
+            last_time = max(times)
+
+            # Zero padded, so the buckets of a chat sort by number
+            await message_collection.replace_one(
+                {"_id": f"{chat_id}:legacy-{bucket_index:06d}"},
+                {
+                    "chat_id": chat_id,
+                    "start": min(times),
+                    "end": last_time,
+                    "count": len(messages),
+                    "messages": messages,
+                },
+                upsert=True,
+            )
+            bucket_index += 1
+            offset += len(messages)
+            migrated_messages += len(messages)
+
+        await chat_collection.update_one({"_id": chat_id}, {"$unset": {"messages": ""}})
+        migrated_chats += 1
+
+    return {"chats": migrated_chats, "messages": migrated_messages}
+
+
+# Startup runs it too (see indexes.bootstrap), by hand: python message_store.py
+if __name__ == "__main__":
+    async def main():
+        await ensure_message_indexes()
+        result = await migrate_embedded_messages()
+        print(f"Migrated {result['messages']} messages from {result['chats']} chats")
+
+    asyncio.run(main())
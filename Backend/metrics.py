@@ -0,0 +1,290 @@
+"""Prometheus style metrics.
+
+Counters, gauges and histograms live in plain dicts keyed by label values.
+Recording a value costs a dict lookup and an addition, and nothing is
+formatted until ``/metrics`` is scraped, so an unscraped worker pays close to
+nothing. ``METRICS_ENABLED=false`` turns the HTTP, socket and database
+instrumentation off entirely.
+
+What is measured:
+  * HTTP latency and status per route (``MetricsMiddleware``)
+  * Socket.IO events and handler latency (``InstrumentedServer``)
+  * MongoDB operation latency per collection (``InstrumentedCollection``)
+  * bcrypt time, connected sockets and message fan-out sizes, recorded where
+    they happen
+
+Messages themselves are logged through ``log_message``, which writes one JSON
+line for a ``MESSAGE_LOG_SAMPLE_RATE`` fraction of them (0, the default, logs
+none).
+"""
+import bisect
+import json
+import logging
+import os
+import random
+import time
+
+import socketio
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+MESSAGE_LOG_SAMPLE_RATE = float(os.getenv("MESSAGE_LOG_SAMPLE_RATE", "0"))
+
+# Seconds, from a cached read to a slow bcrypt call
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+
+REGISTRY = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # label values tuple -> value
+        self._values = {}
+        REGISTRY.append(self)
+
+    def samples(self):
+        # (name suffix, label names, label values, value)
+        for labels, value in self._values.items():
+            yield "", self.labelnames, labels, value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, names, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(names, labels)} {value}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        # Read at scrape time, for values the app already keeps somewhere
+        self.function = function
+
+    def set(self, value, *labels):
+        self._values[labels] = value
+
+    def samples(self):
+        if self.function is not None:
+            yield "", (), (), self.function()
+        else:
+            yield from super().samples()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        state = self._values.get(labels)
+        if state is None:
+            # [count per bucket, the last one is +Inf], sum
+            state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+
+    def samples(self):
+        names = self.labelnames + ("le",)
+        for labels, (counts, total) in list(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                yield "_bucket", names, labels + (bound,), cumulative
+            yield "_sum", self.labelnames, labels, total
+            yield "_count", self.labelnames, labels, cumulative
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+http_requests = Counter("http_requests_total", "HTTP requests", ("method", "route", "status"))
+http_request_duration = Histogram("http_request_duration_seconds", "HTTP request latency until the response is sent", ("method", "route"))
+socket_events = Counter("socketio_events_total", "Socket.IO events received", ("event",))
+socket_event_duration = Histogram("socketio_event_duration_seconds", "Socket.IO handler latency", ("event",))
+socket_fanout = Histogram("socketio_fanout_sockets", "Sockets of this worker a chat message is emitted to", buckets=SIZE_BUCKETS)
+mongo_operation_duration = Histogram("mongo_operation_duration_seconds", "MongoDB operation latency", ("collection", "operation"))
+password_hash_duration = Histogram("password_hash_duration_seconds", "bcrypt time including the wait for a pool worker", ("operation",))
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording latency and status of every HTTP request."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not METRICS_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # The route template, not the path, keeps the number of label values bounded
+            route = getattr(scope.get("route"), "path", "unmatched")
+            http_request_duration.observe(time.perf_counter() - started, scope["method"], route)
+            http_requests.inc(scope["method"], route, str(status_code))
+
+
+class InstrumentedServer(socketio.AsyncServer):
+    """AsyncServer counting events and timing their handlers."""
+
+    async def _trigger_event(self, event, namespace, *args):
+        if not METRICS_ENABLED:
+            return await super()._trigger_event(event, namespace, *args)
+
+        started = time.perf_counter()
+        try:
+            return await super()._trigger_event(event, namespace, *args)
+        finally:
+            # Clients choose event names, only the handled ones get their own label
+            handled = event in self.handlers.get(namespace, {}) or event in self.reserved_events
+            label = event if handled else "unhandled"
+            socket_events.inc(label)
+            socket_event_duration.observe(time.perf_counter() - started, label)
+
+
+# Collection methods returning a coroutine, timed as one operation
+TIMED_OPERATIONS = {
+    "find_one", "insert_one", "insert_many", "update_one", "update_many", "delete_one", "delete_many",
+    "replace_one", "bulk_write", "count_documents", "estimated_document_count", "distinct",
+    "find_one_and_update", "find_one_and_delete", "find_one_and_replace", "create_indexes", "drop",
+}
+# Collection methods returning a cursor, timed while the cursor is read
+CURSOR_OPERATIONS = {"find", "aggregate"}
+
+
+class InstrumentedCursor:
+    """Wraps a Motor cursor and records the time spent waiting for the database."""
+
+    def __init__(self, cursor, collection_name, operation):
+        self._cursor = cursor
+        self._collection_name = collection_name
+        self._operation = operation
+        self._waited = 0.0
+        self._recorded = False
+
+    def __getattr__(self, name):
+        attribute = getattr(self._cursor, name)
+        if name in ("sort", "skip", "limit", "batch_size", "hint", "max_time_ms"):
+            # Builder methods return the cursor itself, keep returning the wrapper
+            def chain(*args, **kwargs):
+                attribute(*args, **kwargs)
+                return self
+            return chain
+        return attribute
+
+    def _record(self):
+        if not self._recorded:
+            self._recorded = True
+            mongo_operation_duration.observe(self._waited, self._collection_name, self._operation)
+
+    async def to_list(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await self._cursor.to_list(*args, **kwargs)
+        finally:
+            self._waited += time.perf_counter() - started
+            self._record()
+
+    def __aiter__(self):
+        self._iterator = self._cursor.__aiter__()
+        return self
+
+    async def __anext__(self):
+        started = time.perf_counter()
+        try:
+            document = await self._iterator.__anext__()
+        except StopAsyncIteration:
+            self._waited += time.perf_counter() - started
+            self._record()
+            raise
+        self._waited += time.perf_counter() - started
+        return document
+
+    def __del__(self):
+        # Loops that break early never reach StopAsyncIteration
+        if self._waited:
+            self._record()
+
+
+class InstrumentedCollection:
+    """Motor collection proxy timing every database call made through it."""
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    def __getattr__(self, name):
+        attribute = getattr(self._collection, name)
+        if not METRICS_ENABLED:
+            return attribute
+
+        collection_name = self._collection.name
+        if name in TIMED_OPERATIONS:
+            async def timed(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await attribute(*args, **kwargs)
+                finally:
+                    mongo_operation_duration.observe(time.perf_counter() - started, collection_name, name)
+            return timed
+        if name in CURSOR_OPERATIONS:
+            def cursor(*args, **kwargs):
+                return InstrumentedCursor(attribute(*args, **kwargs), collection_name, name)
+            return cursor
+        return attribute
+
+
+message_logger = logging.getLogger("chatapp.messages")
+if not message_logger.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    message_logger.addHandler(_handler)
+    message_logger.setLevel(logging.INFO)
+    message_logger.propagate = False
+
+
+def log_message(event, **fields):
+    # Logs a sampled fraction of the calls as one JSON object per line
+    if MESSAGE_LOG_SAMPLE_RATE <= 0 or random.random() >= MESSAGE_LOG_SAMPLE_RATE:
+        return
+    message_logger.info(json.dumps(dict(fields, event=event, ts=time.time()), default=str))
@@ -1,5 +1,6 @@
 from pydantic import BaseModel, Field
 from typing import List,Optional
+from datetime import datetime, timezone
 
 class ChatCreate(BaseModel):
     participants: List[str]
@@ -8,6 +9,18 @@ class Chat(BaseModel):
     chat_id: str
     participants: List[str]
 
+# Bulk export job request, every filter is optional
+class ExportJobCreate(BaseModel):
+    username: Optional[str] = Field(None, example="alice")  # Only chats this user takes part in
+    since: Optional[datetime] = Field(None, example="2024-01-01T00:00:00Z")  # Only messages sent after this time
+    until: Optional[datetime] = Field(None, example="2024-12-31T23:59:59Z")  # Only messages sent before this time
+    format: str = Field("txt", example="txt")  # txt, ndjson or csv
+
+class RetentionPolicy(BaseModel):
+    # Days after which a chat's messages are compressed into the archive, or deleted; None uses the global setting, 0 never
+    archive_after_days: Optional[int] = Field(None, ge=0, example=30)
+    delete_after_days: Optional[int] = Field(None, ge=0, example=365)
+
 class Message(BaseModel):
     sender: str
     content: str
@@ -33,4 +46,50 @@ class UserUpdateModel(BaseModel):
                 "about_me": "Updated about me section.",
                 "timezone": "PST",
             }
-        }
\ No newline at end of file
+        }
+
+def naive_utc(value):
+    # Dates are stored as naive UTC; an aware datetime is converted to UTC first, not just stripped of its offset
+    if value is not None and value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+def format_message_time(value):
+    # Wire format of message times: ISO 8601 UTC with milliseconds, e.g. 2024-05-01T10:00:00.123Z
+    if isinstance(value, datetime):
+        return value.isoformat(timespec="milliseconds") + "Z"
+    return value
+
+# Internal message representation, from the socket handler through the write pipeline and fan-out
+class ChatMessage:
+    # __slots__ keeps the messages waiting in the pipeline and the tail cache small
+    __slots__ = ("chat_id", "sender", "receiver", "content", "time", "seq", "time_text")
+
+    def __init__(self, chat_id: str, sender: str, receiver: List[str], content: str, time: datetime,
+                 seq: Optional[int] = None):
+        self.chat_id = chat_id
+        self.sender = sender
+        self.receiver = receiver
+        self.content = content
+        self.time = time  # naive UTC, stored natively by MongoDB
+        self.seq = seq  # position in the chat, assigned at ingest
+        self.time_text = format_message_time(time)  # wire format, computed once
+
+    def __repr__(self):
+        return f"ChatMessage(chat_id={self.chat_id!r}, sender={self.sender!r}, seq={self.seq!r}, time={self.time_text!r})"
+
+    @classmethod
+    def create(cls, chat_id, sender, receiver, content, seq=None):
+        now = datetime.utcnow()
+        # MongoDB keeps milliseconds, drop the rest so the stored and the sent time are the same
+        return cls(chat_id, sender, receiver, content, now.replace(microsecond=now.microsecond // 1000 * 1000), seq)
+
+    def to_document(self):
+        # Entry of a message bucket
+        return {"content": self.content, "sender": self.sender, "receiver": self.receiver, "time": self.time,
+                "seq": self.seq}
+
+    def to_payload(self):
+        # new_message event sent to the chat participants
+        return {"content": self.content, "sender": self.sender, "receiver": self.receiver,
+                "time": self.time_text, "chat_id": self.chat_id, "seq": self.seq}
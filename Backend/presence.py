@@ -0,0 +1,92 @@
+"""In-memory registry of connected Socket.IO sessions.
+
+Keeps two indexes, sid -> username and username -> sids, so connecting,
+disconnecting and looking up a user or a session are all O(1). A user can have
+several sessions (tabs, the chat list and chat detail sockets, ...) and only
+counts as gone once the last one disconnects.
+
+When several workers share a message queue the registry also holds the
+sessions of the other workers, each tagged with the host that owns it (see
+socket_bus.py).
+"""
+from itertools import islice
+
+
+class PresenceRegistry:
+    def __init__(self):
+        self._user_by_sid = {}
+        # Insertion ordered, so snapshots page through users in the order they came online
+        self._sids_by_user = {}
+        self._sids_by_host = {}
+        self._host_by_sid = {}
+
+    def add(self, username, sid, host=None):
+        """Register a session. Returns True if it is the user's first session."""
+        previous = self._user_by_sid.get(sid)
+        if previous == username:
+            return False
+        if previous is not None:
+            self.remove(sid)
+
+        self._user_by_sid[sid] = username
+        if host is not None:
+            self._host_by_sid[sid] = host
+            self._sids_by_host.setdefault(host, set()).add(sid)
+
+        sids = self._sids_by_user.get(username)
+        if sids is None:
+            self._sids_by_user[username] = {sid}
+            return True
+        sids.add(sid)
+        return False
+
+    def remove(self, sid):
+        """Unregister a session.
+
+        Returns ``(username, last_session)``; ``username`` is None when the sid
+        was not registered.
+        """
+        username = self._user_by_sid.pop(sid, None)
+        if username is None:
+            return None, False
+
+        host = self._host_by_sid.pop(sid, None)
+        if host is not None:
+            host_sids = self._sids_by_host[host]
+            host_sids.discard(sid)
+            if not host_sids:
+                del self._sids_by_host[host]
+
+        sids = self._sids_by_user[username]
+        sids.discard(sid)
+        if not sids:
+            del self._sids_by_user[username]
+            return username, True
+        return username, False
+
+    def drop_host(self, host):
+        # Forget every session owned by a worker that went away
+        for sid in list(self._sids_by_host.get(host, ())):
+            self.remove(sid)
+
+    def host_sessions(self, host):
+        return [(self._user_by_sid[sid], sid) for sid in self._sids_by_host.get(host, ())]
+
+    def get_user(self, sid):
+        return self._user_by_sid.get(sid)
+
+    def get_sids(self, username):
+        return set(self._sids_by_user.get(username, ()))
+
+    def is_online(self, username):
+        return username in self._sids_by_user
+
+    def count(self):
+        # Number of distinct users with at least one session
+        return len(self._sids_by_user)
+
+    def session_count(self):
+        return len(self._user_by_sid)
+
+    def snapshot(self, skip=0, limit=100):
+        return list(islice(self._sids_by_user, skip, skip + limit))
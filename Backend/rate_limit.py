@@ -0,0 +1,161 @@
+"""Rate limits and outbound backpressure.
+
+Token buckets limit how fast a client can make the server work:
+  * every Socket.IO event of a socket (``SOCKET_EVENT_RATE``), checked by
+    ``LimitedServer`` before the handler runs
+  * ``message`` events of a user across all of their sockets
+    (``MESSAGE_RATE``), checked by the handler
+  * authenticated REST requests of a user (``REST_RATE``), answered with 429
+
+A bucket holds up to ``*_BURST`` tokens and refills at ``*_RATE`` tokens per
+second, so short bursts pass and a steady flood is cut to the rate.
+
+Packets waiting to be written to a socket are bounded too. Once a socket has
+``OUTBOUND_QUEUE_LIMIT`` packets queued, a client that reads too slowly either
+misses the new events (``SLOW_CONSUMER_POLICY=drop``) or is disconnected
+(``disconnect``) and reloads its state when it reconnects.
+"""
+import math
+import os
+import time
+from collections import OrderedDict
+
+from socketio import packet
+
+from metrics import Counter, InstrumentedServer
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
+SOCKET_EVENT_RATE = float(os.getenv("SOCKET_EVENT_RATE", "20"))
+SOCKET_EVENT_BURST = int(os.getenv("SOCKET_EVENT_BURST", "40"))
+MESSAGE_RATE = float(os.getenv("MESSAGE_RATE", "5"))
+MESSAGE_BURST = int(os.getenv("MESSAGE_BURST", "20"))
+REST_RATE = float(os.getenv("REST_RATE", "20"))
+REST_BURST = int(os.getenv("REST_BURST", "60"))
+OUTBOUND_QUEUE_LIMIT = int(os.getenv("OUTBOUND_QUEUE_LIMIT", "1000"))
+SLOW_CONSUMER_POLICY = os.getenv("SLOW_CONSUMER_POLICY", "drop")  # drop or disconnect
+
+# Buckets kept per limiter, the least recently used key starts over with a full bucket beyond that
+MAX_TRACKED_KEYS = 100000
+
+rate_limited = Counter("rate_limited_total", "Requests and events refused by a rate limit", ("limit",))
+slow_consumers = Counter("socketio_slow_consumer_total", "Packets dropped or sockets disconnected for reading too slowly", ("action",))
+
+
+class RateLimiter:
+    """Token buckets keyed by user or socket."""
+
+    def __init__(self, name, rate, burst, max_keys=MAX_TRACKED_KEYS, enabled=RATE_LIMIT_ENABLED):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.enabled = enabled
+        # key -> [tokens, time of the last refill]
+        self._buckets = OrderedDict()
+        self.limited = 0
+
+    def retry_after(self, key, cost=1):
+        """Take ``cost`` tokens from the bucket of ``key``; 0 if allowed, else the seconds until it would be."""
+        if not self.enabled:
+            return 0
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = [self.burst, now]
+            self._buckets[key] = bucket
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+
+        if bucket[0] >= cost:
+            bucket[0] -= cost
+            return 0
+        self.limited += 1
+        rate_limited.inc(self.name)
+        return (cost - bucket[0]) / self.rate
+
+    def forget(self, key):
+        self._buckets.pop(key, None)
+
+    def stats(self):
+        return {"rate": self.rate, "burst": self.burst, "tracked": len(self._buckets), "limited": self.limited}
+
+
+def retry_after_header(seconds):
+    # Retry-After takes whole seconds
+    return str(max(1, math.ceil(seconds)))
+
+
+class LimitedServer(InstrumentedServer):
+    """InstrumentedServer applying the per-socket event limit and bounding outbound queues."""
+
+    def __init__(self, *args, event_limiter=None, outbound_limit=OUTBOUND_QUEUE_LIMIT,
+                 slow_consumer_policy=SLOW_CONSUMER_POLICY, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.event_limiter = event_limiter or RateLimiter("socket_event", SOCKET_EVENT_RATE, SOCKET_EVENT_BURST)
+        self.outbound_limit = outbound_limit
+        self.slow_consumer_policy = slow_consumer_policy
+        self.dropped_packets = 0
+        self.slow_disconnects = 0
+
+    async def _trigger_event(self, event, namespace, *args):
+        if event in self.reserved_events:
+            if event == "disconnect":
+                self.event_limiter.forget(args[0])
+            return await super()._trigger_event(event, namespace, *args)
+
+        retry_after = self.event_limiter.retry_after(args[0])
+        if retry_after:
+            # Sent as the acknowledgement when the client asked for one, the handler does not run
+            return {"status": "rate_limited", "retry_after": round(retry_after, 3)}
+        return await super()._trigger_event(event, namespace, *args)
+
+    def _accepts(self, eio_sid):
+        # False when the socket is too far behind to be sent another event
+        socket = self.eio.sockets.get(eio_sid)
+        if socket is None or socket.queue.qsize() < self.outbound_limit:
+            return True
+        if self.slow_consumer_policy == "disconnect":
+            if not socket.closing:
+                self.slow_disconnects += 1
+                slow_consumers.inc("disconnect")
+                self.start_background_task(self._disconnect_slow_consumer, eio_sid, socket)
+        else:
+            self.dropped_packets += 1
+            slow_consumers.inc("drop")
+        return False
+
+    async def _disconnect_slow_consumer(self, eio_sid, socket):
+        # Throw away what the client did not read, so the close packet is next instead of last
+        while not socket.queue.empty():
+            socket.queue.get_nowait()
+            socket.queue.task_done()
+        await socket.close(wait=False, reason=self.eio.reason.SERVER_DISCONNECT)
+        self.eio.sockets.pop(eio_sid, None)
+
+    async def _send_packet(self, eio_sid, pkt):
+        # Acknowledgements and connection packets always go out, only events are refused
+        if pkt.packet_type in (packet.EVENT, packet.BINARY_EVENT) and not self._accepts(eio_sid):
+            return
+        await super()._send_packet(eio_sid, pkt)
+
+    async def _send_eio_packet(self, eio_sid, eio_pkt):
+        # Used for broadcasts, which only carry events
+        if not self._accepts(eio_sid):
+            return
+        await super()._send_eio_packet(eio_sid, eio_pkt)
+
+    def backpressure_stats(self):
+        return {
+            "outbound_limit": self.outbound_limit,
+            "policy": self.slow_consumer_policy,
+            "dropped_packets": self.dropped_packets,
+            "slow_disconnects": self.slow_disconnects,
+        }
+
+
+message_limiter = RateLimiter("message", MESSAGE_RATE, MESSAGE_BURST)
+rest_limiter = RateLimiter("rest", REST_RATE, REST_BURST)
@@ -0,0 +1,213 @@
+"""Message sequence numbers and catch-up replay.
+
+Every message gets the next sequence number of its chat before it is fanned
+out. A client remembers the highest ``seq`` it saw per chat and, when its socket
+reconnects, sends them in the ``resume`` map of ``user_connected`` or
+``join_rooms``. The acknowledgement then replays only the messages it missed.
+
+Sequence numbers come from a counter on the chat document (``seq``). A worker
+reserves ``SEQ_BLOCK_SIZE`` of them with one atomic ``$inc`` and hands them out
+from memory, so numbers grow with every message but skip the unused rest of a
+block after a restart. The chat's participants come with the block, the
+receivers of its messages. With several workers each message takes its own number
+(block size 1), so numbers follow the order in which messages reached the
+database counter, whichever worker they arrived at.
+
+Missed messages are looked up in a per-chat ring of the last
+``REPLAY_LOG_SIZE`` messages this worker fanned out, and in the message store
+for anything older. Past ``REPLAY_MAX_MESSAGES`` the client is told to reload
+the chat instead.
+
+With several workers the log is off, and a message another worker fanned out
+may still wait in its write pipeline, while a later one from a third worker is
+stored already. Numbers are then taken one at a time, so the chat's counter is
+the newest number handed out; replay reads the store again until it holds every
+number up to it, for at most ``REPLAY_STORE_WAIT`` seconds.
+"""
+import asyncio
+import os
+from collections import OrderedDict, deque
+
+from pymongo import ReturnDocument
+
+from db import chat_collection
+from message_store import get_messages_after_seq
+
+MULTI_WORKER = bool(os.getenv("SOCKETIO_MESSAGE_QUEUE"))
+SEQ_BLOCK_SIZE = int(os.getenv("SEQ_BLOCK_SIZE", "1" if MULTI_WORKER else "100"))
+# Other workers' messages never reach this worker's log, so replay reads the store then
+REPLAY_LOG_ENABLED = os.getenv("REPLAY_LOG_ENABLED", "false" if MULTI_WORKER else "true").lower() == "true"
+REPLAY_LOG_SIZE = int(os.getenv("REPLAY_LOG_SIZE", "200"))
+REPLAY_LOG_CHATS = int(os.getenv("REPLAY_LOG_CHATS", "10000"))
+REPLAY_MAX_MESSAGES = int(os.getenv("REPLAY_MAX_MESSAGES", "500"))
+REPLAY_STORE_WAIT = float(os.getenv("REPLAY_STORE_WAIT", "2"))
+
+
+class SequenceAllocator:
+    def __init__(self, block_size=SEQ_BLOCK_SIZE, max_chats=REPLAY_LOG_CHATS):
+        self.block_size = block_size
+        self.max_chats = max_chats
+        # chat_id -> [next seq, last seq of the reserved block, participants]
+        self._blocks = OrderedDict()
+        # chat_id -> lock held while a block of the chat is reserved
+        self._locks = {}
+        self.reservations = 0
+
+    def _take(self, chat_id):
+        block = self._blocks.get(chat_id)
+        if block is None or block[0] > block[1]:
+            return None
+        self._blocks.move_to_end(chat_id)
+        block[0] += 1
+        return block[0] - 1
+
+    async def next(self, chat_id):
+        """Return the next sequence number of a chat, None if the chat does not exist."""
+        seq = self._take(chat_id)
+        if seq is not None:
+            return seq
+
+        # Messages waiting here get their numbers in arrival order once the block is reserved
+        lock = self._locks.setdefault(chat_id, asyncio.Lock())
+        async with lock:
+            seq = self._take(chat_id)
+            if seq is not None:
+                return seq
+            chat = await chat_collection.find_one_and_update(
+                {"_id": chat_id}, {"$inc": {"seq": self.block_size}},
+                projection={"seq": 1, "participants": 1}, return_document=ReturnDocument.AFTER)
+            if chat is None:
+                return None
+            self.reservations += 1
+            self._blocks[chat_id] = [chat["seq"] - self.block_size + 1, chat["seq"], chat.get("participants", [])]
+            while len(self._blocks) > self.max_chats:
+                # The rest of an evicted block is skipped, numbers only need to grow
+                evicted, _ = self._blocks.popitem(last=False)
+                evicted_lock = self._locks.get(evicted)
+                if evicted_lock is not None and not evicted_lock.locked():
+                    del self._locks[evicted]
+            return self._take(chat_id)
+
+    def participants(self, chat_id):
+        # Participants of a chat next() just numbered a message of, a chat's participants never change
+        block = self._blocks.get(chat_id)
+        return block[2] if block is not None else []
+
+    def clear(self):
+        self._blocks.clear()
+        self._locks.clear()
+
+
+class ReplayLog:
+    """The newest messages each chat had fanned out by this worker, in seq order."""
+
+    def __init__(self, size=REPLAY_LOG_SIZE, max_chats=REPLAY_LOG_CHATS, enabled=REPLAY_LOG_ENABLED):
+        self.size = size
+        self.max_chats = max_chats
+        self.enabled = enabled
+        # chat_id -> [floor, deque of ChatMessages]; every message of the chat with seq >= floor is in the deque
+        self._chats = OrderedDict()
+        # Messages held over all chats, kept up to date so stats() stays cheap
+        self.messages = 0
+
+    def append(self, message):
+        if not self.enabled:
+            return
+        entry = self._chats.get(message.chat_id)
+        if entry is None:
+            entry = [message.seq, deque(maxlen=self.size)]
+            self._chats[message.chat_id] = entry
+            if len(self._chats) > self.max_chats:
+                _, (_, evicted) = self._chats.popitem(last=False)
+                self.messages -= len(evicted)
+        else:
+            self._chats.move_to_end(message.chat_id)
+        if len(entry[1]) < self.size:
+            self.messages += 1
+        entry[1].append(message)
+        entry[0] = entry[1][0].seq
+
+    def since(self, chat_id, after_seq):
+        """Return (floor, messages newer than after_seq), or None if the chat has no log."""
+        entry = self._chats.get(chat_id)
+        if entry is None:
+            return None
+        newer = []
+        # Walk back from the newest, the cost follows the number of missed messages
+        for message in reversed(entry[1]):
+            if message.seq <= after_seq:
+                break
+            newer.append(message)
+        newer.reverse()
+        return entry[0], newer
+
+    def clear(self):
+        self._chats.clear()
+        self.messages = 0
+
+    def stats(self):
+        return {"enabled": self.enabled, "chats": len(self._chats),
+                "messages": self.messages}
+
+
+sequences = SequenceAllocator()
+replay_log = ReplayLog()
+replay_counts = {"log": 0, "store": 0, "reset": 0, "store_wait_timeout": 0}
+
+
+async def read_when_stored(chat_id, after_seq):
+    """Stored messages with seq > after_seq, once none of the numbers the chat's counter handed out is missing.
+
+    Gives up after REPLAY_STORE_WAIT seconds and returns what is stored then.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + REPLAY_STORE_WAIT
+    delay = 0.01
+    while True:
+        # The counter first: numbers handed out after it are newer and reach the rejoined socket live
+        chat = await chat_collection.find_one({"_id": chat_id}, {"seq": 1})
+        handed_out = (chat or {}).get("seq", 0)
+        stored = await get_messages_after_seq(chat_id, after_seq, limit=REPLAY_MAX_MESSAGES + 1)
+        present = sum(1 for message in stored if message["seq"] <= handed_out)
+        if present >= handed_out - after_seq or len(stored) > REPLAY_MAX_MESSAGES:
+            return stored
+        if loop.time() + delay > deadline:
+            # A number whose message was never stored, or a worker far behind; replay what is there
+            replay_counts["store_wait_timeout"] += 1
+            return stored
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 0.2)
+
+
+async def replay_missed(chat_id, after_seq):
+    """Messages of a chat with seq > after_seq as new_message payloads, or a reset when too many were missed."""
+    logged = replay_log.since(chat_id, after_seq)
+    if logged is not None and after_seq + 1 >= logged[0]:
+        replay_counts["log"] += 1
+        payloads = [message.to_payload() for message in logged[1]]
+    else:
+        # Older than the log: read them from the store, up to where the log takes over
+        replay_counts["store"] += 1
+        before_seq = logged[0] if logged is not None else None
+        if logged is None and sequences.block_size == 1:
+            # Only then does the counter match the numbers handed out, a reserved block runs ahead of them
+            stored = await read_when_stored(chat_id, after_seq)
+        else:
+            stored = await get_messages_after_seq(chat_id, after_seq, before_seq, limit=REPLAY_MAX_MESSAGES + 1)
+        payloads = [dict(message, chat_id=chat_id) for message in stored]
+        if logged is not None:
+            payloads += [message.to_payload() for message in logged[1]]
+
+    if len(payloads) > REPLAY_MAX_MESSAGES:
+        replay_counts["reset"] += 1
+        return {"messages": [], "reset": True}
+    return {"messages": payloads, "reset": False}
+
+
+def replay_stats():
+    return {
+        "seq_block_size": sequences.block_size,
+        "seq_reservations": sequences.reservations,
+        "log": replay_log.stats(),
+        "replays": dict(replay_counts),
+    }
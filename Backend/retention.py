@@ -0,0 +1,181 @@
+"""Message retention and the compaction job.
+
+Chat history otherwise grows forever and keeps old buckets in the working set
+and in every index. The compaction job applies a retention policy to each
+chat:
+
+  * full buckets whose newest message is older than ``archive_after_days`` are
+    compressed into the ``message_archive`` collection and removed from
+    ``messages``. History pages, catch-up and exports read the archive
+    transparently (see ``message_store.iter_buckets``).
+  * buckets, live or archived, whose newest message is older than
+    ``delete_after_days`` are deleted, along with their search index rows.
+    Retention works on whole buckets, so a message goes once the newest
+    message of its bucket passed the limit.
+
+``ARCHIVE_AFTER_DAYS`` and ``RETENTION_DAYS`` are the defaults, a chat's
+``retention`` field (set with ``PUT /chats/{chat_id}/retention``) overrides
+them; 0 turns a step off. The job runs every ``COMPACTION_INTERVAL`` seconds
+and touches at most ``COMPACTION_BUCKETS_PER_SECOND`` buckets per second so it
+does not compete with live traffic. With several workers, run it on one of
+them (``COMPACTION_INTERVAL=0`` on the others), or once from the command line:
+
+    python retention.py --compact
+"""
+import asyncio
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+import bson
+from bson.binary import Binary
+from pymongo import ASCENDING
+
+from db import chat_collection, message_archive_collection, message_collection
+from export_jobs import Throttle
+from message_store import MESSAGE_BUCKET_SIZE, archived_messages, compress_messages
+from search_index import search_index
+from tail_cache import tail_cache
+
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "30"))
+RETENTION_DAYS = int(os.getenv("RETENTION_DAYS", "0"))  # 0 keeps messages forever
+COMPACTION_INTERVAL = float(os.getenv("COMPACTION_INTERVAL", "3600"))  # 0 means no background job
+COMPACTION_BUCKETS_PER_SECOND = int(os.getenv("COMPACTION_BUCKETS_PER_SECOND", "20"))  # 0 means no limit
+
+
+def policy_for(chat):
+    # (archive_after_days, delete_after_days) of a chat, 0 meaning never
+    retention = chat.get("retention") or {}
+    archive_after = retention.get("archive_after_days")
+    delete_after = retention.get("delete_after_days")
+    return (ARCHIVE_AFTER_DAYS if archive_after is None else archive_after,
+            RETENTION_DAYS if delete_after is None else delete_after)
+
+
+def empty_report():
+    return {"chats": 0, "archived_buckets": 0, "archived_messages": 0, "deleted_buckets": 0,
+            "deleted_messages": 0, "bytes_before": 0, "bytes_after": 0, "bytes_reclaimed": 0}
+
+
+class CompactionJob:
+    def __init__(self, interval=COMPACTION_INTERVAL, buckets_per_second=COMPACTION_BUCKETS_PER_SECOND):
+        self.interval = interval
+        self.throttle = Throttle(buckets_per_second)
+        self._task = None
+        self.running = False
+        self.runs = 0
+        self.bytes_reclaimed = 0
+        self.last_report = None
+
+    def start(self):
+        if self.interval and self._task is None:
+            self._task = asyncio.create_task(self._run_periodically())
+
+    async def stop(self):
+        # A bucket is only deleted after its copy is stored, stopping halfway loses nothing
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run_periodically(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.compact()
+            except Exception as e:
+                print(f"Compaction failed: {e}")
+
+    async def compact(self, now=None):
+        """Apply the retention policy of every chat once and return what it did."""
+        now = now or datetime.utcnow()
+        started = time.monotonic()
+        report = empty_report()
+        self.running = True
+        try:
+            async for chat in chat_collection.find({}, {"_id": 1, "retention": 1}):
+                archive_after, delete_after = policy_for(chat)
+                if delete_after:
+                    await self._delete_chat_history(chat["_id"], now - timedelta(days=delete_after), report)
+                if archive_after:
+                    await self._archive_chat(chat["_id"], now - timedelta(days=archive_after), report)
+                report["chats"] += 1
+        finally:
+            self.running = False
+        report["bytes_reclaimed"] = report["bytes_before"] - report["bytes_after"]
+        report["duration_s"] = round(time.monotonic() - started, 3)
+        self.runs += 1
+        self.bytes_reclaimed += report["bytes_reclaimed"]
+        self.last_report = report
+        print(f"Compaction archived {report['archived_messages']} and deleted {report['deleted_messages']} messages, "
+              f"reclaiming {report['bytes_reclaimed']} bytes")
+        return report
+
+    async def _archive_chat(self, chat_id, cutoff, report):
+        # Only full buckets, the open one still takes new messages
+        query = {"chat_id": chat_id, "end": {"$lt": cutoff}, "count": {"$gte": MESSAGE_BUCKET_SIZE}}
+        async for bucket in message_collection.find(query).sort("start", ASCENDING):
+            await self.throttle.wait()
+            segment = {field: bucket[field] for field in ("chat_id", "start", "end", "count", "last_seq") if field in bucket}
+            segment["codec"] = "zlib"
+            segment["data"] = Binary(compress_messages(bucket["messages"]))
+            segment["archived_at"] = datetime.utcnow()
+            # Copy first, with the bucket's _id, so running again after a crash does not duplicate it
+            await message_archive_collection.replace_one({"_id": bucket["_id"]}, segment, upsert=True)
+            await message_collection.delete_one({"_id": bucket["_id"]})
+            report["archived_buckets"] += 1
+            report["archived_messages"] += bucket["count"]
+            report["bytes_before"] += len(bson.encode(bucket))
+            report["bytes_after"] += len(bson.encode(dict(segment, _id=bucket["_id"])))
+
+    async def _delete_chat_history(self, chat_id, cutoff, report):
+        query = {"chat_id": chat_id, "end": {"$lt": cutoff}}
+        deleted = False
+        for collection in (message_collection, message_archive_collection):
+            async for bucket in collection.find(query).sort("start", ASCENDING):
+                await self.throttle.wait()
+                # Unless a message was appended since it was read, the delete then waits for the next run
+                result = await collection.delete_one({"_id": bucket["_id"], "count": bucket["count"]})
+                if not result.deleted_count:
+                    continue
+                report["deleted_buckets"] += 1
+                report["deleted_messages"] += bucket["count"]
+                report["bytes_before"] += len(bson.encode(bucket))
+                deleted = True
+                # Deleted messages must not show up in search results; only this bucket's, buckets
+                # written by several workers overlap in time and a kept one can hold older messages
+                messages = archived_messages(bucket) if "data" in bucket else bucket["messages"]
+                try:
+                    await search_index.delete_messages(chat_id, messages)
+                except Exception as e:
+                    print(f"Removing deleted messages of chat {chat_id} from the search index failed: {e}")
+        if deleted:
+            # Nor in cached pages
+            tail_cache.discard(chat_id)
+
+    def stats(self):
+        return {
+            "interval": self.interval,
+            "running": self.running,
+            "runs": self.runs,
+            "bytes_reclaimed": self.bytes_reclaimed,
+            "last_report": self.last_report,
+        }
+
+
+compaction = CompactionJob()
+
+
+if __name__ == "__main__":
+    if "--compact" not in sys.argv:
+        print("Usage: python retention.py --compact")
+        sys.exit(1)
+
+    async def main():
+        report = await compaction.compact()
+        print(json.dumps(report, indent=2))
+
+    asyncio.run(main())
+    search_index.close()
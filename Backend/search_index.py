@@ -0,0 +1,237 @@
+"""Full-text message search.
+
+Messages are indexed in an SQLite FTS5 table on local disk
+(``SEARCH_INDEX_PATH``). ``persist_messages`` adds every batch it stores, so
+the index follows new messages without a separate job. Results are ranked
+with BM25 and come with a highlighted snippet, HTML escaped with the matches
+wrapped in ``<mark>``.
+
+SQLite calls block, so they run on one dedicated thread, which also keeps
+writes in order. Workers on the same host can share the file (WAL mode);
+workers on different hosts each index the messages they store, so run
+search on one host or rebuild the index there.
+
+A message is indexed once per (chat_id, seq), so a rebuild running while the
+app stores new messages does not index a batch twice. The index can be rebuilt
+from the message store, one bucket batch at a time:
+
+    python search_index.py --rebuild
+"""
+import asyncio
+import html
+import os
+import re
+import sqlite3
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+SEARCH_ENABLED = os.getenv("SEARCH_ENABLED", "true").lower() == "true"
+SEARCH_INDEX_PATH = os.getenv("SEARCH_INDEX_PATH", "search_index.db")
+SEARCH_MAX_OFFSET = int(os.getenv("SEARCH_MAX_OFFSET", "1000"))
+REBUILD_BATCH_SIZE = 500
+
+SCHEMA = [
+    # Message rows, the FTS table reads its content from here
+    """CREATE TABLE IF NOT EXISTS message_rows (
+        id INTEGER PRIMARY KEY,
+        chat_id TEXT NOT NULL,
+        sender TEXT NOT NULL,
+        time TEXT NOT NULL,
+        content TEXT NOT NULL,
+        seq INTEGER
+    )""",
+    "CREATE INDEX IF NOT EXISTS message_rows_chat_id ON message_rows (chat_id)",
+    # A message is indexed once; messages from before the seqs have none, SQLite does not count NULLs as duplicates
+    "CREATE UNIQUE INDEX IF NOT EXISTS message_rows_chat_id_seq ON message_rows (chat_id, seq)",
+    """CREATE VIRTUAL TABLE IF NOT EXISTS message_fts USING fts5(
+        content, content='message_rows', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+    )""",
+]
+# Control characters around the matches, replaced by <mark> once the snippet is escaped
+MARK_START, MARK_END = "\x02", "\x03"
+
+
+def highlight(snippet):
+    """Escape a snippet for HTML and turn the match markers into <mark> tags."""
+    return html.escape(snippet).replace(MARK_START, "<mark>").replace(MARK_END, "</mark>")
+
+
+def build_match_query(text):
+    """Turn user input into an FTS5 query: every word must match, the last one as a prefix.
+
+    Returns None when the input has no words. Words are quoted, so FTS5
+    operators typed by the user are searched for literally instead of failing.
+    """
+    words = re.findall(r"\w+", text)
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += "*"
+    return " AND ".join(terms)
+
+
+class SearchIndex:
+    def __init__(self, path=SEARCH_INDEX_PATH):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="search-index")
+        self._connection = None
+
+    def _connect(self):
+        # Runs on the index thread only
+        if self._connection is None:
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA busy_timeout=5000")
+            for statement in SCHEMA:
+                connection.execute(statement)
+            connection.commit()
+            self._connection = connection
+        return self._connection
+
+    async def _run(self, function, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, function, *args)
+
+    def _add(self, rows):
+        connection = self._connect()
+        added = 0
+        with connection:
+            for row in rows:
+                cursor = connection.execute(
+                    "INSERT OR IGNORE INTO message_rows (chat_id, sender, time, content, seq) VALUES (?, ?, ?, ?, ?)", row)
+                # Ignored when the message is indexed already
+                if cursor.rowcount:
+                    connection.execute("INSERT INTO message_fts (rowid, content) VALUES (?, ?)", (cursor.lastrowid, row[3]))
+                    added += 1
+        return added
+
+    async def add(self, chat_id, messages):
+        """Index ChatMessages of one chat."""
+        if not SEARCH_ENABLED or not messages:
+            return
+        await self._run(self._add, [(chat_id, message.sender, message.time_text, message.content, message.seq)
+                                    for message in messages])
+
+    def _search(self, match_query, chat_ids, limit, offset):
+        connection = self._connect()
+        placeholders = ",".join("?" * len(chat_ids))
+        rows = connection.execute(
+            f"""SELECT r.chat_id, r.sender, r.time,
+                       snippet(message_fts, 0, ?, ?, '…', 12),
+                       bm25(message_fts)
+                FROM message_fts JOIN message_rows r ON r.id = message_fts.rowid
+                WHERE message_fts MATCH ? AND r.chat_id IN ({placeholders})
+                ORDER BY bm25(message_fts), r.time DESC
+                LIMIT ? OFFSET ?""",
+            [MARK_START, MARK_END, match_query, *chat_ids, limit, offset],
+        ).fetchall()
+        return [
+            # bm25 is lower for better matches, turn it into a score where higher is better
+            {"chat_id": chat_id, "sender": sender, "time": time, "snippet": highlight(snippet), "score": round(-rank, 4)}
+            for chat_id, sender, time, snippet, rank in rows
+        ]
+
+    async def search(self, text, chat_ids, limit=20, offset=0):
+        """Return (results, next_offset) for messages of ``chat_ids`` matching ``text``, best first."""
+        match_query = build_match_query(text)
+        if match_query is None or not chat_ids:
+            return [], None
+        # One extra result tells whether there is a next page
+        results = await self._run(self._search, match_query, list(chat_ids), limit + 1, offset)
+        next_offset = None
+        if len(results) > limit:
+            results = results[:limit]
+            if offset + limit < SEARCH_MAX_OFFSET:
+                next_offset = offset + limit
+        return results, next_offset
+
+    def _delete(self, chat_id, seqs, unnumbered):
+        connection = self._connect()
+        with connection:
+            rows = []
+            for seq in seqs:
+                rows += connection.execute(
+                    "SELECT id, content FROM message_rows WHERE chat_id = ? AND seq = ?", (chat_id, seq)).fetchall()
+            for time, content in unnumbered:
+                rows += connection.execute(
+                    "SELECT id, content FROM message_rows WHERE chat_id = ? AND seq IS NULL AND time = ? AND content = ?",
+                    (chat_id, time, content)).fetchall()
+            # The FTS table keeps no copy of the content, it needs the old text to remove a row
+            connection.executemany(
+                "INSERT INTO message_fts (message_fts, rowid, content) VALUES ('delete', ?, ?)", rows)
+            connection.executemany("DELETE FROM message_rows WHERE id = ?", [(row_id,) for row_id, _ in rows])
+        return len(rows)
+
+    async def delete_messages(self, chat_id, messages):
+        """Remove messages of a chat, as stored in a bucket, from the index.
+
+        Messages are found by seq, the ones from before the seqs by time and content.
+        """
+        if not SEARCH_ENABLED or not messages:
+            return 0
+        from models import format_message_time
+        seqs = [message["seq"] for message in messages if message.get("seq") is not None]
+        # Written the way rebuild() writes them
+        unnumbered = [(format_message_time(message.get("time")) or "", message["content"])
+                      for message in messages if message.get("seq") is None]
+        return await self._run(self._delete, chat_id, seqs, unnumbered)
+
+    def _clear(self):
+        connection = self._connect()
+        with connection:
+            connection.execute("DELETE FROM message_rows")
+            connection.execute("INSERT INTO message_fts (message_fts) VALUES ('delete-all')")
+
+    async def clear(self):
+        await self._run(self._clear)
+
+    async def rebuild(self):
+        """Index every stored message again, holding only a few buckets in memory at a time.
+
+        Batches the app indexes meanwhile are not indexed twice, their seqs are.
+        """
+        from db import chat_collection
+        from message_store import iter_messages
+        from models import format_message_time
+
+        await self.clear()
+        indexed = 0
+        async for chat in chat_collection.find({}, {"_id": 1}):
+            rows = []
+            async for message in iter_messages(chat["_id"]):
+                rows.append((chat["_id"], message["sender"], format_message_time(message.get("time")) or "",
+                             message["content"], message.get("seq")))
+                if len(rows) >= REBUILD_BATCH_SIZE:
+                    indexed += await self._run(self._add, rows)
+                    rows = []
+            if rows:
+                indexed += await self._run(self._add, rows)
+        await self._run(self._optimize)
+        return indexed
+
+    def _optimize(self):
+        connection = self._connect()
+        with connection:
+            connection.execute("INSERT INTO message_fts (message_fts) VALUES ('optimize')")
+
+    def close(self):
+        if self._connection is not None:
+            self._executor.submit(self._connection.close).result()
+            self._connection = None
+        self._executor.shutdown(wait=True)
+
+
+search_index = SearchIndex()
+
+
+if __name__ == "__main__":
+    if "--rebuild" not in sys.argv:
+        print("Usage: python search_index.py --rebuild")
+        sys.exit(1)
+
+    async def main():
+        count = await search_index.rebuild()
+        print(f"Indexed {count} messages into {SEARCH_INDEX_PATH}")
+
+    asyncio.run(main())
+    search_index.close()
@@ -0,0 +1,250 @@
+"""Socket.IO client managers for running several workers or pods.
+
+The client manager decides how emits and room changes reach sockets connected
+to other processes. ``SOCKETIO_MESSAGE_QUEUE`` selects the backend:
+
+- empty (default): everything stays in this process, fine for a single worker
+- ``redis://host:port/db``: python-socketio's Redis pub/sub manager
+- ``tcp://host:port``: a small newline-delimited JSON broker, started with
+  ``python socket_bus.py --port 6380``. Handy on a laptop or in CI where there
+  is no Redis.
+
+The pub/sub backends also replicate the presence registries, so every worker
+knows who is online and on which worker each session lives, and pass on cache
+invalidations so a changed user is forgotten by every worker at once.
+"""
+import argparse
+import asyncio
+import json
+import os
+import uuid
+from urllib.parse import urlparse
+
+import socketio
+from socketio.async_pubsub_manager import AsyncPubSubManager
+
+SOCKETIO_MESSAGE_QUEUE = os.getenv("SOCKETIO_MESSAGE_QUEUE", "")
+SOCKETIO_CHANNEL = os.getenv("SOCKETIO_CHANNEL", "socketio")
+# Wait a moment after startup before asking the other workers for their sessions
+PRESENCE_SYNC_DELAY = float(os.getenv("PRESENCE_SYNC_DELAY", "0.5"))
+
+
+class LocalManager(socketio.AsyncManager):
+    """In-process manager, presence changes have nobody to be shared with."""
+
+    def __init__(self):
+        super().__init__()
+        self.host_id = uuid.uuid4().hex
+        self.registries = {}
+        self.caches = {}
+
+    def attach_registries(self, registries):
+        self.registries = registries
+
+    def attach_caches(self, caches):
+        self.caches = caches
+
+    async def share_presence(self, registry, op, username=None, sid=None):
+        pass
+
+    async def share_invalidation(self, cache, key=None):
+        pass
+
+    async def drop_host(self):
+        pass
+
+
+class PresenceSyncMixin:
+    """Replicates PresenceRegistry changes over the pub/sub channel.
+
+    Every session is tagged with the host that owns it. A starting worker asks
+    the others for their sessions, and a worker shutting down cleanly tells the
+    others to forget its sessions. Sessions of a worker that crashes are only
+    forgotten when the remaining workers restart.
+
+    Cache invalidations are relayed the same way: ``caches`` maps a cache name
+    to the function dropping a key (or everything, for ``None``) from it.
+    """
+
+    registries = {}
+    caches = {}
+
+    def attach_registries(self, registries):
+        self.registries = registries
+
+    def attach_caches(self, caches):
+        self.caches = caches
+
+    def initialize(self):
+        super().initialize()
+        if not self.write_only:
+            self.server.start_background_task(self._request_presence_sync)
+
+    async def share_presence(self, registry, op, username=None, sid=None):
+        await self._publish({
+            "method": "presence", "registry": registry, "op": op,
+            "username": username, "sid": sid, "host_id": self.host_id,
+        })
+
+    async def share_invalidation(self, cache, key=None):
+        await self._publish({"method": "invalidate", "cache": cache, "key": key, "host_id": self.host_id})
+
+    async def drop_host(self):
+        for registry in self.registries.values():
+            registry.drop_host(self.host_id)
+        await self._publish({"method": "presence", "op": "drop_host", "host_id": self.host_id})
+
+    async def _request_presence_sync(self):
+        await asyncio.sleep(PRESENCE_SYNC_DELAY)
+        await self._publish({"method": "presence", "op": "sync_request", "host_id": self.host_id})
+
+    async def _handle_presence(self, message):
+        op = message.get("op")
+        host_id = message.get("host_id")
+        if op == "sync_request":
+            # Tell the new worker about every session connected to this one
+            for name, registry in self.registries.items():
+                for username, sid in registry.host_sessions(self.host_id):
+                    await self.share_presence(name, "add", username, sid)
+        elif op == "drop_host":
+            for registry in self.registries.values():
+                registry.drop_host(host_id)
+        else:
+            registry = self.registries.get(message.get("registry"))
+            if registry is None:
+                return
+            if op == "add":
+                registry.add(message["username"], message["sid"], host=host_id)
+            elif op == "remove":
+                registry.remove(message["sid"])
+
+    async def _listen(self):
+        async for message in super()._listen():
+            data = message
+            if not isinstance(data, dict):
+                try:
+                    data = self.json.loads(message)
+                except (TypeError, ValueError):
+                    data = None
+            if isinstance(data, dict) and data.get("method") == "presence":
+                if data.get("host_id") != self.host_id:
+                    await self._handle_presence(data)
+                continue
+            if isinstance(data, dict) and data.get("method") == "invalidate":
+                forget = self.caches.get(data.get("cache"))
+                if forget is not None and data.get("host_id") != self.host_id:
+                    forget(data.get("key"))
+                continue
+            yield message
+
+
+class RedisManager(PresenceSyncMixin, socketio.AsyncRedisManager):
+    name = "redis"
+
+
+class TCPPubSubManager(AsyncPubSubManager):
+    """Pub/sub manager talking to the loopback broker below."""
+
+    name = "tcp"
+
+    def __init__(self, url, channel="socketio", write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        parsed = urlparse(url)
+        self.broker_host = parsed.hostname or "127.0.0.1"
+        self.broker_port = parsed.port or 6380
+        self._reader = None
+        self._writer = None
+        self._connect_lock = asyncio.Lock()
+
+    async def _connect(self):
+        async with self._connect_lock:
+            if self._writer is None:
+                self._reader, self._writer = await asyncio.open_connection(
+                    self.broker_host, self.broker_port)
+
+    def _reset(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+    async def _publish(self, data):
+        frame = json.dumps({"channel": self.channel, "data": data}, default=str)
+        for retries_left in range(1, -1, -1):
+            try:
+                await self._connect()
+                self._writer.write(frame.encode("utf-8") + b"\n")
+                await self._writer.drain()
+                return
+            except OSError:
+                self._reset()
+                if retries_left == 0:
+                    self._get_logger().error("Cannot publish to the socket broker")
+
+    async def _listen(self):
+        retry_sleep = 1
+        while True:
+            try:
+                await self._connect()
+                line = await self._reader.readline()
+            except OSError:
+                line = b""
+            if not line:
+                # Broker went away, reconnect with a growing delay
+                self._reset()
+                await asyncio.sleep(retry_sleep)
+                retry_sleep = min(retry_sleep * 2, 30)
+                continue
+            retry_sleep = 1
+            frame = json.loads(line)
+            if frame.get("channel") == self.channel:
+                yield frame["data"]
+
+
+class TCPManager(PresenceSyncMixin, TCPPubSubManager):
+    pass
+
+
+def create_client_manager(url=SOCKETIO_MESSAGE_QUEUE, channel=SOCKETIO_CHANNEL):
+    if not url:
+        return LocalManager()
+    scheme = urlparse(url).scheme
+    if scheme in ("redis", "rediss", "unix"):
+        return RedisManager(url, channel=channel)
+    if scheme == "tcp":
+        return TCPManager(url, channel=channel)
+    raise ValueError(f"Unsupported SOCKETIO_MESSAGE_QUEUE scheme: {scheme}")
+
+
+async def run_broker(host, port):
+    """Relay every line received from a client to all connected clients."""
+    clients = set()
+
+    async def handle(reader, writer):
+        clients.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                for client in list(clients):
+                    try:
+                        client.write(line)
+                    except (ConnectionError, RuntimeError):
+                        clients.discard(client)
+        finally:
+            clients.discard(writer)
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    print(f"Socket broker listening on {host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+
+# Start the loopback broker: python socket_bus.py --port 6380
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Loopback pub/sub broker for Socket.IO workers")
+    arg_parser.add_argument("--host", default="127.0.0.1")
+    arg_parser.add_argument("--port", type=int, default=6380)
+    args = arg_parser.parse_args()
+    asyncio.run(run_broker(args.host, args.port))
@@ -0,0 +1,115 @@
+"""Counters and database status served by ``/server_status``.
+
+``/server_status`` used to count every user document and run MongoDB's
+``serverStatus`` on each call, so a health checker polling it added load that
+grew with the user count. ``StatsService`` answers from memory instead:
+
+  * users, chats and stored messages are counted as this worker registers,
+    creates and stores them. Every ``STATS_RECONCILE_INTERVAL`` seconds the
+    user and chat counts are reset from ``estimated_document_count``, which
+    reads collection metadata, so the changes other workers made show up too.
+    Messages are stored in buckets, their count is what this worker stored
+    since it started, next to the estimated number of buckets.
+  * the ``serverStatus`` snapshot is kept for ``SERVER_STATUS_TTL`` seconds and
+    refreshed in the background once it is older; callers never wait for it.
+"""
+import asyncio
+import os
+import time
+
+from db import chat_collection, message_collection, mongo, user_collection
+
+STATS_RECONCILE_INTERVAL = float(os.getenv("STATS_RECONCILE_INTERVAL", "300"))
+SERVER_STATUS_TTL = float(os.getenv("SERVER_STATUS_TTL", "30"))
+
+
+class StatsService:
+    def __init__(self, reconcile_interval=STATS_RECONCILE_INTERVAL, status_ttl=SERVER_STATUS_TTL):
+        self.reconcile_interval = reconcile_interval
+        self.status_ttl = status_ttl
+        self.users = 0
+        self.chats = 0
+        self.message_buckets = 0
+        self.messages_stored = 0
+        self.reconciled_at = None
+        self._db_status = None
+        self._db_status_at = None
+        # A failed refresh is not retried before the TTL either
+        self._db_status_tried_at = None
+        self._refreshing = None
+        self._timer_task = None
+
+    async def start(self):
+        # Counts and status are known before the first request
+        await self.reconcile()
+        await self._refresh_db_status()
+        if self._timer_task is None:
+            self._timer_task = asyncio.create_task(self._reconcile_periodically())
+
+    async def stop(self):
+        if self._timer_task is not None:
+            self._timer_task.cancel()
+            self._timer_task = None
+
+    async def reconcile(self):
+        try:
+            self.users, self.chats, self.message_buckets = await asyncio.gather(
+                user_collection.estimated_document_count(),
+                chat_collection.estimated_document_count(),
+                message_collection.estimated_document_count())
+            self.reconciled_at = time.monotonic()
+        except Exception as e:
+            print(f"Reconciling the document counts failed: {e}")
+
+    async def _reconcile_periodically(self):
+        while True:
+            await asyncio.sleep(self.reconcile_interval)
+            await self.reconcile()
+
+    def user_added(self):
+        self.users += 1
+
+    def chat_added(self):
+        self.chats += 1
+
+    def messages_added(self, count):
+        self.messages_stored += count
+
+    def reset(self):
+        # After the collections were dropped
+        self.users = self.chats = self.message_buckets = self.messages_stored = 0
+
+    async def _refresh_db_status(self):
+        self._db_status_tried_at = time.monotonic()
+        try:
+            status = await mongo.client.admin.command("serverStatus")
+            self._db_status = {"connections": status.get("connections"), "version": status.get("version"),
+                               "uptime": status.get("uptime")}
+            self._db_status_at = time.monotonic()
+        except Exception as e:
+            print(f"Reading the MongoDB server status failed: {e}")
+        finally:
+            self._refreshing = None
+
+    def db_status(self):
+        """The cached serverStatus snapshot and its age, starting a refresh when it expired."""
+        now = time.monotonic()
+        expired = self._db_status_tried_at is None or now - self._db_status_tried_at >= self.status_ttl
+        if expired and self._refreshing is None:
+            # One refresh at a time, whatever the number of pollers
+            self._refreshing = asyncio.create_task(self._refresh_db_status())
+        age = round(now - self._db_status_at, 1) if self._db_status_at is not None else None
+        return self._db_status, age
+
+    def counts(self):
+        return {
+            "users": self.users,
+            "chats": self.chats,
+            "message_buckets": self.message_buckets,
+            "messages_stored": self.messages_stored,
+            "reconciled_seconds_ago": round(time.monotonic() - self.reconciled_at, 1)
+                                      if self.reconciled_at is not None else None,
+        }
+
+
+stats_service = StatsService()
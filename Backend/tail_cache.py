@@ -0,0 +1,208 @@
+"""In-memory tail of the most recently active chats.
+
+For each chat that was read recently, the newest ``TAIL_CACHE_MESSAGES``
+messages are kept in a ring buffer. ``persist_messages`` appends every batch
+it stores, so the newest page of a busy chat, and polls for messages after a
+recent cursor, are answered without touching the database.
+
+The tail holds (key, message) pairs ordered by the message key of
+``message_store``, so pages cut at the same cursors as database reads. A
+chat's tail is loaded from the database the first time it is read (also
+after a restart) and dropped, least recently used first, when the tails
+together exceed ``TAIL_CACHE_MAX_BYTES``.
+
+Messages stored by another worker never reach this worker's tails, so the
+cache is off by default when ``SOCKETIO_MESSAGE_QUEUE`` is set.
+"""
+import os
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+from message_store import get_message_page, message_key, parse_message_time
+from metrics import Counter
+from models import ChatMessage
+
+TAIL_CACHE_ENABLED = os.getenv("TAIL_CACHE_ENABLED", "false" if os.getenv("SOCKETIO_MESSAGE_QUEUE") else "true").lower() == "true"
+TAIL_CACHE_MESSAGES = int(os.getenv("TAIL_CACHE_MESSAGES", "200"))
+TAIL_CACHE_MAX_BYTES = int(os.getenv("TAIL_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+# Rough size of a cached message besides its strings: the slotted object, datetime, list and refs
+MESSAGE_OVERHEAD_BYTES = 250
+
+tail_cache_reads = Counter("tail_cache_reads_total", "Message page reads by tail cache result", ("result",))
+
+
+def message_size(entry):
+    message = entry[1]
+    return MESSAGE_OVERHEAD_BYTES + len(message.content) + len(message.sender) + sum(len(r) for r in message.receiver)
+
+
+def history_entry(message):
+    # Same shape as a message returned by get_message_page
+    return {"content": message.content, "sender": message.sender, "receiver": message.receiver, "time": message.time_text,
+            "seq": message.seq}
+
+
+class ChatTail:
+    __slots__ = ("messages", "size", "complete")
+
+    def __init__(self, capacity):
+        self.messages = deque(maxlen=capacity)
+        self.size = 0
+        # True while the tail holds every message of the chat
+        self.complete = False
+
+    def extend(self, entries):
+        for entry in entries:
+            if len(self.messages) == self.messages.maxlen:
+                self.size -= message_size(self.messages[0])
+                self.complete = False
+            self.messages.append(entry)
+            self.size += message_size(entry)
+
+
+class TailCache:
+    def __init__(self, capacity=TAIL_CACHE_MESSAGES, max_bytes=TAIL_CACHE_MAX_BYTES, enabled=TAIL_CACHE_ENABLED):
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self._tails = OrderedDict()
+        # chat_id -> batches being written right now
+        self._writing = {}
+        # chat_id -> True once a batch was written while the chat's tail loaded
+        self._loading = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @contextmanager
+    def storing(self, chat_id, messages):
+        """Wrap the database write of a batch of ChatMessages, they join the chat's tail once stored."""
+        if not self.enabled:
+            yield
+            return
+        self._writing[chat_id] = self._writing.get(chat_id, 0) + 1
+        if chat_id in self._loading:
+            self._loading[chat_id] = True
+        try:
+            yield
+        finally:
+            self._writing[chat_id] -= 1
+            if not self._writing[chat_id]:
+                del self._writing[chat_id]
+
+        # Only reached when the write succeeded
+        tail = self._tails.get(chat_id)
+        if tail is not None:
+            entries = sorted(((message_key(m.time, m.seq), m) for m in messages), key=lambda entry: entry[0])
+            if tail.messages and entries and entries[0][0] < tail.messages[-1][0]:
+                # Older than messages already cached (stored by an overlapping batch), reload the tail instead
+                self.discard(chat_id)
+                return
+            self.size -= tail.size
+            tail.extend(entries)
+            self.size += tail.size
+            self._evict()
+
+    def _evict(self):
+        while self.size > self.max_bytes and self._tails:
+            chat_id, tail = self._tails.popitem(last=False)
+            self.size -= tail.size
+            self.evictions += 1
+
+    async def _load(self, chat_id):
+        # A batch being written may or may not end up in the page read, don't load then
+        if chat_id in self._writing or chat_id in self._loading:
+            return None
+        self._loading[chat_id] = False
+        try:
+            documents = await get_message_page(chat_id, self.capacity)
+        finally:
+            written = self._loading.pop(chat_id)
+        if written or chat_id in self._tails:
+            return None
+
+        tail = ChatTail(self.capacity)
+        tail.extend((key, ChatMessage(chat_id, document["sender"], document.get("receiver", []), document["content"],
+                                      parse_message_time(document["time"]), document.get("seq")))
+                    for key, document in documents if document.get("time"))
+        tail.complete = len(documents) < self.capacity
+        self._tails[chat_id] = tail
+        self.size += tail.size
+        self._evict()
+        return tail
+
+    def _page(self, tail, limit, before, after):
+        # The (key, message) page when the tail is sure to have all of it, None otherwise
+        messages = tail.messages
+        if after is not None:
+            if not tail.complete and (not messages or messages[0][0] >= after):
+                return None
+            return [(k, history_entry(m)) for k, m in messages if k > after and (before is None or k < before)][:limit]
+        if before is not None:
+            older = [(k, m) for k, m in messages if k < before]
+            if len(older) < limit and not tail.complete:
+                return None
+            return [(k, history_entry(m)) for k, m in older[-limit:]]
+        if len(messages) < limit and not tail.complete:
+            return None
+        return [(k, history_entry(m)) for k, m in list(messages)[-limit:]]
+
+    def cached_page(self, chat_id, limit, before=None, after=None):
+        """Serve a (key, message) page from a cached tail, None when the database has to be asked.
+
+        ``before`` and ``after`` are message keys, as for ``get_message_page``.
+        """
+        if not self.enabled:
+            return None
+        tail = self._tails.get(chat_id)
+        page = self._page(tail, limit, before, after) if tail is not None else None
+        if page is None:
+            self.misses += 1
+            tail_cache_reads.inc("miss")
+            return None
+        self._tails.move_to_end(chat_id)
+        self.hits += 1
+        tail_cache_reads.inc("hit")
+        return page
+
+    async def load_page(self, chat_id, limit, before=None, after=None):
+        """Read a page that was not served from memory.
+
+        For the newest page or a poll of a chat that is not cached yet, the
+        chat's tail is loaded first and the page served from it.
+        """
+        if self.enabled and before is None and chat_id not in self._tails:
+            tail = await self._load(chat_id)
+            if tail is not None:
+                page = self._page(tail, limit, before, after)
+                if page is not None:
+                    return page
+        return await get_message_page(chat_id, limit, before=before, after=after)
+
+    def discard(self, chat_id):
+        # After messages of the chat were deleted
+        tail = self._tails.pop(chat_id, None)
+        if tail is not None:
+            self.size -= tail.size
+
+    def clear(self):
+        self._tails.clear()
+        self.size = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "chats": len(self._tails),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+tail_cache = TailCache()
@@ -0,0 +1,120 @@
+"""Shared setup of the backend tests.
+
+The tests run against mongomock-motor, an in-memory stand-in for MongoDB, so
+they need no database: ``pip install -r tests/requirements.txt`` and run
+``python -m pytest`` from the ``Backend`` folder.
+"""
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+# Set before the app modules read them at import
+os.environ.setdefault("SECRET_KEY", "test-secret-key")
+os.environ.setdefault("SEARCH_INDEX_PATH", os.path.join(tempfile.mkdtemp(prefix="chat-tests-"), "search_index.db"))
+os.environ.setdefault("COMPACTION_INTERVAL", "0")
+
+import motor.motor_asyncio  # noqa: E402
+from mongomock_motor import AsyncMongoMockClient  # noqa: E402
+
+motor.motor_asyncio.AsyncIOMotorClient = AsyncMongoMockClient
+
+import pytest  # noqa: E402
+
+import db  # noqa: E402
+from replay import replay_log, sequences  # noqa: E402
+from tail_cache import tail_cache  # noqa: E402
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture(autouse=True)
+def fresh_database():
+    # Every test starts with an empty database, each mock client has its own data,
+    # and without the per-worker state cached from the last one
+    db.mongo.close()
+    sequences.clear()
+    replay_log.clear()
+    tail_cache.clear()
+    yield db.mongo
+    db.mongo.close()
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def wait_ready(url, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server at {url} exited with status {process.returncode}")
+        try:
+            with urllib.request.urlopen(url + "/ready", timeout=1) as response:
+                if response.status == 200:
+                    return
+        except OSError:
+            pass
+        time.sleep(0.1)
+    raise RuntimeError(f"Server at {url} did not start within {timeout}s")
+
+
+@pytest.fixture
+def backend():
+    """Start ``benchmarks/server.py`` processes: ``backend(users=4, env={...})`` returns the server URL.
+
+    Each server seeds its own in-memory database with the ``bench<i>`` users
+    (password ``bench``) paired into chats, and is stopped after the test.
+    """
+    processes = []
+
+    def start(users=4, history=0, env=None, wait=True):
+        port = free_port()
+        process_env = dict(os.environ, REST_RATE="1000000", REST_BURST="1000000")
+        process_env.update(env or {})
+        process = subprocess.Popen(
+            [sys.executable, "benchmarks/server.py", "--port", str(port), "--mongo", "fake",
+             "--users", str(users), "--history", str(history)],
+            cwd=BACKEND_DIR, env=process_env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        processes.append(process)
+        url = f"http://127.0.0.1:{port}"
+        if wait:
+            wait_ready(url, process)
+        return url
+
+    def broker():
+        # The loopback Socket.IO broker, returns the SOCKETIO_MESSAGE_QUEUE value pointing at it
+        port = free_port()
+        processes.append(subprocess.Popen([sys.executable, "socket_bus.py", "--port", str(port)], cwd=BACKEND_DIR,
+                                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                return f"tcp://127.0.0.1:{port}"
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+
+    start.broker = broker
+    start.processes = processes
+    yield start
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
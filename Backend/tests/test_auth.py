@@ -0,0 +1,21 @@
+import pytest
+
+import auth
+
+
+@pytest.mark.parametrize("key", [None, "", "your-secret-key", "change-me"])
+def test_placeholder_secret_key_is_refused(monkeypatch, key):
+    monkeypatch.setattr(auth, "SECRET_KEY", key)
+    with pytest.raises(RuntimeError):
+        auth.check_secret_key()
+
+
+def test_real_secret_key_is_accepted(monkeypatch):
+    monkeypatch.setattr(auth, "SECRET_KEY", "a-long-random-value")
+    auth.check_secret_key()
+
+
+def test_server_does_not_start_without_secret_key(backend):
+    backend(env={"SECRET_KEY": ""}, wait=False)
+    process = backend.processes[-1]
+    assert process.wait(timeout=60) != 0
@@ -0,0 +1,60 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import app
+from db import chat_collection, inbox_collection
+from inbox import add_chat, mark_read
+from message_store import parse_message_time
+from models import ChatMessage
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_updated_since_with_an_offset_is_compared_in_utc():
+    for index, hour in enumerate((3, 5, 7)):
+        chat = {"_id": f"chat{index}", "name": "", "image": "", "participants": ["alice", "bob"],
+                "created_at": datetime(2024, 5, 1), "created_by": "alice",
+                "last_updated": datetime(2024, 5, 1, hour), "last_updated_by": "alice", "latestMessage": None,
+                "readSeq": {}}
+        await chat_collection.insert_one(chat)
+        await add_chat(chat)
+
+    # 10:00 in India is 04:30 UTC: only the chats updated at 05:00 and 07:00 UTC changed since
+    since = datetime(2024, 5, 1, 10, 0, tzinfo=timezone(timedelta(hours=5, minutes=30)))
+    page = await app.get_user_chats(user_id="alice", cursor=None, updated_since=since, limit=100,
+                                    sort_field="last_updated", sort_order="desc", username="alice")
+    assert [chat["_id"] for chat in page["chats"]] == ["chat1", "chat2"]
+
+
+def test_message_times_with_an_offset_are_converted():
+    assert parse_message_time("2024-05-01T10:00:00+05:30") == datetime(2024, 5, 1, 4, 30)
+    assert parse_message_time("2024-05-01T10:00:00.123Z") == datetime(2024, 5, 1, 10, 0, 0, 123000)
+    assert parse_message_time(datetime(2024, 5, 1, 10, tzinfo=timezone(timedelta(hours=-2)))) == datetime(2024, 5, 1, 12)
+
+
+async def test_updated_since_returns_chats_read_since():
+    chat = {"_id": "alice_bob", "name": "", "image": "", "participants": ["alice", "bob"],
+            "created_at": datetime(2024, 5, 1), "created_by": "alice", "last_updated": datetime(2024, 5, 1),
+            "last_updated_by": "alice", "latestMessage": None, "readSeq": {}}
+    await chat_collection.insert_one(chat)
+    await add_chat(chat)
+    await app.persist_messages("alice_bob", [ChatMessage.create("alice_bob", "alice", ["bob"], "hi", 1)])
+
+    async def poll(since):
+        page = await app.get_user_chats(user_id="bob", cursor=None, updated_since=since, limit=100,
+                                        sort_field="last_updated", sort_order="desc", username="bob")
+        return [(chat["_id"], chat["unreadMessageCounter"]) for chat in page["chats"]]
+
+    # MongoDB keeps milliseconds, the next one starts after the stored message
+    await asyncio.sleep(0.002)
+    now = datetime.utcnow()
+    since = now.replace(microsecond=now.microsecond // 1000 * 1000)
+    assert await poll(since) == []
+    await asyncio.sleep(0.002)
+    # Read on another device: the poll must bring the cleared badge, the chat keeps its place in the list
+    await mark_read({"alice_bob": {"bob": 1}})
+    assert await poll(since) == [("alice_bob", 0)]
+    row = await inbox_collection.find_one({"user": "bob", "chat_id": "alice_bob"})
+    assert row["last_updated"] < since <= row["changed_at"]
@@ -0,0 +1,71 @@
+import asyncio
+import tarfile
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from db import chat_collection, export_job_collection
+from export_jobs import ExportJobManager
+from message_store import append_messages
+
+pytestmark = pytest.mark.anyio
+
+CHATS = [f"chat{i:02d}" for i in range(12)]
+
+
+async def seed():
+    now = datetime(2024, 5, 1)
+    for chat_id in CHATS:
+        await chat_collection.insert_one({"_id": chat_id, "participants": ["alice", "bob"], "last_updated": now,
+                                          "created_at": now})
+        await append_messages(chat_id, [{"content": f"{chat_id} {i}", "sender": "alice", "receiver": ["bob"],
+                                         "time": now + timedelta(seconds=i), "seq": i + 1} for i in range(3)])
+
+
+async def claim_and_run(manager):
+    job = await manager._claim()
+    await manager._run(job)
+    return await export_job_collection.find_one({"_id": job["_id"]})
+
+
+def members(manager, job_id):
+    with tarfile.open(manager.archive_path(job_id)) as tar:
+        return [member.name for member in tar.getmembers()]
+
+
+async def test_job_checkpoints_a_watermark_and_resumes_after_it(tmp_path, monkeypatch):
+    await seed()
+    manager = ExportJobManager(export_dir=str(tmp_path), workers=1, chat_concurrency=3)
+    job = await manager.submit("admin")
+    export_chat = manager._export_chat
+
+    async def failing_export(job, chat_id):
+        # Later chats finish first, and chat06 fails: the checkpoint must stop right before it
+        await asyncio.sleep(0.01 * (len(CHATS) - CHATS.index(chat_id)))
+        if chat_id == "chat06":
+            raise RuntimeError("interrupted")
+        return await export_chat(job, chat_id)
+
+    monkeypatch.setattr(manager, "_export_chat", failing_export)
+    claimed = await manager._claim()
+    with pytest.raises(RuntimeError):
+        await manager._run(claimed)
+    stored = await export_job_collection.find_one({"_id": job["_id"]})
+    assert stored["last_chat_id"] == "chat05" and stored["exported_chats"] == 6
+
+    # Resumed by the next claim once the lease ran out
+    monkeypatch.setattr(manager, "_export_chat", export_chat)
+    await export_job_collection.update_one({"_id": job["_id"]}, {"$set": {"lease_until": datetime(2000, 1, 1)}})
+    stored = await claim_and_run(manager)
+    assert stored["status"] == "completed"
+    assert stored["exported_chats"] == len(CHATS) and stored["last_chat_id"] == CHATS[-1]
+    assert members(manager, job["_id"]) == [f"chat_{chat_id}.txt.gz" for chat_id in CHATS]
+
+
+async def test_aware_range_is_converted_to_utc(tmp_path):
+    manager = ExportJobManager(export_dir=str(tmp_path))
+    india = timezone(timedelta(hours=5, minutes=30))
+    job = await manager.submit("admin", since=datetime(2024, 5, 1, 10, 0, tzinfo=india),
+                               until=datetime(2024, 5, 1, 23, 0, tzinfo=timezone.utc))
+    assert job["params"]["since"] == datetime(2024, 5, 1, 4, 30)
+    assert job["params"]["until"] == datetime(2024, 5, 1, 23, 0)
@@ -0,0 +1,59 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+import app
+from db import chat_collection, inbox_collection, user_collection
+from indexes import bootstrap, participant_key
+from models import ChatCreate, User
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_existing_chats_get_keys_before_the_unique_index():
+    # Chats from before participant_key: without the backfill first, they all share a missing key
+    await chat_collection.insert_many([{"_id": "alice_bob", "participants": ["alice", "bob"]},
+                                       {"_id": "alice_carol", "participants": ["carol", "alice"]}])
+    await bootstrap()
+
+    assert "participant_key_unique" in await chat_collection.index_information()
+    keys = {chat["_id"]: chat["participant_key"] async for chat in chat_collection.find({})}
+    assert keys == {"alice_bob": participant_key(["alice", "bob"]),
+                    "alice_carol": participant_key(["alice", "carol"])}
+
+
+async def test_startup_fails_when_a_unique_index_cannot_be_built():
+    # Two chats of the same participants, a database from before chat creation was idempotent
+    await chat_collection.insert_many([{"_id": "alice_bob", "participants": ["alice", "bob"]},
+                                       {"_id": "bob_alice", "participants": ["bob", "alice"]}])
+    with pytest.raises(RuntimeError, match="participant_key_unique"):
+        await bootstrap()
+
+
+async def test_many_identical_creates_insert_one_chat():
+    await bootstrap()
+    await user_collection.insert_many([{"username": name} for name in ("alice", "bob", "carol")])
+
+    results = await asyncio.gather(*[
+        app.create_chat(ChatCreate(participants=participants), username="alice")
+        for participants in (["alice", "bob", "carol"], ["carol", "bob", "alice"], ["bob", "alice", "carol", "bob"]) * 10
+    ])
+
+    assert sum(1 for result in results if result["created"]) == 1
+    assert {result["chat_id"] for result in results} == {"alice_bob_carol"}
+    assert await chat_collection.count_documents({}) == 1
+    assert await inbox_collection.count_documents({"chat_id": "alice_bob_carol"}) == 3
+
+
+async def test_concurrent_registrations_of_one_name_create_one_user():
+    await bootstrap()
+    user = User(email="alice@example.com", username="alice", password="secret", gender="female", avatarUrl="")
+
+    results = await asyncio.gather(*[app.register_user(user) for _ in range(5)], return_exceptions=True)
+
+    assert sum(1 for result in results if isinstance(result, dict)) == 1
+    refused = [result for result in results if not isinstance(result, dict)]
+    assert [(type(error), error.status_code, error.detail) for error in refused] == \
+        [(HTTPException, 400, "Username already registered")] * 4
+    assert await user_collection.count_documents({"username": "alice"}) == 1
@@ -0,0 +1,50 @@
+import asyncio
+import time
+
+import aiohttp
+import pytest
+import socketio
+
+from auth import create_access_token
+
+pytestmark = pytest.mark.anyio
+
+LOGINS = 8
+
+
+async def test_socket_latency_stays_flat_during_a_login_burst(backend):
+    # Every login is a bcrypt check of 100 ms or more; on the event loop, a burst would stall every socket
+    url = backend()
+    client = socketio.AsyncClient(reconnection=False)
+    await client.connect(url, socketio_path="/socket.io/", transports=["websocket"],
+                         auth={"token": create_access_token("bench0")})
+
+    async def round_trip():
+        started = time.perf_counter()
+        await client.call("read_message", {}, timeout=10)
+        return time.perf_counter() - started
+
+    try:
+        baseline = max([await round_trip() for _ in range(5)])
+        statuses = []
+
+        async def login(session, index):
+            async with session.post(f"{url}/login", params={"username": f"bench{index % 4}", "password": "bench"}) as response:
+                statuses.append(response.status)
+
+        async with aiohttp.ClientSession() as session:
+            burst = asyncio.gather(*[login(session, index) for index in range(LOGINS)])
+            during = []
+            started = time.perf_counter()
+            while not burst.done():
+                during.append(await round_trip())
+                await asyncio.sleep(0.02)
+            await burst
+            burst_seconds = time.perf_counter() - started
+
+        assert statuses.count(200) >= 1
+        # The burst takes several bcrypt checks of time, the socket never waits for one of them
+        assert during
+        assert max(during) < max(0.25, baseline * 5), (max(during), burst_seconds)
+    finally:
+        await client.disconnect()
@@ -0,0 +1,101 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+import message_store
+from db import chat_collection, message_collection
+from message_store import append_messages, decode_message_cursor, get_message_page, iter_messages
+
+pytestmark = pytest.mark.anyio
+
+NOW = datetime(2024, 5, 1, 12, 0, 0)
+
+
+def message(index, time=NOW, seq=None):
+    document = {"content": f"m{index}", "sender": "alice", "receiver": ["bob"], "time": time}
+    if seq is not None:
+        document["seq"] = seq
+    return document
+
+
+async def read_all(chat_id, limit):
+    # Walk the history backwards page by page, like a client scrolling up
+    contents, before = [], None
+    while True:
+        page = await get_message_page(chat_id, limit, before=before)
+        if not page:
+            return contents
+        contents[:0] = [m["content"] for _, m in page]
+        before = page[0][0]
+
+
+async def test_messages_sharing_a_time_are_all_paged(monkeypatch):
+    monkeypatch.setattr(message_store, "MESSAGE_BUCKET_SIZE", 4)
+    await chat_collection.insert_one({"_id": "alice_bob"})
+    # Legacy messages without seq, all in the same second, spread over several buckets
+    for index in range(10):
+        await append_messages("alice_bob", [message(index)])
+
+    assert await read_all("alice_bob", 3) == [f"m{index}" for index in range(10)]
+
+
+async def test_cursor_between_equal_times_uses_seq():
+    await chat_collection.insert_one({"_id": "alice_bob"})
+    await append_messages("alice_bob", [message(index, seq=index + 1) for index in range(6)])
+
+    first = await get_message_page("alice_bob", 2)
+    assert [m["seq"] for _, m in first] == [5, 6]
+    after = await get_message_page("alice_bob", 10, after=first[0][0])
+    assert [m["seq"] for _, m in after] == [6]
+    # A plain time cursor means before or after every message of that time
+    assert await get_message_page("alice_bob", 10, before=decode_message_cursor("2024-05-01T12:00:00Z", "before")) == []
+    assert await get_message_page("alice_bob", 10, after=decode_message_cursor("2024-05-01T12:00:00Z", "after")) == []
+
+
+async def test_concurrent_appends_keep_one_open_bucket(monkeypatch):
+    monkeypatch.setattr(message_store, "MESSAGE_BUCKET_SIZE", 5)
+    await chat_collection.insert_one({"_id": "alice_bob"})
+
+    async def flush(index):
+        await append_messages("alice_bob", [message(index, NOW + timedelta(milliseconds=index), seq=index + 1)])
+
+    await asyncio.gather(*[flush(index) for index in range(60)])
+
+    buckets = await message_collection.find({"chat_id": "alice_bob"}).to_list(length=None)
+    assert len([b for b in buckets if b["count"] < 5]) <= 1
+    assert sorted(b["_id"] for b in buckets) == sorted(f"alice_bob:{n}" for n in range(len(buckets)))
+    streamed = [m["seq"] async for m in iter_messages("alice_bob")]
+    assert streamed == list(range(1, 61))
+    assert [m["seq"] for m in await read_all_messages("alice_bob")] == list(range(1, 61))
+
+
+async def read_all_messages(chat_id):
+    page = await get_message_page(chat_id, 500)
+    return [m for _, m in page]
+
+
+async def test_opaque_cursor_round_trip():
+    key = ("2024-05-01T12:00:00.000000", 1, 7)
+    cursor = message_store.encode_message_cursor(key)
+    assert decode_message_cursor(cursor, "before") == key
+    with pytest.raises(ValueError):
+        decode_message_cursor("not a cursor", "before")
+
+
+async def test_migration_keeps_messages_sent_before_it_ran(monkeypatch):
+    monkeypatch.setattr(message_store, "MESSAGE_BUCKET_SIZE", 2)
+    legacy = [message(i, NOW + timedelta(seconds=i)) for i in range(3)]
+    await chat_collection.insert_one({"_id": "alice_bob", "messages": legacy})
+    # Sent after the deploy, before the embedded messages were moved
+    await append_messages("alice_bob", [message(3, NOW + timedelta(seconds=3), seq=1)])
+
+    assert await message_store.migrate_embedded_messages() == {"chats": 1, "messages": 3}
+    # Running it again, as after an interruption, changes nothing
+    assert await message_store.migrate_embedded_messages() == {"chats": 0, "messages": 0}
+    await append_messages("alice_bob", [message(4, NOW + timedelta(seconds=4), seq=2)])
+
+    assert await read_all("alice_bob", 2) == ["m0", "m1", "m2", "m3", "m4"]
+    assert "messages" not in await chat_collection.find_one({"_id": "alice_bob"})
+    assert sorted(await message_collection.distinct("_id")) == \
+        ["alice_bob:0", "alice_bob:legacy-000000", "alice_bob:legacy-000001"]
@@ -0,0 +1,79 @@
+import asyncio
+
+import httpx
+import pytest
+import socketio
+
+from auth import create_access_token
+
+pytestmark = pytest.mark.anyio
+
+
+async def connect(url, user, received):
+    client = socketio.AsyncClient(reconnection=False)
+    client.on("new_message", received.append)
+    await client.connect(url, socketio_path="/socket.io/", transports=["websocket"],
+                         auth={"token": create_access_token(user)})
+    await client.call("user_connected", {}, timeout=10)
+    return client
+
+
+async def wait_for(condition, timeout=10):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        if asyncio.get_running_loop().time() > deadline:
+            return False
+        await asyncio.sleep(0.05)
+    return True
+
+
+async def test_emit_on_one_worker_reaches_a_client_on_another(backend):
+    # Two workers behind the loopback broker; each seeds the same users and chats into its own in-memory database
+    queue = backend.broker()
+    env = {"SOCKETIO_MESSAGE_QUEUE": queue}
+    worker_a, worker_b = backend(env=env), backend(env=env)
+
+    on_a, on_b = [], []
+    sender = await connect(worker_a, "bench0", on_a)
+    receiver = await connect(worker_b, "bench1", on_b)
+    try:
+        ack = await sender.call("message", {"chat_id": "bench0_bench1", "content": "across workers",
+                                            "chatparticipants": ["bench0", "bench1"]}, timeout=10)
+        assert ack["status"] == "ok"
+
+        assert await wait_for(lambda: on_b), "message sent on worker A never reached the client on worker B"
+        assert [(m["chat_id"], m["sender"], m["content"], m["seq"]) for m in on_b] == \
+            [("bench0_bench1", "bench0", "across workers", ack["seq"])]
+        # The sender's own socket gets it once, not once per worker
+        await wait_for(lambda: on_a)
+        await asyncio.sleep(0.3)
+        assert len(on_a) == 1 and len(on_b) == 1
+    finally:
+        await sender.disconnect()
+        await receiver.disconnect()
+
+
+async def test_user_update_on_one_worker_clears_cached_credentials_on_another(backend):
+    queue = backend.broker()
+    env = {"SOCKETIO_MESSAGE_QUEUE": queue}
+    worker_a, worker_b = backend(env=env), backend(env=env)
+    admin = ("admin", "password123")
+
+    async with httpx.AsyncClient(timeout=10) as http:
+        async def cached_credentials():
+            status = await http.get(f"{worker_b}/server_status", auth=admin)
+            return status.json()["credential_cache"]["size"]
+
+        # No socket ever connects to worker B, it still has to hear the invalidation
+        assert (await http.get(f"{worker_b}/users/bench1", auth=("bench1", "bench"))).status_code == 200
+        assert await cached_credentials() == 1
+
+        update = await http.put(f"{worker_a}/users/bench1",
+                                json={"online_status": "Away", "aboutme": "changed", "timezone": "GMT"},
+                                headers={"Authorization": f"Bearer {create_access_token('bench1')}"})
+        assert update.status_code == 200
+
+        deadline = asyncio.get_running_loop().time() + 10
+        while await cached_credentials() and asyncio.get_running_loop().time() < deadline:
+            await asyncio.sleep(0.05)
+        assert await cached_credentials() == 0
@@ -0,0 +1,206 @@
+import asyncio
+import statistics
+import time
+
+import pytest
+import socketio
+from engineio import packet as eio_packet
+from fastapi import HTTPException
+from socketio import packet
+
+import rate_limit
+from auth import create_access_token, rate_limited_user
+from rate_limit import SOCKET_EVENT_BURST, LimitedServer, RateLimiter
+
+pytestmark = pytest.mark.anyio
+
+
+class Clock:
+    # Stands in for the time module of rate_limit, time only moves when a test moves it
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(rate_limit, "time", clock)
+    return clock
+
+
+def test_a_flooding_key_is_refused_while_other_keys_pass(clock):
+    limiter = RateLimiter("test", rate=2, burst=5, enabled=True)
+
+    assert [limiter.retry_after("flooder") for _ in range(5)] == [0] * 5
+    assert limiter.retry_after("flooder") == pytest.approx(0.5)
+    assert limiter.retry_after("flooder") == pytest.approx(0.5)
+    # Everybody else keeps a full bucket of their own
+    assert [limiter.retry_after(f"user{i}") for i in range(10)] == [0] * 10
+    assert limiter.limited == 2
+
+    # Half a second refills one token at 2 per second, then the flood is cut to the rate again
+    clock.now += 0.5
+    assert limiter.retry_after("flooder") == 0
+    assert limiter.retry_after("flooder") > 0
+
+
+def test_refill_stops_at_the_burst(clock):
+    limiter = RateLimiter("test", rate=10, burst=3, enabled=True)
+    limiter.retry_after("user")
+    clock.now += 60
+    assert [limiter.retry_after("user") for _ in range(4)][-1] > 0
+
+
+def test_the_least_recently_used_key_is_forgotten(clock):
+    limiter = RateLimiter("test", rate=1, burst=1, max_keys=2, enabled=True)
+    limiter.retry_after("a")
+    limiter.retry_after("b")
+    limiter.retry_after("c")
+    assert limiter.stats()["tracked"] == 2
+    # a starts over with a full bucket, b is still empty
+    assert limiter.retry_after("a") == 0
+    assert limiter.retry_after("c") > 0
+
+
+def test_a_disabled_limiter_allows_everything(clock):
+    limiter = RateLimiter("test", rate=1, burst=1, enabled=False)
+    assert [limiter.retry_after("flooder") for _ in range(100)] == [0] * 100
+
+
+async def test_server_refuses_the_events_of_a_flooding_socket_only(clock):
+    server = LimitedServer(async_mode="asgi", event_limiter=RateLimiter("socket_event", rate=1, burst=3, enabled=True))
+    handled = []
+
+    @server.on("ping")
+    async def ping(sid, data):
+        handled.append(sid)
+        return {"status": "ok"}
+
+    replies = [await server._trigger_event("ping", "/", "flooder", {}) for _ in range(5)]
+    assert replies[:3] == [{"status": "ok"}] * 3
+    assert replies[3:] == [{"status": "rate_limited", "retry_after": 1.0}] * 2
+    # The refused events never reached the handler, another socket's do
+    assert await server._trigger_event("ping", "/", "other", {}) == {"status": "ok"}
+    assert handled == ["flooder"] * 3 + ["other"]
+
+    # Reconnecting does not keep the empty bucket around
+    await server._trigger_event("disconnect", "/", "flooder", "client disconnect")
+    assert await server._trigger_event("ping", "/", "flooder", {}) == {"status": "ok"}
+
+
+async def test_rest_requests_beyond_the_limit_get_429(clock, monkeypatch):
+    monkeypatch.setattr("auth.rest_limiter", RateLimiter("rest", rate=0.5, burst=2, enabled=True))
+
+    assert await rate_limited_user(username="flooder") == "flooder"
+    assert await rate_limited_user(username="flooder") == "flooder"
+    with pytest.raises(HTTPException) as refused:
+        await rate_limited_user(username="flooder")
+    assert refused.value.status_code == 429
+    assert refused.value.headers["Retry-After"] == "2"
+    assert await rate_limited_user(username="someone-else") == "someone-else"
+
+
+async def connect_socket(url, user):
+    client = socketio.AsyncClient(reconnection=False)
+    await client.connect(url, socketio_path="/socket.io/", transports=["websocket"],
+                         auth={"token": create_access_token(user)})
+    await client.call("join_rooms", {}, timeout=10)
+    return client
+
+
+class SlowSocket:
+    # An Engine.IO socket whose client stopped reading
+    def __init__(self, queued):
+        self.queue = asyncio.Queue()
+        for _ in range(queued):
+            self.queue.put_nowait("unread")
+        self.closing = False
+        self.closed = False
+
+    async def close(self, wait=True, reason=None):
+        self.closing = self.closed = True
+
+
+def backpressure_server(policy, sockets):
+    server = LimitedServer(async_mode="asgi", outbound_limit=3, slow_consumer_policy=policy)
+    server.eio.sockets.update(sockets)
+    sent = []
+
+    async def send(eio_sid, data):
+        sent.append((eio_sid, data))
+
+    async def send_packet(eio_sid, pkt):
+        sent.append((eio_sid, pkt))
+    server.eio.send = send
+    server.eio.send_packet = send_packet
+    return server, sent
+
+
+def event(name="new_message"):
+    return packet.Packet(packet.EVENT, data=[name, {}])
+
+
+async def test_events_to_a_full_queue_are_dropped():
+    server, sent = backpressure_server("drop", {"slow": SlowSocket(3), "fast": SlowSocket(0)})
+
+    await server._send_packet("slow", event())
+    await server._send_eio_packet("slow", eio_packet.Packet(eio_packet.MESSAGE, data="broadcast"))
+    await server._send_packet("fast", event())
+    # Acknowledgements still go out, the client is waiting for them
+    await server._send_packet("slow", packet.Packet(packet.ACK, data=[{"status": "ok"}], id=1))
+
+    assert [eio_sid for eio_sid, _ in sent] == ["fast", "slow"]
+    assert server.backpressure_stats()["dropped_packets"] == 2
+    assert not server.eio.sockets["slow"].closed
+
+
+async def test_a_full_queue_disconnects_the_slow_consumer():
+    slow = SlowSocket(3)
+    server, sent = backpressure_server("disconnect", {"slow": slow, "fast": SlowSocket(0)})
+
+    await server._send_packet("slow", event())
+    await server._send_packet("fast", event())
+    await asyncio.sleep(0)
+
+    assert [eio_sid for eio_sid, _ in sent] == ["fast"]
+    # Its unread packets are thrown away so the close goes out next
+    assert slow.closed and slow.queue.empty()
+    assert "slow" not in server.eio.sockets and "fast" in server.eio.sockets
+    assert server.backpressure_stats()["slow_disconnects"] == 1
+
+
+async def round_trips(client, chat_id, count):
+    latencies = []
+    for index in range(count):
+        started = time.perf_counter()
+        ack = await client.call("message", {"chat_id": chat_id, "content": f"probe {index}"}, timeout=10)
+        latencies.append(time.perf_counter() - started)
+        assert ack["status"] == "ok"
+    return statistics.median(latencies)
+
+
+async def test_a_flooding_client_does_not_slow_down_the_others(backend):
+    # Acknowledged once queued, so the round trip is the server's own work and not the write interval
+    url = backend(users=4, env={"MESSAGE_DURABILITY": "enqueue"})
+    flooder = await connect_socket(url, "bench0")
+    other = await connect_socket(url, "bench2")
+    try:
+        quiet = await round_trips(other, "bench2_bench3", 8)
+
+        # A thousand message events at once, far past the socket's burst
+        flood = asyncio.gather(*[flooder.call("message", {"chat_id": "bench0_bench1", "content": f"flood {index}"},
+                                              timeout=30) for index in range(1000)])
+        await asyncio.sleep(0)
+        during = await round_trips(other, "bench2_bench3", 8)
+        acks = await flood
+
+        # Refused before the handler runs: only the burst is written and fanned out
+        assert sum(1 for ack in acks if ack["status"] == "ok") <= SOCKET_EVENT_BURST + 5
+        # so the other client's messages keep their pace, give or take decoding the refused events
+        assert during < quiet + 0.05, (quiet, during)
+    finally:
+        await flooder.disconnect()
+        await other.disconnect()
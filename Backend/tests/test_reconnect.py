@@ -0,0 +1,62 @@
+import pytest
+import socketio
+
+from auth import create_access_token
+from test_multi_worker import wait_for
+
+pytestmark = pytest.mark.anyio
+
+CHAT = "bench0_bench1"
+
+
+async def connect(url, user, received, resume=None):
+    client = socketio.AsyncClient(reconnection=False)
+    client.on("new_message", lambda data: received.append(data["seq"]))
+    await client.connect(url, socketio_path="/socket.io/", transports=["websocket"],
+                         auth={"token": create_access_token(user)})
+    ack = await client.call("join_rooms", {"resume": resume or {}}, timeout=10)
+    return client, ack
+
+
+async def send(client, count):
+    seqs = []
+    for index in range(count):
+        ack = await client.call("message", {"chat_id": CHAT, "content": f"message {index}"}, timeout=10)
+        assert ack["status"] == "ok"
+        seqs.append(ack["seq"])
+    return seqs
+
+
+# The replay log of one worker, and the message store as with several workers,
+# where the missed messages are still in the write pipeline when the socket comes back
+@pytest.mark.parametrize("env", [
+    {},
+    {"REPLAY_LOG_ENABLED": "false", "SEQ_BLOCK_SIZE": "1", "MESSAGE_DURABILITY": "enqueue",
+     "MESSAGE_FLUSH_INTERVAL_MS": "500"},
+], ids=["replay_log", "store"])
+async def test_reconnect_mid_stream_replays_exactly_the_missed_messages(backend, env):
+    url = backend(users=2, env=env)
+    sender, _ = await connect(url, "bench0", [])
+    before = []
+    receiver, _ = await connect(url, "bench1", before)
+    try:
+        sent = await send(sender, 5)
+        assert await wait_for(lambda: len(before) == 5)
+        await receiver.disconnect()
+
+        missed = await send(sender, 7)
+        after = []
+        receiver, ack = await connect(url, "bench1", after, resume={CHAT: max(before)})
+        replay = ack["replay"][CHAT]
+        sent += missed + await send(sender, 3)
+        assert await wait_for(lambda: len(after) == 3)
+
+        replayed = [message["seq"] for message in replay["messages"]]
+        assert replay["reset"] is False
+        # Only what the socket missed, so its cost follows the gap and not the chat's history
+        assert replayed == missed
+        received = before + replayed + after
+        assert sorted(received) == sent, "a message was lost or delivered twice"
+    finally:
+        await sender.disconnect()
+        await receiver.disconnect()
@@ -0,0 +1,127 @@
+import asyncio
+
+import pytest
+
+import app
+import message_store
+import replay
+from db import chat_collection
+from models import ChatMessage
+from replay import replay_log, replay_missed, sequences
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def multi_worker_chat(monkeypatch):
+    # What SOCKETIO_MESSAGE_QUEUE sets: numbers one at a time and no replay log
+    monkeypatch.setattr(sequences, "block_size", 1)
+    monkeypatch.setattr(replay_log, "enabled", False)
+    await chat_collection.insert_one({"_id": "alice_bob", "participants": ["alice", "bob"], "readSeq": {}, "last_seq": 0})
+    return "alice_bob"
+
+
+def message(chat_id, seq):
+    return ChatMessage.create(chat_id, "alice", ["bob"], f"message {seq}", seq)
+
+
+async def test_replay_waits_for_messages_still_in_a_write_pipeline(multi_worker_chat):
+    chat_id = multi_worker_chat
+    seqs = [await sequences.next(chat_id) for _ in range(3)]
+    # Another worker fanned out all three, but has stored only the first two so far
+    await app.persist_messages(chat_id, [message(chat_id, seq) for seq in seqs[:2]])
+
+    replaying = asyncio.create_task(replay_missed(chat_id, 0))
+    await asyncio.sleep(0.1)
+    assert not replaying.done()
+
+    await app.persist_messages(chat_id, [message(chat_id, seqs[2])])
+    result = await asyncio.wait_for(replaying, 5)
+    assert [payload["seq"] for payload in result["messages"]] == seqs
+    assert result["reset"] is False
+
+
+async def test_replay_waits_for_a_lower_seq_another_worker_stores_later(multi_worker_chat):
+    chat_id = multi_worker_chat
+    first, second = [await sequences.next(chat_id) for _ in range(2)]
+    # Worker B stored its message while worker A still holds the one numbered before it
+    await app.persist_messages(chat_id, [message(chat_id, second)])
+
+    replaying = asyncio.create_task(replay_missed(chat_id, 0))
+    await asyncio.sleep(0.1)
+    assert not replaying.done()
+
+    await app.persist_messages(chat_id, [message(chat_id, first)])
+    result = await asyncio.wait_for(replaying, 5)
+    assert [payload["seq"] for payload in result["messages"]] == [first, second]
+
+
+async def test_last_seq_is_raised_only_once_the_batch_is_stored(multi_worker_chat, monkeypatch):
+    chat_id = multi_worker_chat
+    seq = await sequences.next(chat_id)
+    stored = asyncio.Event()
+    original = app.append_messages
+
+    async def slow_append(*args):
+        await stored.wait()
+        await original(*args)
+    monkeypatch.setattr(app, "append_messages", slow_append)
+
+    persisting = asyncio.create_task(app.persist_messages(chat_id, [message(chat_id, seq)]))
+    await asyncio.sleep(0.05)
+    assert (await chat_collection.find_one({"_id": chat_id}))["last_seq"] == 0
+    replaying = asyncio.create_task(replay_missed(chat_id, 0))
+    await asyncio.sleep(0.1)
+    assert not replaying.done()
+
+    stored.set()
+    await persisting
+    assert (await chat_collection.find_one({"_id": chat_id}))["last_seq"] == seq
+    assert [payload["seq"] for payload in (await asyncio.wait_for(replaying, 5))["messages"]] == [seq]
+
+
+async def test_replay_from_the_store_reads_only_the_buckets_after_the_seq(multi_worker_chat, monkeypatch):
+    monkeypatch.setattr(message_store, "MESSAGE_BUCKET_SIZE", 10)
+    chat_id = multi_worker_chat
+    seqs = [await sequences.next(chat_id) for _ in range(100)]
+    for start in range(0, 100, 10):
+        await app.persist_messages(chat_id, [message(chat_id, seq) for seq in seqs[start:start + 10]])
+
+    read = []
+    original = message_store.iter_buckets
+
+    async def counting(*args, **kwargs):
+        async for bucket in original(*args, **kwargs):
+            read.append(bucket["_id"])
+            yield bucket
+    monkeypatch.setattr(message_store, "iter_buckets", counting)
+
+    for missed in (3, 25):
+        read.clear()
+        result = await replay_missed(chat_id, 100 - missed)
+        assert [payload["seq"] for payload in result["messages"]] == seqs[-missed:]
+        # The buckets holding the missed messages, not the chat's whole history
+        assert len(read) == -(-missed // 10)
+
+
+async def test_replay_does_not_wait_when_nothing_is_missing(multi_worker_chat):
+    chat_id = multi_worker_chat
+    seqs = [await sequences.next(chat_id) for _ in range(2)]
+    await app.persist_messages(chat_id, [message(chat_id, seq) for seq in seqs])
+
+    result = await asyncio.wait_for(replay_missed(chat_id, 0), 0.5)
+    assert [payload["seq"] for payload in result["messages"]] == seqs
+    assert (await asyncio.wait_for(replay_missed(chat_id, seqs[-1]), 0.5))["messages"] == []
+
+
+async def test_replay_gives_up_waiting_for_a_message_never_stored(multi_worker_chat, monkeypatch):
+    monkeypatch.setattr(replay, "REPLAY_STORE_WAIT", 0.2)
+    chat_id = multi_worker_chat
+    seqs = [await sequences.next(chat_id) for _ in range(2)]
+    # The second one was lost with its worker
+    await app.persist_messages(chat_id, [message(chat_id, seqs[0])])
+    timeouts = replay.replay_counts["store_wait_timeout"]
+
+    result = await asyncio.wait_for(replay_missed(chat_id, 0), 2)
+    assert [payload["seq"] for payload in result["messages"]] == seqs[:1]
+    assert replay.replay_counts["store_wait_timeout"] == timeouts + 1
@@ -0,0 +1,112 @@
+from datetime import datetime, timedelta
+
+import pytest
+from bson.binary import Binary
+
+import message_store
+import retention
+from db import chat_collection, message_archive_collection, message_collection
+from message_store import append_messages, compress_messages, get_message_page, get_messages_after_seq, iter_messages
+from models import ChatMessage
+from retention import CompactionJob
+from search_index import search_index
+
+pytestmark = pytest.mark.anyio
+
+NOW = datetime(2024, 5, 1)
+CHAT = "alice_bob"
+
+
+def days_ago(days):
+    return NOW - timedelta(days=days)
+
+
+def message(seq, time):
+    return {"content": f"hello {seq}", "sender": "alice", "receiver": ["bob"], "time": time, "seq": seq}
+
+
+@pytest.fixture
+async def chat(monkeypatch):
+    monkeypatch.setattr(message_store, "MESSAGE_BUCKET_SIZE", 2)
+    monkeypatch.setattr(retention, "MESSAGE_BUCKET_SIZE", 2)
+    await search_index.clear()
+    await chat_collection.insert_one({"_id": CHAT, "participants": ["alice", "bob"]})
+    yield CHAT
+    await search_index.clear()
+
+
+async def index(bucket_messages):
+    await search_index.add(CHAT, [ChatMessage(CHAT, m["sender"], m["receiver"], m["content"], m["time"], m["seq"])
+                                  for m in bucket_messages])
+
+
+async def searched_seqs():
+    results, _ = await search_index.search("hello", [CHAT], limit=50)
+    return sorted(int(result["snippet"].split()[-1]) for result in results)
+
+
+async def test_full_old_buckets_are_archived_and_still_read(chat):
+    await chat_collection.update_one({"_id": chat}, {"$set": {"retention": {"archive_after_days": 30, "delete_after_days": 0}}})
+    for seqs in ((1, 2), (3, 4), (5,)):
+        await append_messages(chat, [message(seq, days_ago(60 - seq)) for seq in seqs])
+
+    report = await CompactionJob(interval=0, buckets_per_second=0).compact(now=NOW)
+
+    assert (report["archived_buckets"], report["archived_messages"], report["deleted_messages"]) == (2, 4, 0)
+    assert report["bytes_reclaimed"] == report["bytes_before"] - report["bytes_after"]
+    # The open bucket stays live, the full ones move
+    assert await message_collection.distinct("_id") == [f"{chat}:2"]
+    assert sorted(await message_archive_collection.distinct("_id")) == [f"{chat}:0", f"{chat}:1"]
+
+    everything = [1, 2, 3, 4, 5]
+    assert [m["seq"] for _, m in await get_message_page(chat, 10)] == everything
+    page = await get_message_page(chat, 2)
+    assert [m["seq"] for _, m in await get_message_page(chat, 10, before=page[0][0])] == [1, 2, 3]
+    assert [m["seq"] async for m in iter_messages(chat)] == everything
+    assert [m["seq"] for m in await get_messages_after_seq(chat, 2)] == [3, 4, 5]
+
+    # Running again finds nothing new to move
+    report = await CompactionJob(interval=0, buckets_per_second=0).compact(now=NOW)
+    assert report["archived_buckets"] == 0
+
+
+async def test_deletion_removes_the_search_rows_of_deleted_buckets_only(chat):
+    await chat_collection.update_one({"_id": chat}, {"$set": {"retention": {"archive_after_days": 0, "delete_after_days": 30}}})
+    # Written by two workers: the kept bucket starts before the deleted ones end
+    kept = [message(1, days_ago(60)), message(6, days_ago(10))]
+    deleted_live = [message(2, days_ago(50)), message(3, days_ago(45))]
+    deleted_archived = [message(4, days_ago(42)), message(5, days_ago(40))]
+    await message_collection.insert_many([
+        {"_id": f"{chat}:0", "chat_id": chat, "start": days_ago(60), "end": days_ago(10), "count": 2,
+         "last_seq": 6, "messages": kept},
+        {"_id": f"{chat}:1", "chat_id": chat, "start": days_ago(50), "end": days_ago(45), "count": 2,
+         "last_seq": 3, "messages": deleted_live},
+    ])
+    await message_archive_collection.insert_one(
+        {"_id": f"{chat}:2", "chat_id": chat, "start": days_ago(42), "end": days_ago(40), "count": 2, "last_seq": 5,
+         "codec": "zlib", "data": Binary(compress_messages(deleted_archived))})
+    for bucket_messages in (kept, deleted_live, deleted_archived):
+        await index(bucket_messages)
+    assert await searched_seqs() == [1, 2, 3, 4, 5, 6]
+
+    report = await CompactionJob(interval=0, buckets_per_second=0).compact(now=NOW)
+
+    assert (report["deleted_buckets"], report["deleted_messages"]) == (2, 4)
+    assert [m["seq"] for _, m in await get_message_page(chat, 10)] == [1, 6]
+    # The kept bucket's message from before the deleted ones is still found
+    assert await searched_seqs() == [1, 6]
+
+
+async def test_messages_from_before_seqs_are_removed_by_time_and_content(chat):
+    await chat_collection.update_one({"_id": chat}, {"$set": {"retention": {"archive_after_days": 0, "delete_after_days": 30}}})
+    old = [{"content": "hello 7", "sender": "alice", "receiver": ["bob"], "time": "2024-02-01T10:00:00.000Z"},
+           {"content": "hello 8", "sender": "alice", "receiver": ["bob"], "time": "2024-02-01T10:00:01.000Z"}]
+    await message_collection.insert_one({"_id": f"{chat}:legacy-000000", "chat_id": chat, "start": datetime(2024, 2, 1, 10),
+                                         "end": datetime(2024, 2, 1, 10, 0, 1), "count": 2, "messages": old})
+    await append_messages(chat, [message(1, days_ago(1))])
+    await search_index.rebuild()
+    assert await searched_seqs() == [1, 7, 8]
+
+    await CompactionJob(interval=0, buckets_per_second=0).compact(now=NOW)
+
+    assert await searched_seqs() == [1]
@@ -0,0 +1,42 @@
+import pytest
+
+import app
+from db import chat_collection
+from models import ChatMessage
+from search_index import search_index
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def chat():
+    await search_index.clear()
+    await chat_collection.insert_one({"_id": "alice_bob", "participants": ["alice", "bob"], "readSeq": {}})
+    yield "alice_bob"
+    await search_index.clear()
+
+
+async def test_snippet_escapes_the_message(chat):
+    await app.persist_messages(chat, [ChatMessage.create(chat, "alice", ["bob"], '<img src=x onerror="alert(1)"> hello', 1)])
+
+    results, _ = await search_index.search("hello", [chat])
+
+    assert results[0]["snippet"] == "&lt;img src=x onerror=&quot;alert(1)&quot;&gt; <mark>hello</mark>"
+
+
+async def test_rebuild_does_not_index_live_batches_twice(chat, monkeypatch):
+    # A batch stored and indexed after the rebuild cleared the index, but before it read that chat
+    await app.persist_messages(chat, [ChatMessage.create(chat, "alice", ["bob"], f"hello {seq}", seq)
+                                      for seq in (1, 2, 3)])
+    async def cleared():
+        pass
+    monkeypatch.setattr(search_index, "clear", cleared)
+
+    assert await search_index.rebuild() == 0
+    results, _ = await search_index.search("hello", [chat])
+    assert len(results) == 3
+
+    # A batch indexed twice by the app, e.g. after a retried write, is one result as well
+    await search_index.add(chat, [ChatMessage.create(chat, "alice", ["bob"], "hello 3", 3)])
+    results, _ = await search_index.search("hello", [chat])
+    assert len(results) == 3
@@ -0,0 +1,58 @@
+import asyncio
+
+import pytest
+import socketio
+from jose import jwt
+
+from auth import ALGORITHM, create_access_token
+
+pytestmark = pytest.mark.anyio
+
+
+async def connect(url, auth):
+    client = socketio.AsyncClient(reconnection=False)
+    await client.connect(url, socketio_path="/socket.io/", transports=["websocket"], auth=auth)
+    return client
+
+
+async def test_connect_needs_credentials(backend):
+    url = backend()
+
+    for auth in (None, {"username": "bench0"}, {"username": "bench0", "password": "wrong"},
+                 {"token": jwt.encode({"sub": "bench0"}, "another-key", algorithm=ALGORITHM)}):
+        with pytest.raises(socketio.exceptions.ConnectionError):
+            await connect(url, auth)
+
+    client = await connect(url, {"username": "bench0", "password": "bench"})
+    await client.disconnect()
+
+
+async def test_events_act_as_the_authenticated_user(backend):
+    url = backend()
+    received = {"bench0": [], "bench1": [], "bench2": []}
+    clients = {}
+    for user in received:
+        client = await connect(url, {"token": create_access_token(user)})
+        client.on("new_message", received[user].append)
+        clients[user] = client
+        # The username in the event is ignored, each socket joins the rooms of its own user
+        await client.call("user_connected", {"username": "bench1"}, timeout=10)
+
+    # bench0 claims to be bench1 and names bench2 instead of bench1 as the receiver:
+    # the message is still sent as bench0, to the chat's participants
+    ack = await clients["bench0"].call("message", {
+        "chat_id": "bench0_bench1", "content": "hi", "sender": "bench1", "chatparticipants": ["bench0", "bench2"],
+    }, timeout=10)
+    assert ack["status"] == "ok"
+    # bench2 is not in the chat and may not write to it
+    ack = await clients["bench2"].call("message", {
+        "chat_id": "bench0_bench1", "content": "spoofed", "sender": "bench0", "chatparticipants": ["bench0", "bench1"],
+    }, timeout=10)
+    assert ack["status"] == "error"
+
+    await asyncio.sleep(0.3)
+    assert [(m["sender"], m["content"], m["receiver"]) for m in received["bench1"]] == [("bench0", "hi", ["bench1"])]
+    assert received["bench2"] == []
+    for client in clients.values():
+        await client.disconnect()
+
@@ -0,0 +1,108 @@
+import asyncio
+import random
+
+import pytest
+
+import app
+from db import chat_collection
+from inbox import add_chat, get_inbox_page
+from ingest import MessagePipeline, ReadReceiptBatcher
+from models import ChatMessage
+from pymongo import DESCENDING
+from replay import sequences
+
+pytestmark = pytest.mark.anyio
+
+SENDERS = [f"user{i}" for i in range(8)]
+READER = "reader"
+IDLE = "idle"
+MESSAGES_PER_SENDER = 40
+
+
+async def unread_of(user, chat_id):
+    rows = await get_inbox_page(user, "last_updated", DESCENDING, 10)
+    return next(row["unreadMessageCounter"] for row in rows if row["_id"] == chat_id)
+
+
+async def test_counters_stay_exact_under_concurrent_senders_and_reads():
+    participants = SENDERS + [READER, IDLE]
+    chat = {"_id": "group", "name": "group", "image": "", "participants": participants, "created_at": None,
+            "created_by": SENDERS[0], "last_updated": None, "last_updated_by": None, "latestMessage": None,
+            "readSeq": {}}
+    await chat_collection.insert_one(dict(chat))
+    await add_chat(chat)
+
+    # Small batches and short ticks, so writes of messages and reads interleave in every order
+    pipeline = MessagePipeline(app.persist_messages, batch_size=3, flush_interval=0.002)
+    reads = ReadReceiptBatcher(app.store_read_receipts, interval=0.003)
+    pipeline.start()
+    reads.start()
+    fanned_out = []
+    read_up_to = 0
+
+    async def send(sender):
+        for index in range(MESSAGES_PER_SENDER):
+            seq = await sequences.next("group")
+            message = ChatMessage.create("group", sender, [p for p in participants if p != sender], f"{sender} {index}", seq)
+            pipeline.submit("group", message)
+            fanned_out.append(seq)
+            await asyncio.sleep(random.random() / 1000)
+
+    async def read():
+        # The reader has the chat open and reads whatever it was sent so far, often before it is stored
+        nonlocal read_up_to
+        while len(fanned_out) < len(SENDERS) * MESSAGES_PER_SENDER:
+            if fanned_out:
+                read_up_to = max(read_up_to, max(fanned_out))
+                reads.submit("group", READER, read_up_to)
+            await asyncio.sleep(random.random() / 500)
+
+    random.seed(8)
+    await asyncio.gather(read(), *[send(sender) for sender in SENDERS])
+    await pipeline.stop()
+    await reads.stop()
+
+    total = len(SENDERS) * MESSAGES_PER_SENDER
+    assert sorted(fanned_out) == list(range(1, total + 1))
+    assert await unread_of(READER, "group") == total - read_up_to
+    assert await unread_of(IDLE, "group") == total
+    for sender in SENDERS:
+        assert await unread_of(sender, "group") == total - MESSAGES_PER_SENDER
+
+    # Reading everything brings every counter to zero, whatever is still in flight
+    reads.submit("group", IDLE, total)
+    await reads.flush()
+    assert await unread_of(IDLE, "group") == 0
+    stored = await chat_collection.find_one({"_id": "group"})
+    assert stored["last_seq"] == total and stored["readSeq"][IDLE] == total
+
+
+async def test_a_read_written_before_the_messages_it_covers_still_counts():
+    chat = {"_id": "alice_bob", "name": "", "image": "", "participants": ["alice", "bob"], "created_at": None,
+            "created_by": "alice", "last_updated": None, "last_updated_by": None, "latestMessage": None, "readSeq": {}}
+    await chat_collection.insert_one(dict(chat))
+    await add_chat(chat)
+
+    # bob read up to seq 2 on the fan-out, before the batch holding 1..3 was stored
+    await app.store_read_receipts({"alice_bob": {"bob": 2}})
+    await app.persist_messages("alice_bob", [ChatMessage.create("alice_bob", "alice", ["bob"], str(seq), seq)
+                                             for seq in (1, 2, 3)])
+    assert await unread_of("bob", "alice_bob") == 1
+
+
+async def test_rebuilt_rows_keep_the_counts():
+    from inbox import rebuild_inboxes
+    from db import inbox_collection
+
+    chat = {"_id": "alice_bob", "name": "", "image": "", "participants": ["alice", "bob"], "created_at": None,
+            "created_by": "alice", "last_updated": None, "last_updated_by": None, "latestMessage": None, "readSeq": {}}
+    await chat_collection.insert_one(dict(chat))
+    await add_chat(chat)
+    await app.persist_messages("alice_bob", [ChatMessage.create("alice_bob", "alice", ["bob"], str(seq), seq)
+                                             for seq in range(1, 6)])
+    await app.store_read_receipts({"alice_bob": {"bob": 3}})
+
+    await inbox_collection.delete_many({})
+    await rebuild_inboxes()
+    assert await unread_of("bob", "alice_bob") == 2
+    assert await unread_of("alice", "alice_bob") == 0
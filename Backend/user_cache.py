@@ -0,0 +1,71 @@
+"""Read-through cache of user profiles.
+
+Profiles are read on every ``user_connected`` event and profile view but
+change rarely, so the public part of each user record (never the password) is
+kept in a ``TTLCache``. Every entry holds the whole public profile and readers
+pick the fields they need, so one entry serves every projection.
+
+``update_user`` and ``register_user`` keep the cache in step on this worker.
+Other workers see a change once their entry expires after ``USER_CACHE_TTL``
+seconds.
+"""
+import os
+
+from cache import TTLCache
+from db import user_collection
+
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", "60"))
+
+# Everything of a user record except the password hash
+PROFILE_FIELDS = ("username", "email", "online_status", "timezone", "aboutme",
+                  "gender", "avatarUrl", "creation_date")
+PROFILE_PROJECTION = dict({field: 1 for field in PROFILE_FIELDS}, _id=0)
+
+profile_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+
+
+def project(profile, fields):
+    return {field: profile[field] for field in fields if field in profile}
+
+
+def store_profile(user):
+    # Write-through for a record that was just written to the database
+    profile_cache.set(user["username"], project(user, PROFILE_FIELDS))
+
+
+def invalidate_profile(username=None):
+    if username is None:
+        profile_cache.clear()
+    else:
+        profile_cache.pop(username)
+
+
+async def get_profile(username, fields=PROFILE_FIELDS):
+    """Return the requested fields of a user's profile, None for an unknown user."""
+    profile = profile_cache.get(username)
+    if profile is None:
+        profile = await user_collection.find_one({"username": username}, PROFILE_PROJECTION)
+        if profile is None:
+            return None
+        profile_cache.set(username, profile)
+    return project(profile, fields)
+
+
+async def get_profiles(usernames, fields=PROFILE_FIELDS):
+    """Return {username: profile} for the known users, loading every missing one in a single query."""
+    profiles = {}
+    missing = []
+    for username in set(usernames):
+        profile = profile_cache.get(username)
+        if profile is None:
+            missing.append(username)
+        else:
+            profiles[username] = profile
+
+    if missing:
+        async for profile in user_collection.find({"username": {"$in": missing}}, PROFILE_PROJECTION):
+            profile_cache.set(profile["username"], profile)
+            profiles[profile["username"]] = profile
+
+    return {username: project(profile, fields) for username, profile in profiles.items()}
@@ -37,7 +37,7 @@ const ChatPage = () => {
       }
 
       const data = await response.json();
-      const formattedChats = data.map(chat => ({
+      const formattedChats = data.chats.map(chat => ({
         id: chat._id,
         name: chat.name,
         image: chat.image,
@@ -69,11 +69,22 @@ const ChatPage = () => {
           path: "/socket.io/",
           transports: ['websocket'],
           timeout: 5000,
+          // Authenticated on connect, the server takes the username from here and not from the events
+          auth: (cb) => cb({
+            token: localStorage.getItem('token'),
+            username: localStorage.getItem('username'),
+            password: localStorage.getItem('password'),
+          }),
         });
 
         if (!isConnected.current) {
           console.log('Socket connected. Emitting user_connected...');
-          socket.emit('user_connected', { username: parsedUser.name });          
+          // The acknowledgement carries the first page of the online user list
+          socket.emit('user_connected', {}, (snapshot) => {
+            if (snapshot && snapshot.online_users) {
+              setOnlineUsers(snapshot.online_users);
+            }
+          });
           
           setLoggedInUser(parsedUser);
           console.log(loggedInUser);
@@ -85,16 +96,18 @@ const ChatPage = () => {
           if (parsedUser.name !== data.username) {
             toast.success(`${data.username} is online!`);
           }
-          // Update the onlineUsers state with the list returned from data.online_users
-          setOnlineUsers(data.online_users);
+          // Only the user who came online is sent, add it to the list
+          setOnlineUsers((prevUsers) =>
+            prevUsers.includes(data.username) ? prevUsers : [...prevUsers, data.username]
+          );
           console.log(`${data.username} is online`);
         });
 
         // Listen for users going offline
         socket.on('user_offline', (data) => {
           toast.warn(`${data.username} is offline!`);
-          // Update the onlineUsers state with the list returned from data.online_users
-          setOnlineUsers(data.online_users);
+          // Only the user who went offline is sent, remove it from the list
+          setOnlineUsers((prevUsers) => prevUsers.filter((user) => user !== data.username));
           console.log(`${data.username} is offline`);
         });
 
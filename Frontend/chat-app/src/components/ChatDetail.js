@@ -9,7 +9,58 @@ import 'react-toastify/dist/ReactToastify.css';
 const socket = io("http://localhost:8000", {
   path: "/socket.io/", // Ensure the correct Socket.IO path is used
   transports: ['websocket'], // WebSocket transport
-  timeout: 5000 // Timeout in milliseconds
+  timeout: 5000, // Timeout in milliseconds
+  // The server authenticates the socket on connect; the credentials let a reconnect succeed after the token expired
+  auth: (cb) => cb({
+    token: localStorage.getItem('token'),
+    username: localStorage.getItem('username'),
+    password: localStorage.getItem('password'),
+  }),
+});
+
+// Highest message seq seen per chat, and the seqs themselves so a message replayed and also received live shows once
+const lastSeqs = {};
+const seenSeqs = {};
+// Highest seq per chat not acknowledged to the server yet
+let pendingAcks = {};
+
+// Returns false for a message that was already delivered
+const noteSeq = (msg) => {
+  if (typeof msg.seq !== 'number') return true;
+  const seen = seenSeqs[msg.chat_id] || (seenSeqs[msg.chat_id] = new Set());
+  if (seen.has(msg.seq)) return false;
+  seen.add(msg.seq);
+  if (msg.seq > (lastSeqs[msg.chat_id] || 0)) {
+    lastSeqs[msg.chat_id] = msg.seq;
+    pendingAcks[msg.chat_id] = msg.seq;
+  }
+  return true;
+};
+
+// Acknowledge received messages once a second, senders see them as delivered
+setInterval(() => {
+  if (socket.connected && Object.keys(pendingAcks).length > 0) {
+    socket.emit('ack_messages', { acks: pendingAcks });
+    pendingAcks = {};
+  }
+}, 1000);
+
+// Messages are only sent to the rooms of the chat participants, so join them on every (re)connect.
+// After a drop the server replays what was sent since the last seq seen in each chat.
+socket.on('connect', () => {
+  const storedUser = localStorage.getItem('user');
+  if (storedUser) {
+    socket.emit('join_rooms', { resume: { ...lastSeqs } }, (ack) => {
+      Object.entries((ack && ack.replay) || {}).forEach(([chatId, replay]) => {
+        if (replay.reset) {
+          // Too much was missed, the open chat reloads its history instead
+          socket.listeners('chat_reset').forEach((handler) => handler(chatId));
+        } else {
+          replay.messages.forEach((msg) => socket.listeners('new_message').forEach((handler) => handler(msg)));
+        }
+      });
+    });
+  }
 });
 
 // You can import the sound file or reference it from the public folder
@@ -33,6 +84,7 @@ const ChatDetail = ({ chatId, chatName, chatimage, onUpdateMessage, chatparticip
   const [onlinestatus, setOnlineStatus] = useState(false);
   const [showEmojiPicker, setShowEmojiPicker] = useState(false); // State to show/hide emoji picker
   const [messages, setMessages] = useState([]); // State for chat messages
+  const [deliveredSeq, setDeliveredSeq] = useState(0); // Own messages up to this seq reached the other participants
   const isConnected = useRef(false); // Track connection status
   const [receiverDetails, setReceiverDetails] = useState(
     {
@@ -156,6 +208,7 @@ const ChatDetail = ({ chatId, chatName, chatimage, onUpdateMessage, chatparticip
   useEffect(() => {
     // Clear previous chat's messages
     setMessages([]);
+    setDeliveredSeq(0);
 
     if (!isConnected.current) {
       isConnected.current = true; // Mark the socket as connected
@@ -172,12 +225,14 @@ const ChatDetail = ({ chatId, chatName, chatimage, onUpdateMessage, chatparticip
 
         if (!response.ok) throw new Error('Failed to fetch messages');
         const data = await response.json();
-        // Set the messages in state
+        // Set the messages in state, and remember their seqs so a replay after a reconnect starts from the newest
+        data.messages.forEach((msg) => noteSeq({ ...msg, chat_id: chatId }));
         setMessages(data.messages);
 
         // Check if there are any messages, and if so, emit the 'read_message' event
+        // with the newest seq shown, messages sent after it stay unread
         if (data.messages.length > 0) {
-          socket.emit('read_message', { chatid: chatId });
+          socket.emit('read_message', { chatid: chatId, seq: lastSeqs[chatId] });
           onUpdateMessage(chatId, null, true);
         }
       } catch (error) {
@@ -188,6 +243,8 @@ const ChatDetail = ({ chatId, chatName, chatimage, onUpdateMessage, chatparticip
     fetchMessages();
 
     const handleNewMessage = (msg) => {
+      // Replayed after a reconnect and also received live
+      if (!noteSeq(msg)) return;
       console.log(msg);
       console.log(loggedInUser.name);
 
@@ -229,16 +286,32 @@ const ChatDetail = ({ chatId, chatName, chatimage, onUpdateMessage, chatparticip
       }
       if (msg.chat_id === chatId) {
         setMessages((prevMessages) => [...prevMessages, msg]);
-        socket.emit('read_message', { chatid: chatId });
+        socket.emit('read_message', { chatid: chatId, seq: msg.seq });
         onUpdateMessage(chatId, null, true);
       }
     };
 
+    const handleDelivered = (data) => {
+      if (data.chat_id !== chatId) return;
+      const others = Object.entries(data.delivered).filter(([user]) => user !== loggedInUser.name);
+      if (others.length > 0) {
+        setDeliveredSeq((prevSeq) => Math.max(prevSeq, ...others.map(([, seq]) => seq)));
+      }
+    };
+
+    const handleReset = (resetChatId) => {
+      if (resetChatId === chatId) fetchMessages();
+    };
+
     socket.on("new_message", handleNewMessage);
+    socket.on("messages_delivered", handleDelivered);
+    socket.on("chat_reset", handleReset);
 
     // Clean up: remove event listener when component unmounts or chatId changes
     return () => {
       socket.off("new_message", handleNewMessage);
+      socket.off("messages_delivered", handleDelivered);
+      socket.off("chat_reset", handleReset);
     };
   }, [chatId, loggedInUser, onUpdateMessage]);
 
@@ -258,7 +331,13 @@ const ChatDetail = ({ chatId, chatName, chatimage, onUpdateMessage, chatparticip
         sender: loggedInUser.name,
         chatparticipants: chatparticipants,
       };
-      socket.emit("message", messageData);
+      socket.emit("message", messageData, (ack) => {
+        // Over the rate limit the message is not sent, give it back to the input
+        if (ack && ack.status === "rate_limited") {
+          toast.warn("You are sending messages too fast, please wait a moment");
+          setMessage((prevMessage) => prevMessage || messageData.content);
+        }
+      });
       setMessage(''); // Clear input after sending
     }
   };
@@ -479,6 +558,7 @@ const ChatDetail = ({ chatId, chatName, chatimage, onUpdateMessage, chatparticip
                         hour12: true,
                         timeZone: 'Asia/Kolkata',
                       })}
+                      {msg.sender === loggedInUser.name && msg.seq && msg.seq <= deliveredSeq && ' ✓✓'}
                     </span>
                   </div>
                 </div>
@@ -193,10 +193,18 @@ const ChatList = ({ chats, selectedChat, onChatSelect, loggedInUser, setLoggedIn
 
         const data = await response.json();
         console.log('New chat created with ID:', data.chat_id);
-        // Call the parent function to add the chat to the list dynamically
-        onAddChat({ id: data.chat_id, name: data.name, participants: data.participants, image: data.image });
         setNewChatName(''); // Clear the input field
         handleCloseAddChatModal(); // Close the modal
+        if (!data.created) {
+          // The chat with these participants already exists and is in the list
+          toast.info(`Chat ${data.name} already exists.`, {
+            position: 'top-right',
+            autoClose: 2000,
+          });
+          return;
+        }
+        // Call the parent function to add the chat to the list dynamically
+        onAddChat({ id: data.chat_id, name: data.name, participants: data.participants, image: data.image });
         toast.success('Chat added successfully!', {
           position: 'top-right',
           autoClose: 2000,
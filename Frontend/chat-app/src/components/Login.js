@@ -17,7 +17,7 @@ const Login = () => {
     });
     const data = await response.json();
     if (data.status === 'success') {
-      localStorage.setItem('token', 'test');
+      localStorage.setItem('token', data.access_token); // Sent with REST calls and socket connects
       localStorage.setItem('user', JSON.stringify(data.user)); // Store user info
       localStorage.setItem('username', username); // Store creds
       localStorage.setItem('password', password); // Store creds